@@ -0,0 +1,195 @@
+# Admission control for generation jobs: refuse work up front instead of timing it out later
+
+import logging
+import math
+import threading
+import time
+
+import config
+from metrics import Counter, register_collector
+from prompt_scheduler import PRIORITIES
+
+log = logging.getLogger(__name__)
+
+REJECTIONS = Counter('adventure_admission_rejections_total', 'Generation requests refused, by reason', ['reason'])
+
+
+class Overloaded(Exception):
+    """Raised by admit() when a new job should not start now; retry_after is in whole seconds"""
+
+    def __init__(self, message, retry_after, reason, status=429):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+        self.status = status
+
+
+class Ticket:
+    """An admitted job's place in line, held until the job finishes"""
+
+    def __init__(self, client, priority):
+        self.client = client
+        self.rank = PRIORITIES.index(priority)
+        self.cost = 1  # images the job will sample
+        self.job = None
+        self.backend = None  # set with prompt_id once the job's prompt is in a ComfyUI queue
+        self.prompt_id = None
+        self.published = None  # last position sent to the job's event stream
+
+
+class AdmissionControl:
+    """Lets a generation job start only if it can expect to finish, before any vision or LLM time goes into it.
+
+    A new job is refused with a Retry-After hint when MAX_PENDING_JOBS are
+    already unfinished, when its client holds MAX_JOBS_PER_CLIENT of them, or
+    when the images ahead of it would keep it in ComfyUI's queue for longer
+    than ADMISSION_MAX_WAIT. Images ahead are those of the prompts in the
+    healthy backends' queues (ours at their own image count, anyone else's
+    as one) plus those of admitted jobs that have not queued their prompt
+    yet and will go first (same or more urgent priority), each charged the
+    backends' observed sampling time per image.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._tickets = []  # in admission order
+        self._by_job = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        register_collector(self._collect)
+
+    def start(self):
+        if not self._thread:
+            self._thread = threading.Thread(target=self._publish_positions, name='queue-positions', daemon=True)
+            self._thread.start()
+
+    def _backends(self):
+        return [backend for backend in self.pool.backends if backend.healthy]
+
+    def sample_seconds(self, backends):
+        """Average observed run time per image on backends, or the configured guess before any prompt finished"""
+        timed = [backend.tracker.sample_seconds for backend in backends if backend.tracker.sample_seconds]
+        return sum(timed) / len(timed) if timed else config.ADMISSION_SAMPLE_SECONDS
+
+    def _unqueued_images_locked(self, rank=len(PRIORITIES), before=None):
+        """Images of admitted jobs whose prompts are not in a ComfyUI queue yet and go before
+        a job of priority rank: more urgent ones, and equally urgent ones admitted before ticket `before`"""
+        images = 0
+        behind = False
+        for ticket in self._tickets:
+            if ticket is before:
+                behind = True
+            elif ticket.prompt_id is None and (ticket.rank < rank or ticket.rank == rank and not behind):
+                images += ticket.cost
+        return images
+
+    def admit(self, client, priority='interactive'):
+        """Reserve a place in line for a new job from client; raises Overloaded if it should not start"""
+        backends = self._backends()
+        if not backends:
+            self._refuse('Image generation is unavailable, try again shortly', config.COMFY_HEALTH_INTERVAL,
+                         'unavailable', status=503)
+        sample = self.sample_seconds(backends)
+        with self._lock:
+            if len(self._tickets) >= config.MAX_PENDING_JOBS:
+                excess = len(self._tickets) - config.MAX_PENDING_JOBS + 1
+                self._refuse('Too many generations in progress, try again later',
+                             excess * sample / len(backends), 'pending')
+            if config.MAX_JOBS_PER_CLIENT and sum(
+                    ticket.client == client for ticket in self._tickets) >= config.MAX_JOBS_PER_CLIENT:
+                self._refuse(f'You already have {config.MAX_JOBS_PER_CLIENT} generations in progress', sample, 'client')
+            rank = PRIORITIES.index(priority)
+            ahead = sum(backend.load for backend in backends) + self._unqueued_images_locked(rank)
+            wait = ahead * sample / len(backends)
+            if wait > config.ADMISSION_MAX_WAIT:
+                self._refuse('The image queue is full, try again later', wait - config.ADMISSION_MAX_WAIT, 'queue')
+            ticket = Ticket(client, priority)
+            self._tickets.append(ticket)
+        return ticket
+
+    def _refuse(self, message, retry_after, reason, status=429):
+        REJECTIONS.inc(reason=reason)
+        log.info("Refused a generation: %s", message, extra={'reason': reason})
+        raise Overloaded(message, max(1, math.ceil(retry_after)), reason, status)
+
+    def attach(self, ticket, job, cost=1):
+        """Hand a ticket to the job it was admitted for; it is released when the job finishes"""
+        with self._lock:
+            ticket.job = job
+            ticket.rank = PRIORITIES.index(job.priority)
+            ticket.cost = cost
+            self._by_job[job.id] = ticket
+        job.add_done_callback(lambda job: self.release(ticket))
+
+    def abandon(self, ticket):
+        """Give back a ticket whose job was never submitted; does nothing once attached"""
+        if ticket.job is None:
+            self.release(ticket)
+
+    def release(self, ticket):
+        with self._lock:
+            if ticket in self._tickets:
+                self._tickets.remove(ticket)
+            if ticket.job is not None:
+                self._by_job.pop(ticket.job.id, None)
+
+    def prompt_queued(self, job, backend, prompt_id):
+        """Record that job's prompt is in backend's queue, where /queue polls track its place"""
+        with self._lock:
+            ticket = self._by_job.get(job.id)
+            if ticket:
+                ticket.backend = backend
+                ticket.prompt_id = prompt_id
+
+    def position(self, job):
+        """{'position', 'estimated_wait'} of an unfinished job, or None.
+
+        position counts the images ahead of it; estimated_wait is the seconds
+        until it should start sampling.
+        """
+        with self._lock:
+            ticket = self._by_job.get(job.id)
+            return self._position_locked(ticket) if ticket else None
+
+    def _position_locked(self, ticket):
+        if ticket.backend is not None:
+            ahead = ticket.backend.position(ticket.prompt_id)
+            wait = ahead * self.sample_seconds([ticket.backend])
+        else:
+            backends = self._backends() or self.pool.backends
+            ahead = sum(backend.load for backend in backends) + self._unqueued_images_locked(ticket.rank, before=ticket)
+            wait = ahead * self.sample_seconds(backends) / len(backends)
+        return {'position': ahead, 'estimated_wait': round(wait)}
+
+    def _publish_positions(self):
+        """Send each waiting job's event stream a 'queue' event whenever its place changes"""
+        while True:
+            time.sleep(config.QUEUE_POSITION_INTERVAL)
+            updates = []
+            with self._lock:
+                for ticket in self._tickets:
+                    if ticket.job is None:
+                        continue
+                    position = self._position_locked(ticket)
+                    if position != ticket.published:
+                        ticket.published = position
+                        updates.append((ticket.job, position))
+            for job, position in updates:
+                job.publish('queue', position)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._tickets),
+                'unqueued_images': self._unqueued_images_locked(),
+                'clients': len({ticket.client for ticket in self._tickets}),
+            }
+
+    def _collect(self):
+        stats = self.stats()
+        return [
+            ('adventure_admission_pending', 'gauge', 'Admitted generation jobs not finished yet',
+             [({}, stats['pending'])]),
+            ('adventure_admission_unqueued_images', 'gauge', 'Images of admitted jobs not yet queued on ComfyUI',
+             [({}, stats['unqueued_images'])]),
+        ]
@@ -0,0 +1,67 @@
+# The asyncio loop that runs job pipelines, and bridges between it and the worker threads
+
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+# Short blocking work (PIL, SQLite, file I/O) from coroutines; stages never wait on each other here
+blocking_executor = ThreadPoolExecutor(max_workers=config.STAGE_WORKERS, thread_name_prefix='stage')
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a blocking call on the stage threads and await it, keeping the caller's log context"""
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, call)
+
+
+class EventLoopThread:
+    """An asyncio loop running forever in a daemon thread"""
+
+    def __init__(self, name):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """Schedule coro on the loop from any thread; returns a concurrent.futures.Future.
+
+        The task starts from a copy of the submitting thread's contextvars.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+class LoopEvent:
+    """Waits on the running loop for a set() that may come from any thread.
+
+    Stands in for threading.Event where a watcher thread wakes waiters, so a
+    waiting coroutine costs a future instead of a parked thread.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._future = self._loop.create_future()
+
+    def set(self):
+        try:
+            self._loop.call_soon_threadsafe(self._resolve)
+        except RuntimeError:
+            pass  # loop closed at shutdown
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(True)
+
+    def is_set(self):
+        return self._future.done()
+
+    async def wait(self, timeout=None):
+        """True once set, False after timeout seconds"""
+        try:
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
@@ -1,36 +1,130 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
+from flask import Flask, Request, render_template, request, jsonify, send_file, redirect, url_for, abort
+from werkzeug.security import safe_join
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
 import json
 import random
 import time
 import glob
 from datetime import datetime
-import base64
 from io import BytesIO
 from PIL import Image
 import d20
 from ollama import chat, Client
 import sys
-from urllib import request as urllib_request, parse
 import shutil
+import re
+import zlib
+import threading
 import requests
+import httpx
+import logging
+import uuid
 import config
+import logs
+import metrics
+from jobs import JobManager, JobError, TERMINAL_EVENTS
+from output_watcher import OutputWatcher, IMAGE_EXTENSIONS
+from gallery_index import GalleryIndex
+from image_variants import VariantCache, VARIANT_FORMATS, UndecodableImage
+from photo_normalizer import PhotoNormalizer
+from upload_store import UploadStream, UploadRefs
+from hashing import file_sha256
+from vision_cache import VisionCache
+from result_cache import ResultCache, canonical_hash
+from model_scheduler import ModelScheduler
+from aio import run_blocking, blocking_executor
+from pipeline import Stage, run_stages, STAGE_SECONDS
+from comfy_pool import ComfyPool, NoBackendAvailable
+from comfy_tracker import PromptLost
+from admission import AdmissionControl, Overloaded
+from prompt_scheduler import PromptScheduler, PRIORITIES
+from workflow_registry import WorkflowRegistry, Workflow, WorkflowError
+from retention import RetentionManager
+
+logs.setup_logging()
+log = logging.getLogger(__name__)
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Stream photo parts straight into the upload folder instead of spooling them in memory
+        return UploadStream(app.config['UPLOAD_FOLDER'], config.PHOTO_UPLOAD_MAX_BYTES, content_length)
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['UPLOAD_FOLDER'] = config.UPLOAD_FOLDER
 app.config['GENERATED_FOLDER'] = config.GENERATED_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = config.MAX_UPLOAD_SIZE
+app.config['USE_X_SENDFILE'] = config.USE_X_SENDFILE
 
 # Ensure directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['GENERATED_FOLDER'], exist_ok=True)
 
-# Initialize Ollama client
-client = Client(host=config.OLLAMA_HOST)
+# Initialize Ollama client; all chat calls go through the per-model batching scheduler
+client = ModelScheduler(Client(host=config.OLLAMA_HOST))
 omodel = config.OLLAMA_MAIN_MODEL
+photo_normalizer = PhotoNormalizer(config.PHOTO_CACHE_DIR, config.PHOTO_CACHE_MAX_BYTES)
+vision_cache = VisionCache(config.VISION_CACHE_PATH, config.VISION_CACHE_MAX_ENTRIES,
+                           config.VISION_CACHE_TTL, config.VISION_CACHE_PHASH_DISTANCE)
+
+# API-format ComfyUI workflows, loaded from disk and patched per request
+workflow_registry = WorkflowRegistry(config.WORKFLOW_DIR, config.DEFAULT_WORKFLOW)
+
+# ComfyUI backends: pooled client, completion tracker and health/queue polling per host
+comfy_pool = ComfyPool(config.COMFYUI_HOSTS)
+
+# Background worker pool for /generate pipelines
+job_manager = JobManager()
+
+# Refuses new generations the backends could not get to in time
+admission = AdmissionControl(comfy_pool)
+
+# Feeds prompts to each backend a few at a time, interactive ones first
+prompt_scheduler = PromptScheduler()
+
+# Photos still needed by unfinished jobs
+upload_refs = UploadRefs()
 
 # Local ComfyUI output directory used for filesystem-based watching and gallery
-COMFY_OUTPUT_DIR = '/home/ut/3Git/ComfyUI/output/adventure'
+COMFY_OUTPUT_DIR = config.COMFY_OUTPUT_DIR
+output_watcher = OutputWatcher(COMFY_OUTPUT_DIR)
+gallery_index = GalleryIndex(config.GALLERY_INDEX_PATH)
+output_watcher.subscribe(gallery_index.on_watcher_event)
+# Finished generations by input hash; follows the same watcher so it never outlives a gallery image
+result_cache = ResultCache(config.RESULT_CACHE_PATH, COMFY_OUTPUT_DIR,
+                           config.RESULT_CACHE_MAX_ENTRIES, config.RESULT_CACHE_TTL)
+output_watcher.subscribe(result_cache.on_watcher_event)
+variant_cache = VariantCache(config.VARIANT_CACHE_DIR, config.VARIANT_CACHE_MAX_BYTES)
+output_synced = threading.Event()
+
+def prewarm_new_output(event, filename, info):
+    """Pre-render gallery thumbnails for portraits that land after the initial scan"""
+    if event == 'synced':
+        output_synced.set()
+    elif event == 'created' and output_synced.is_set():
+        variant_cache.prewarm(os.path.join(COMFY_OUTPUT_DIR, filename))
+
+output_watcher.subscribe(prewarm_new_output)
+
+# ComfyUI saves <prefix>_<counter>_.png, counting on from the highest counter in the folder
+COMFY_OUTPUT_NAME = re.compile(r'(?P<prefix>.+)_(?P<counter>\d+)_\.[^.]+')
+
+def comfy_output_series(filename):
+    """(prefix, counter) of a ComfyUI output name, so retention keeps the newest of each prefix and
+    ComfyUI never reuses a name browsers were told is immutable"""
+    match = COMFY_OUTPUT_NAME.fullmatch(filename)
+    return (match['prefix'], int(match['counter'])) if match else None
+
+# Keeps uploaded photos and portraits within their size and age caps, least recently used first
+retention = RetentionManager()
+upload_retention = retention.add_folder('uploads', app.config['UPLOAD_FOLDER'], config.UPLOAD_RETENTION_MAX_BYTES,
+                                        config.UPLOAD_RETENTION_MAX_AGE, protected=upload_refs.held)
+output_retention = retention.add_folder('outputs', COMFY_OUTPUT_DIR, config.OUTPUT_RETENTION_MAX_BYTES,
+                                        config.OUTPUT_RETENTION_MAX_AGE, watcher=output_watcher,
+                                        protected=lambda path: output_in_use(os.path.basename(path)),
+                                        series=comfy_output_series)
+output_watcher.start()
 
 # D&D Classes
 dnd_classes = ['Bard', 'Paladin', 'Rogue', 'Wizard', 'Fighter', 'Cleric', 'Druid', 'Ranger', 'Barbarian', 'Monk', 'Sorcerer', 'Warlock']
@@ -55,25 +149,66 @@ class Character:
             self.stats[stat] = random.randint(8, 18)
         return self.stats
 
-def analyze_image_with_vision(image_path):
+def output_in_use(filename):
+    """Portraits retention must keep: pinned ones, those in the result of an unfinished or still
+    pollable job, and result cache entries stored or hit within JOB_RESULT_TTL, which a client may still fetch"""
+    return (gallery_index.is_pinned(filename) or job_manager.uses_output(filename)
+            or result_cache.used_since(filename, time.time() - config.JOB_RESULT_TTL))
+
+def roll_party(size):
+    """Roll a whole party at once: distinct classes while they last and a stat block for each member"""
+    classes = random.sample(dnd_classes, min(size, len(dnd_classes)))
+    classes += random.choices(dnd_classes, k=size - len(classes))
+    stamp = int(time.time())
+    party = []
+    for number, character_class in enumerate(classes, 1):
+        character = Character()
+        character.name = f'Hero_{stamp}_{number}'
+        character.character_class = character_class
+        character.random_stats()
+        party.append(character)
+    return party
+
+def normalize_photo(image_path):
+    """Upright, downscaled copies of an upload: (path for the vision model, path for ComfyUI)"""
+    try:
+        return (photo_normalizer.normalize(image_path),
+                photo_normalizer.normalize(image_path, crop_face=config.PHOTO_FACE_CROP))
+    except UndecodableImage as e:
+        # A truncated or corrupt photo that got past the upload check
+        raise JobError(f'The photo could not be read: {e}')
+    except Exception as e:
+        log.warning("Photo normalization error: %s", e)
+        return image_path, image_path
+
+async def analyze_image_with_vision(image_path):
     """Use vision model to analyze uploaded image"""
     try:
-        vision_response = client.chat(
+        # The same (or a near-identical) photo skips the vision model entirely
+        cache_key = await run_blocking(vision_cache.key_for, image_path)
+        cached = await run_blocking(vision_cache.get, cache_key, config.OLLAMA_VISION_MODEL)
+        if cached:
+            return cached
+        vision_response = await client.chat_async(
             model=config.OLLAMA_VISION_MODEL, 
             messages=[{
                 'role': 'user',
                 'content': 'Describe the person in this image. Take great care to describe the hair, face, and body. Ignore the background and surroundings.',
                 'images': [image_path]
-            }],
-            keep_alive=0
+            }]
         )
-        return vision_response['message']['content']
+        description = vision_response['message']['content']
+        await run_blocking(vision_cache.put, cache_key, config.OLLAMA_VISION_MODEL, description)
+        return description
     except Exception as e:
-        print(f"Vision analysis error: {e}")
+        log.error("Vision analysis error: %s", e)
         return "A person with distinctive features suitable for a fantasy character."
 
-def generate_character_description(character):
-    """Generate character description using Ollama"""
+async def generate_character_description(character, on_token=None, seed=None):
+    """Generate character description using Ollama; on_token(text) streams the reply as it is written.
+
+    With a seed the model samples deterministically, so the same character gets the same description.
+    """
     try:
         messages = [{
             'role': 'user', 
@@ -88,90 +223,174 @@ def generate_character_description(character):
             '''
         }]
         
-        response = client.chat(omodel, messages=messages)
-        return response.message.content
+        options = {'seed': seed} if seed is not None else None
+        response = await client.chat_async(omodel, messages=messages, on_chunk=on_token, options=options)
+        return response['message']['content']
     except Exception as e:
-        print(f"Character description error: {e}")
+        log.error("Character description error: %s", e)
         return f"A {character.character_class} named {character.name} with the described physical features."
 
-def upload_image_to_comfyui(image_path, comfyui_host=None):
-    """Upload image to ComfyUI server"""
-    if not comfyui_host:
-        comfyui_host = config.COMFYUI_HOST
+PARTY_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'characters': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {'name': {'type': 'string'}, 'description': {'type': 'string'}},
+                'required': ['name', 'description']
+            }
+        }
+    },
+    'required': ['characters']
+}
+
+async def generate_party_descriptions(party, seed=None):
+    """Describe every party member with one structured Ollama call; returns one description per member"""
+    fallback = [f"A {character.character_class} named {character.name} with the described physical features."
+                for character in party]
+    members = '\n'.join(
+        f'''            {number}. Name: {character.name}
+            Class: {character.character_class}
+            Stats: {character.stats}
+            Physical Description: {character.user_description}'''
+        for number, character in enumerate(party, 1))
     try:
-        with open(image_path, 'rb') as f:
-            files = {'image': (os.path.basename(image_path), f, 'image/png')}
-            response = requests.post(f"http://{comfyui_host}/upload/image", files=files)
-            if response.status_code == 200:
-                result = response.json()
-                return result.get('name', os.path.basename(image_path))
-            else:
-                print(f"Failed to upload image: {response.status_code} - {response.text}")
-                return None
+        messages = [{
+            'role': 'user',
+            'content': f'''Create a detailed visual description for each member of this D&D adventuring party:
+{members}
+
+            Describe each character with appropriate equipment, pose, and adventuring style for their class.
+            Include details about armor, weapons, magic items, and setting that would make a great fantasy portrait.
+            Answer with one entry in "characters" per member, in the same order.
+            '''
+        }]
+
+        options = {'seed': seed} if seed is not None else None
+        response = await client.chat_async(omodel, messages=messages, format=PARTY_SCHEMA, options=options)
+        characters = json.loads(response['message']['content']).get('characters', [])
+        descriptions = [entry.get('description') for entry in characters[:len(party)]]
+        # Members the model skipped keep the plain fallback description
+        descriptions += [None] * (len(party) - len(descriptions))
+        return [description or default for description, default in zip(descriptions, fallback)]
     except Exception as e:
-        print(f"Error uploading image to ComfyUI: {e}")
-        return None
+        log.error("Party description error: %s", e)
+        return fallback
 
-def queue_comfyui_prompt(prompt_data):
-    """Queue prompt to ComfyUI"""
-    try:
-        p = {"prompt": prompt_data}
-        data = json.dumps(p).encode('utf-8')
-        req = urllib_request.Request(f"http://{config.COMFYUI_HOST}/prompt", data=data)
-        urllib_request.urlopen(req)
+def get_comfy_client(comfyui_host=None):
+    """Shared pooled client for a ComfyUI host (the first of config.COMFYUI_HOSTS by default)"""
+    return comfy_pool.get(comfyui_host).client
+
+def is_backend_failure(error):
+    """True for errors that mean the ComfyUI node itself is unreachable or broken"""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError)):
         return True
-    except Exception as e:
-        print(f"ComfyUI queue error: {e}")
-        return False
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code >= 500
 
-def get_latest_generated_image(output_dir=None):
-    """Get the latest generated image from ComfyUI output directory"""
-    if not output_dir:
-        # Try to find ComfyUI output directory
-        possible_dirs = [
-            '/home/ut/3Git/ComfyUI/output',
-            './ComfyUI/output',
-            '../ComfyUI/output',
-            os.path.expanduser('~/ComfyUI/output')
-        ]
-        
-        for dir_path in possible_dirs:
-            if os.path.exists(dir_path):
-                output_dir = dir_path
-                break
-        
-        if not output_dir:
-            return None
-    
-    if not os.path.exists(output_dir):
-        return None
-    
-    png_files = glob.glob(os.path.join(output_dir, "*.png"))
-    if not png_files:
-        return None
-    
-    # Get the most recent file
-    latest_file = max(png_files, key=os.path.getctime)
-    return latest_file
+async def upload_to_backend(job, image_paths, exclude=(), images=1):
+    """Upload images to the least-loaded healthy backend, failing over; returns (backend, image_names).
+
+    The job's `images` (how many it will sample) count against the backend's load until its prompt is queued there.
+    """
+    tried = set(exclude)
+    job.add_done_callback(lambda job: comfy_pool.unclaim(job.id))
+    while True:
+        try:
+            backend = comfy_pool.choose(exclude=tried, claim=job.id, images=images)
+        except NoBackendAvailable:
+            raise JobError('Failed to upload image to ComfyUI server')
+        try:
+            return backend, [await backend.upload_image_async(path) for path in image_paths]
+        except Exception as e:
+            log.error("Error uploading image to ComfyUI at %s: %s", backend.host, e)
+            if not is_backend_failure(e):
+                raise JobError('Failed to upload image to ComfyUI server')
+            comfy_pool.mark_failed(backend, e)
+            tried.add(backend.host)
+
+async def queue_on_backend(job, backend, image_names, image_paths, build_prompt, exclude=(), images=1):
+    """Queue build_prompt(backend, image_names) on backend once the prompt scheduler has room there for
+    the job's priority, moving the job (and its images) to another node if this one stops responding.
+
+    Returns (slot, prompt_id); slot.backend is the node that took the prompt, and the slot must be
+    released once the prompt is done (the job's end releases it too).
+    """
+    tried = set(exclude)
+    while True:
+        slot = await prompt_scheduler.acquire(backend, job.priority)
+        job.add_done_callback(lambda job, slot=slot: settle_prompt(job, slot))
+        try:
+            prompt_id = await backend.client.queue_prompt_async(build_prompt(backend, image_names),
+                                                                backend.tracker.client_id, front=slot.front)
+            if not prompt_id:
+                raise JobError('Failed to queue generation')
+            slot.prompt_id = prompt_id
+            # Sampling time is charged per image, so a party prompt does not skew the estimate
+            backend.tracker.expect(prompt_id, images)
+            comfy_pool.unclaim(job.id)
+            admission.prompt_queued(job, backend, prompt_id)
+            return slot, prompt_id
+        except JobError:
+            prompt_scheduler.release(slot)
+            raise
+        except Exception as e:
+            prompt_scheduler.release(slot)
+            log.error("ComfyUI queue error at %s: %s", backend.host, e)
+            if not is_backend_failure(e):
+                raise JobError('Failed to queue generation')
+            comfy_pool.mark_failed(backend, e)
+            tried.add(backend.host)
+            # The uploaded images only exist on the failed node, so send them again
+            backend, image_names = await upload_to_backend(job, image_paths, exclude=tried, images=images)
+
+async def wait_on_backend(job, slot, prompt_id, image_paths, build_prompt, max_wait=None, on_progress=None,
+                          images=1):
+    """Wait for the outputs of a prompt from queue_on_backend(), queueing it again on another node
+    (images and all) if the one running it goes away meanwhile.
 
-def get_files_in_directory(output_dir):
-    """Return a dict of file_path -> ctime for PNG files in a directory."""
-    files_map = {}
+    Returns (slot, images): the slot of the node that ran it, and wait_for_outputs()'s result.
+    """
+    tried = set()
+    while True:
+        backend = slot.backend
+        comfy_pool.started(backend, prompt_id, images)
+        try:
+            return slot, await wait_for_outputs(prompt_id, max_wait, on_progress, backend.host)
+        except PromptLost as e:
+            log.warning("%s; queueing it again elsewhere", e)
+            tried.add(backend.host)
+        finally:
+            comfy_pool.finished(backend, prompt_id, images)
+            prompt_scheduler.release(slot)
+        try:
+            comfy_pool.choose(exclude=tried)
+        except NoBackendAvailable:
+            raise JobError('The ComfyUI server went away during generation')
+        backend, image_names = await upload_to_backend(job, image_paths, exclude=tried, images=images)
+        slot, prompt_id = await queue_on_backend(job, backend, image_names, image_paths, build_prompt, exclude=tried,
+                                                 images=images)
+
+def settle_prompt(job, slot):
+    """Job done callback: free the prompt's room, and take it off ComfyUI if the job ended without its image"""
+    prompt_scheduler.release(slot)
+    if job.status != 'completed' and slot.prompt_id:
+        blocking_executor.submit(cancel_prompt, slot.backend, slot.prompt_id)
+
+def cancel_prompt(backend, prompt_id):
     try:
-        for path in glob.glob(os.path.join(output_dir, '*.png')):
-            try:
-                files_map[path] = os.path.getctime(path)
-            except Exception:
-                continue
+        action = backend.cancel_prompt(prompt_id)
+        if action:
+            log.info("ComfyUI prompt %s %s on %s", prompt_id, action, backend.host)
     except Exception as e:
-        print(f"[DEBUG] Error reading directory {output_dir}: {e}")
-    return files_map
+        log.warning("Could not cancel ComfyUI prompt %s on %s: %s", prompt_id, backend.host, e)
 
 def log_comfyui_directory_state(note=None):
-    """Print helpful debug info about ComfyUI outputs and local state."""
+    """Log helpful debug info about ComfyUI outputs and local state."""
     try:
         if note:
-            print(f"[DEBUG] {note}")
+            log.debug("%s", note)
         # Attempt to list local ComfyUI output directories (if accessible on this machine)
         possible_dirs = [
             '/home/ut/3Git/ComfyUI/output',
@@ -181,55 +400,138 @@ def log_comfyui_directory_state(note=None):
         ]
         for dir_path in possible_dirs:
             exists = os.path.exists(dir_path)
-            print(f"[DEBUG] Checking local path: {dir_path} exists={exists}")
+            log.debug("Checking local path: %s exists=%s", dir_path, exists)
             if exists:
                 try:
                     files = sorted(glob.glob(os.path.join(dir_path, '*.png')))
                     tail = files[-10:]
-                    print(f"[DEBUG] Local output png count: {len(files)}; last 10: {[os.path.basename(f) for f in tail]}")
+                    log.debug("Local output png count: %d; last 10: %s", len(files), [os.path.basename(f) for f in tail])
                 except Exception as e:
-                    print(f"[DEBUG] Error listing {dir_path}: {e}")
+                    log.debug("Error listing %s: %s", dir_path, e)
     except Exception as e:
-        print(f"[DEBUG] Error in log_comfyui_directory_state: {e}")
+        log.debug("Error in log_comfyui_directory_state: %s", e)
+
+@app.before_request
+def tag_request():
+    """Give every request an id (the caller's X-Request-ID if sent) that its log lines carry"""
+    request.environ['adventure.request_id_token'] = logs.request_id.set(
+        request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16])
+
+@app.after_request
+def add_request_id(response):
+    response.headers['X-Request-ID'] = logs.request_id.get()
+    return response
+
+@app.teardown_request
+def untag_request(error=None):
+    token = request.environ.pop('adventure.request_id_token', None)
+    if token:
+        logs.request_id.reset(token)
 
 @app.route('/')
 def index():
     return render_template('index.html', dnd_classes=dnd_classes)
 
+def save_uploaded_photo(file, held):
+    """Keep an uploaded photo in UPLOAD_FOLDER under its SHA-256; returns its path, or None for an empty file field.
+
+    The photo is held in upload_refs from the moment it is committed and its
+    path added to held, until hand_over_uploads() passes the hold to a job or
+    the request gives it back. Raises UndecodableImage for a file that is not
+    an image, which is deleted again unless another job uses the same file.
+    """
+    if file.filename == '':
+        return None
+    path = file.stream.commit(os.path.splitext(file.filename)[1] or 'png', refs=upload_refs)
+    try:
+        # Only the header is read here; normalization decodes the rest
+        with Image.open(path):
+            pass
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        for deleted in upload_refs.release([path], delete=True):
+            upload_retention.forget(os.path.basename(deleted))
+        raise UndecodableImage(f'{file.filename} is not a supported image') from e
+    held.append(path)
+    upload_retention.touch(os.path.basename(path))
+    return path
+
+def parse_seed(value):
+    """Seed from a form field, or a fresh random one when it is missing; raises ValueError if malformed"""
+    if value in (None, ''):
+        return random.randint(1, 1000000)
+    try:
+        seed = int(value)
+    except ValueError:
+        raise ValueError('Seed must be an integer')
+    if not 0 <= seed <= config.MAX_SEED:
+        raise ValueError(f'Seed must be between 0 and {config.MAX_SEED}')
+    return seed
+
+def parse_priority(value, default):
+    """Priority from a form field; a request may lower its endpoint's default but not raise it"""
+    if value in (None, ''):
+        return default
+    if value not in PRIORITIES:
+        raise ValueError(f"Priority must be one of: {', '.join(PRIORITIES)}")
+    return max(value, default, key=PRIORITIES.index)
+
+def client_address():
+    """Who a request counts against for MAX_JOBS_PER_CLIENT"""
+    if config.CLIENT_ADDRESS_HEADER:
+        forwarded = request.headers.get(config.CLIENT_ADDRESS_HEADER)
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote_addr
+
+@app.errorhandler(Overloaded)
+def refuse_generation(e):
+    """429 (503 with no backend up) before the upload is even read, with a hint of when to come back"""
+    response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+    response.status_code = e.status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def hand_over_uploads(job, paths, held):
+    """Pass the request's holds on paths to job, which releases them when it finishes.
+
+    A cancelled job's photos are deleted unless another job still holds them.
+    """
+    for path in paths:
+        held.remove(path)
+    job.add_done_callback(lambda job: release_job_uploads(job, paths))
+
+def release_job_uploads(job, paths):
+    for path in upload_refs.release(paths, delete=job.status == 'cancelled'):
+        upload_retention.forget(os.path.basename(path))
+
+def job_accepted(job, seed):
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'seed': seed,
+        'queue': admission.position(job),
+        'status_url': url_for('job_status', job_id=job.id),
+        'events_url': url_for('job_events', job_id=job.id)
+    }), 202
+
 @app.route('/generate', methods=['POST'])
 def generate_character():
+    ticket = admission.admit(client_address())
+    held = []  # photos this request committed and has not handed to its job
     try:
         # Get form data
         generation_type = request.form.get('generation_type', 'manual')
         character = Character()
         
-        # Handle file upload
+        # Handle file upload; a webcam capture arrives as its own file part and takes precedence
         uploaded_file = None
-        if 'photo' in request.files:
-            file = request.files['photo']
-            if file.filename != '':
-                filename = f"{int(time.time())}_{file.filename}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                uploaded_file = filepath
-        
-        # Handle webcam data
-        webcam_data = request.form.get('webcam_data')
-        if webcam_data and webcam_data != '':
-            # Decode base64 image
-            image_data = base64.b64decode(webcam_data.split(',')[1])
-            filename = f"webcam_{int(time.time())}.png"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
-            uploaded_file = filepath
+        for field in ('photo', 'webcam'):
+            if field in request.files:
+                uploaded_file = save_uploaded_photo(request.files[field], held) or uploaded_file
         
         if not uploaded_file:
             return jsonify({'error': 'No image provided'}), 400
         
-        # Analyze image with vision model
-        character.user_description = analyze_image_with_vision(uploaded_file)
-        
         if generation_type == 'manual':
             # Get manual stats from form
             character.name = request.form.get('name', f'Hero_{int(time.time())}')
@@ -248,269 +550,550 @@ def generate_character():
             character.character_class = random.choice(dnd_classes)
             character.random_stats()
         
-        # Upload image to ComfyUI server first
-        uploaded_image_name = upload_image_to_comfyui(uploaded_file)
-        if not uploaded_image_name:
-            return jsonify({'error': 'Failed to upload image to ComfyUI server'}), 500
-        
-        # Generate character description
-        description = generate_character_description(character)
-        
-        # Create ComfyUI prompt using the uploaded image name
-        comfy_prompt = create_comfyui_prompt(description, uploaded_image_name)
+        try:
+            workflow = workflow_registry.get(request.form.get('workflow') or None)
+            seed = parse_seed(request.form.get('seed'))
+            priority = parse_priority(request.form.get('priority'), 'interactive')
+        except (WorkflowError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Queue to ComfyUI
-        if queue_comfyui_prompt(comfy_prompt):
-            # Wait for generation and get result via filesystem
-            generated_image_filename = wait_for_generation()
-            
-            if generated_image_filename:
-                return jsonify({
-                    'success': True,
-                    'character': {
-                        'name': character.name,
-                        'class': character.character_class,
-                        'stats': character.stats,
-                        'description': description
-                    },
-                    'generated_image': generated_image_filename
-                })
-            else:
-                return jsonify({'error': 'Image generation failed or timed out'}), 500
-        else:
-            return jsonify({'error': 'Failed to queue generation'}), 500
+        # Run the slow pipeline in the background and hand back a job id right away
+        job = job_manager.submit(run_generation_pipeline, character, uploaded_file, workflow, seed, priority=priority)
+        admission.attach(ticket, job)
+        hand_over_uploads(job, [uploaded_file], held)
+        return job_accepted(job, seed)
             
+    except UndecodableImage as e:
+        return jsonify({'error': str(e)}), 400
+    except RequestEntityTooLarge as e:
+        return jsonify({'error': e.description}), 413
     except Exception as e:
-        print(f"Generation error: {e}")
+        log.exception("Generation error: %s", e)
         return jsonify({'error': str(e)}), 500
+    finally:
+        admission.abandon(ticket)
+        upload_refs.release(held)
 
-def create_comfyui_prompt(description, image_name):
-    """Create ComfyUI prompt based on the existing workflow"""
-    # Use the full workflow from the original script
-    prompt_template = {
-        "3": {
-            "inputs": {
-                "seed": random.randint(1, 1000000),
-                "steps": 45,
-                "cfg": 6.5,
-                "sampler_name": "ddpm",
-                "scheduler": "karras",
-                "denoise": 1,
-                "model": ["21", 0],
-                "positive": ["6", 0],
-                "negative": ["7", 0],
-                "latent_image": ["5", 0]
-            },
-            "class_type": "KSampler",
-            "_meta": {"title": "KSampler"}
-        },
-        "4": {
-            "inputs": {
-                "ckpt_name": "dreamshaper_8.safetensors"
-            },
-            "class_type": "CheckpointLoaderSimple",
-            "_meta": {"title": "Load Checkpoint"}
-        },
-        "5": {
-            "inputs": {
-                "width": 512,
-                "height": 512,
-                "batch_size": 1
-            },
-            "class_type": "EmptyLatentImage",
-            "_meta": {"title": "Empty Latent Image"}
-        },
-        "6": {
-            "inputs": {
-                "text": description,
-                "clip": ["34", 1]
-            },
-            "class_type": "CLIPTextEncode",
-            "_meta": {"title": "CLIP Text Encode (Prompt)"}
-        },
-        "7": {
-            "inputs": {
-                "text": "blurry, noisy, messy, lowres, jpeg, artifacts, ill, distorted, malformed",
-                "clip": ["4", 1]
-            },
-            "class_type": "CLIPTextEncode",
-            "_meta": {"title": "CLIP Text Encode (Prompt)"}
-        },
-        "8": {
-            "inputs": {
-                "samples": ["3", 0],
-                "vae": ["4", 2]
-            },
-            "class_type": "VAEDecode",
-            "_meta": {"title": "VAE Decode"}
-        },
-        "12": {
-            "inputs": {
-                "image": image_name
-            },
-            "class_type": "LoadImage",
-            "_meta": {"title": "Load Image"}
-        },
-        "18": {
-            "inputs": {
-                "weight": 0.8,
-                "weight_faceidv2": -0.77,
-                "weight_type": "linear",
-                "combine_embeds": "concat",
-                "start_at": 0,
-                "end_at": 1,
-                "embeds_scaling": "V only",
-                "model": ["20", 0],
-                "ipadapter": ["20", 1],
-                "image": ["12", 0]
-            },
-            "class_type": "IPAdapterFaceID",
-            "_meta": {"title": "IPAdapter FaceID"}
-        },
-        "20": {
-            "inputs": {
-                "preset": "FACEID PLUS V2",
-                "lora_strength": 0.5,
-                "provider": "CPU",
-                "model": ["34", 0]
-            },
-            "class_type": "IPAdapterUnifiedLoaderFaceID",
-            "_meta": {"title": "IPAdapter Unified Loader FaceID"}
-        },
-        "21": {
-            "inputs": {
-                "weight": 0.4,
-                "start_at": 0,
-                "end_at": 1,
-                "weight_type": "standard",
-                "model": ["22", 0],
-                "ipadapter": ["22", 1],
-                "image": ["18", 1]
-            },
-            "class_type": "IPAdapter",
-            "_meta": {"title": "IPAdapter"}
-        },
-        "22": {
-            "inputs": {
-                "preset": "FULL FACE - SD1.5 only (portraits stronger)",
-                "model": ["18", 0],
-                "ipadapter": ["20", 1]
-            },
-            "class_type": "IPAdapterUnifiedLoader",
-            "_meta": {"title": "IPAdapter Unified Loader"}
-        },
-        "34": {
-            "inputs": {
-                "lora_name": "pixelart_style_eagle_v6.safetensors",
-                "strength_model": 1.0,
-                "strength_clip": 1.0,
-                "model": ["4", 0],
-                "clip": ["4", 1]
+async def run_generation_pipeline(job, character, uploaded_file, workflow, seed):
+    """Normalize -> vision + ComfyUI upload -> description -> queue -> wait, run on the job loop.
+
+    The upload does not depend on the vision result or the character, so it
+    runs concurrently with vision analysis and the description. A request
+    seen before with the same seed returns its earlier result straight away,
+    and a patched workflow rendered before skips ComfyUI.
+    """
+    def result(description, generated_image, cached=False):
+        job_manager.add_outputs(job, [generated_image])
+        return {
+            'character': {
+                'name': character.name,
+                'class': character.character_class,
+                'stats': character.stats,
+                'description': description
             },
-            "class_type": "LoraLoader",
-            "_meta": {"title": "Load LoRA"}
-        },
-         "37": {
-            "inputs": {
-              "filename_prefix": "ComfyUI",
-              "subdirectory_name": "adventure",
-              "output_format": "png",
-                "quality": "max",
-                "metadata_scope": "full",
-                "include_batch_num": "true",
-                "prefer_nearest": "true",
-                "images": ["8",0]
-                 },
-    "class_type": "SaveImageWithMetaData",
-    "_meta": {
-      "title": "Save Image With MetaData"
-          }
-    }
-}
-    return prompt_template
+            'generated_image': generated_image,
+            'seed': seed,
+            'cached': cached,
+            'timings': dict(job.timings)
+        }
+
+    request_key = canonical_hash({
+        'photo': await run_blocking(file_sha256, uploaded_file),
+        'name': character.name,
+        'class': character.character_class,
+        'stats': character.stats,
+        'workflow': [workflow.name, workflow.mtime],
+        'models': [config.OLLAMA_VISION_MODEL, omodel],
+        'seed': seed,
+    })
+    cached = await run_blocking(result_cache.get, request_key)
+    if cached:
+        return result(cached['description'], cached['filename'], cached=True)
+
+    def normalize(results):
+        return normalize_photo(uploaded_file)
+
+    async def vision(results):
+        # Analyze image with vision model
+        character.user_description = await analyze_image_with_vision(results['normalize'][0])
+
+    async def upload(results):
+        return await upload_to_backend(job, [results['normalize'][1]])
+
+    async def describe(results):
+        return await generate_character_description(
+            character, on_token=lambda text: job.publish('token', {'text': text}), seed=seed)
 
-def get_comfyui_history(comfyui_host=None):
-    """Get ComfyUI generation history"""
-    if not comfyui_host:
-        comfyui_host = config.COMFYUI_HOST
+    def lookup(results):
+        # The patched workflow, with the photo by content hash and no node-specific names, identifies the image
+        prompt_key = canonical_hash(create_comfyui_prompt(
+            results['description'], file_sha256(results['normalize'][1]), workflow, seed=seed))
+        return prompt_key, result_cache.get(prompt_key)
+
+    def build_prompt(results):
+        return lambda node, names: create_comfyui_prompt(
+            results['description'], names[0], workflow, filename_prefix=node.filename_prefix, seed=seed)
+
+    async def queue(results):
+        if results['lookup'][1]:
+            return None
+        # Create ComfyUI prompt using the uploaded image name, on the node that holds the image
+        backend, image_names = results['upload']
+        return await queue_on_backend(job, backend, image_names, [results['normalize'][1]], build_prompt(results))
+
+    def sampler_progress(data):
+        # The workflow's sampler node reports one event per step
+        if data.get('node') == workflow.progress_node and data.get('max'):
+            job.set_progress(0.6 + 0.35 * data['value'] / data['max'], step=data['value'], steps=data['max'])
+
+    async def generate(results):
+        prompt_key, cached = results['lookup']
+        if cached:
+            # Remember the request too, so an identical repeat skips vision and the LLM as well
+            await run_blocking(result_cache.put, [request_key], cached['filename'], results['description'])
+            return cached['filename']
+        # Wait for this prompt's own outputs, on the node that ran it
+        slot, prompt_id = results['queue']
+        _, images = await wait_on_backend(job, slot, prompt_id, [results['normalize'][1]], build_prompt(results),
+                                          on_progress=sampler_progress)
+        if not images:
+            raise JobError('Image generation failed or timed out')
+        generated_image_filename = images[0]['filename']
+        await run_blocking(result_cache.put, [request_key, prompt_key], generated_image_filename,
+                           results['description'])
+        return generated_image_filename
+
+    results = await run_stages(job, [
+        Stage('normalize', normalize, progress=0.05),
+        Stage('vision', vision, deps=['normalize'], progress=0.1),
+        Stage('upload', upload, deps=['normalize'], progress=0.1),
+        Stage('description', describe, deps=['vision'], progress=0.4),
+        Stage('lookup', lookup, deps=['description', 'normalize'], progress=0.5),
+        Stage('queue', queue, deps=['lookup', 'upload'], progress=0.55),
+        Stage('generating', generate, deps=['lookup', 'queue'], progress=0.6),
+    ])
+    
+    return result(results['description'], results['generating'], cached=results['lookup'][1] is not None)
+
+@app.route('/party', methods=['POST'])
+def generate_party():
+    """Generate a whole party as one job: `size` random members drawn from one or more photos in turn"""
+    ticket = admission.admit(client_address(), 'batch')
+    held = []  # photos this request committed and has not handed to its job
     try:
-        response = requests.get(f"http://{comfyui_host}/history")
-        if response.status_code == 200:
-            return response.json()
-        return None
+        photos = [path for path in (save_uploaded_photo(file, held) for file in request.files.getlist('photo')) if path]
+        if not photos:
+            return jsonify({'error': 'No image provided'}), 400
+        size = request.form.get('size', len(photos), type=int)
+        if not 1 <= size <= config.PARTY_MAX_SIZE:
+            return jsonify({'error': f'Party size must be between 1 and {config.PARTY_MAX_SIZE}'}), 400
+
+        try:
+            workflow = workflow_registry.get(request.form.get('workflow') or None)
+            seed = parse_seed(request.form.get('seed'))
+            priority = parse_priority(request.form.get('priority'), 'batch')
+        except (WorkflowError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        job = job_manager.submit(run_party_pipeline, roll_party(size), photos, workflow, seed,
+                                 kind='party', priority=priority)
+        admission.attach(ticket, job, cost=size)
+        hand_over_uploads(job, photos, held)
+        return job_accepted(job, seed)
+
+    except UndecodableImage as e:
+        return jsonify({'error': str(e)}), 400
+    except RequestEntityTooLarge as e:
+        return jsonify({'error': e.description}), 413
     except Exception as e:
-        print(f"Error getting ComfyUI history: {e}")
-        return None
+        log.exception("Party generation error: %s", e)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        admission.abandon(ticket)
+        upload_refs.release(held)
+
+async def run_party_pipeline(job, party, photos, workflow, seed):
+    """Normalize + vision per photo, upload -> one description call -> one multi-branch ComfyUI prompt -> wait.
+
+    Every member is a branch of the same ComfyUI prompt, so the checkpoint and
+    LoRAs load once and the party waits in the ComfyUI queue once. Member n
+    is sampled with seed + n.
+    """
+    def normalize(path):
+        return lambda results: normalize_photo(path)
+
+    def vision(number):
+        async def analyze(results):
+            return await analyze_image_with_vision(results[f'normalize_{number}'][0])
+        return analyze
+
+    def comfy_photos(results):
+        return [results[f'normalize_{number}'][1] for number in range(len(photos))]
+
+    async def upload(results):
+        return await upload_to_backend(job, comfy_photos(results), images=len(party))
 
-def download_generated_image(filename, subfolder=None, image_type=None, comfyui_host=None):
-    """Download generated image from ComfyUI server using filename, and optional subfolder/type."""
-    if not comfyui_host:
-        comfyui_host = config.COMFYUI_HOST
+    async def describe(results):
+        for number, character in enumerate(party):
+            character.user_description = results[f'vision_{number % len(photos)}']
+        return await generate_party_descriptions(party, seed=seed)
+
+    async def queue(results):
+        backend, image_names = results['upload']
+        node_maps = {}
+
+        def build_prompt(node, names):
+            branches = [
+                {'positive': description, 'image': names[number % len(photos)], 'seed': seed + number}
+                for number, description in enumerate(results['description'])
+            ]
+            shared = {}
+            if node.filename_prefix and 'filename_prefix' in workflow.patch_points:
+                shared['filename_prefix'] = node.filename_prefix
+            prompt, node_maps[node.host] = workflow.build_branches(branches, **shared)
+            return prompt
+
+        slot, prompt_id = await queue_on_backend(job, backend, image_names, comfy_photos(results), build_prompt,
+                                                 images=len(party))
+        return slot, prompt_id, build_prompt, node_maps
+
+    async def generate(results):
+        slot, prompt_id, build_prompt, node_maps = results['queue']
+        samplers = ({node_map[workflow.progress_node] for node_map in node_maps[slot.backend.host]}
+                    if workflow.progress_node else set())
+        sampler_done = {}
+
+        def sampler_progress(data):
+            # Every member's copy of the sampler reports its own steps
+            if data.get('node') in samplers and data.get('max'):
+                sampler_done[data['node']] = data['value'] / data['max']
+                job.set_progress(0.6 + 0.35 * sum(sampler_done.values()) / len(samplers),
+                                 step=data['value'], steps=data['max'])
+
+        slot, images = await wait_on_backend(job, slot, prompt_id, comfy_photos(results), build_prompt,
+                                             max_wait=config.MAX_WAIT_TIME * len(party), on_progress=sampler_progress,
+                                             images=len(party))
+        if not images:
+            raise JobError('Party generation failed or timed out')
+
+        # Hand each member the image saved by its own branch, as numbered in the prompt built for its node
+        branch_of = {}
+        for number, node_map in enumerate(node_maps[slot.backend.host]):
+            branch_of.update({node_id: number for template_id, node_id in node_map.items()
+                              if number == 0 or node_id != template_id})
+        filenames = [None] * len(party)
+        for image in images:
+            number = branch_of.get(image.get('node'))
+            if number is not None and filenames[number] is None:
+                filenames[number] = image['filename']
+        missing = [party[number].name for number, filename in enumerate(filenames) if filename is None]
+        if missing:
+            raise JobError(f"No portrait came back for {', '.join(missing)}")
+        job_manager.add_outputs(job, filenames)
+        return filenames
+
+    normalizes = [Stage(f'normalize_{number}', normalize(path), progress=0.05) for number, path in enumerate(photos)]
+    visions = [Stage(f'vision_{number}', vision(number), deps=[f'normalize_{number}'], progress=0.1)
+               for number in range(len(photos))]
+    results = await run_stages(job, normalizes + visions + [
+        Stage('upload', upload, deps=[stage.name for stage in normalizes], progress=0.1),
+        Stage('description', describe, deps=[stage.name for stage in visions], progress=0.4),
+        Stage('queue', queue, deps=['description', 'upload'], progress=0.55),
+        Stage('generating', generate, deps=['queue'], progress=0.6),
+    ])
+
+    return {
+        'party': [{
+            'character': {
+                'name': character.name,
+                'class': character.character_class,
+                'stats': character.stats,
+                'description': description
+            },
+            'generated_image': filename
+        } for character, description, filename in zip(party, results['description'], results['generating'])],
+        'seed': seed,
+        'timings': dict(job.timings)
+    }
+
+def sse_message(seq, event, data):
+    return f"id: {seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events stream of a job: stage, token, progress, then done or failed."""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    last_seq = request.headers.get('Last-Event-ID', 0, type=int)
+    if job.past_end(last_seq):
+        # EventSource reconnects after the final event unless closed; 204 tells it to stop
+        return '', 204
+
+    def stream():
+        # An open stream keeps the job from being cancelled as abandoned
+        job.add_watcher()
+        try:
+            seq = last_seq
+            while True:
+                events = job.events_after(seq, config.SSE_KEEPALIVE_INTERVAL)
+                if not events:
+                    if job.past_end(seq):
+                        return
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ': keep-alive\n\n'
+                    continue
+                for seq, event, data in events:
+                    yield sse_message(seq, event, data)
+                    if event in TERMINAL_EVENTS:
+                        return
+        finally:
+            job.remove_watcher()
+
+    return app.response_class(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stats')
+def stats():
+    """Cache and scheduler counters for quick inspection."""
+    return jsonify({
+        'vision_cache': vision_cache.stats(),
+        'result_cache': result_cache.stats(),
+        'ollama': client.stats(),
+        'comfyui': {backend.host: backend.client.stats() for backend in comfy_pool.backends},
+        'comfyui_backends': comfy_pool.stats(),
+        'prompt_scheduler': prompt_scheduler.stats(),
+        'admission': admission.stats(),
+        'retention': retention.stats()
+    })
+
+def collect_app_metrics():
+    """Cache and Ollama counters, read at scrape time"""
+    vision = vision_cache.stats()
+    results = result_cache.stats()
+    ollama = client.stats()
+    return [
+        ('adventure_cache_lookups_total', 'counter', 'Cache lookups by cache and outcome', [
+            ({'cache': 'vision', 'result': 'hit'}, vision['hits']),
+            ({'cache': 'vision', 'result': 'phash_hit'}, vision['phash_hits']),
+            ({'cache': 'vision', 'result': 'miss'}, vision['misses']),
+            ({'cache': 'result', 'result': 'hit'}, results['hits']),
+            ({'cache': 'result', 'result': 'miss'}, results['misses']),
+        ]),
+        ('adventure_cache_evictions_total', 'counter', 'Entries evicted from a cache', [
+            ({'cache': 'vision'}, vision['evictions']),
+            ({'cache': 'result'}, results['evictions']),
+        ]),
+        ('adventure_cache_entries', 'gauge', 'Entries held by a cache', [
+            ({'cache': 'vision'}, vision['entries']),
+            ({'cache': 'result'}, results['entries']),
+        ]),
+        ('adventure_ollama_calls_total', 'counter', 'Completed Ollama chat calls', [({}, ollama['calls'])]),
+        ('adventure_ollama_abandoned_total', 'counter', 'Ollama replies cut off because their job was cancelled',
+         [({}, ollama['abandoned'])]),
+        ('adventure_ollama_model_swaps_total', 'counter', 'Times the scheduler switched Ollama models',
+         [({}, ollama['swaps'])]),
+        ('adventure_ollama_load_seconds_total', 'counter', 'Time Ollama spent loading models',
+         [({}, ollama['load_seconds'])]),
+        ('adventure_ollama_queue_wait_seconds_total', 'counter', 'Time calls waited for their model\'s turn',
+         [({}, ollama['queue_wait_seconds'])]),
+        ('adventure_ollama_pending', 'gauge', 'Ollama calls waiting, per model',
+         [({'model': model}, count) for model, count in ollama['pending'].items()]),
+    ]
+
+metrics.register_collector(collect_app_metrics)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Stage latencies, job, cache, Ollama and ComfyUI metrics in the Prometheus text format."""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/workflows')
+def list_workflows():
+    """Workflows selectable with the 'workflow' form field of /generate."""
+    return jsonify({'default': workflow_registry.default, 'workflows': workflow_registry.list()})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report stage, progress and result of a background generation job."""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    job.touch()
+    return jsonify(dict(job.to_dict(), queue=admission.position(job)))
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a job: its Ollama calls are dropped or cut off and its ComfyUI prompt dequeued or interrupted."""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    if not job_manager.cancel(job, 'Cancelled by the client'):
+        return jsonify({'error': f'Job already {job.status}'}), 409
+    return jsonify({'success': True, 'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+
+def create_comfyui_prompt(description, image_name, workflow=None, filename_prefix=None, seed=None):
+    """Create ComfyUI prompt from a registered workflow (config.DEFAULT_WORKFLOW by default)"""
+    if not isinstance(workflow, Workflow):
+        workflow = workflow_registry.get(workflow)
+    if seed is None:
+        seed = random.randint(1, 1000000)
+    values = {'positive': description, 'image': image_name, 'seed': seed}
+    if filename_prefix and 'filename_prefix' in workflow.patch_points:
+        values['filename_prefix'] = filename_prefix
+    return workflow.build(**values)
+
+async def fetch_output_image(image, comfyui_host=None):
+    """Copy a finished output from a ComfyUI node into COMFY_OUTPUT_DIR; returns True on success"""
     try:
-        params = {'filename': filename}
-        if subfolder is not None:
-            params['subfolder'] = subfolder
-        if image_type is not None:
-            params['type'] = image_type
-        response = requests.get(f"http://{comfyui_host}/view", params=params)
-        if response.status_code == 200:
-            return response.content
-        return None
+        data = await get_comfy_client(comfyui_host).view_async(image['filename'], image.get('subfolder'),
+                                                               image.get('type', 'output'))
     except Exception as e:
-        print(f"Error downloading image: {e}")
-        return None
+        log.error("Error downloading image: %s", e)
+        return False
+    await run_blocking(save_output_image, image['filename'], data)
+    return True
+
+def save_output_image(filename, data):
+    os.makedirs(COMFY_OUTPUT_DIR, exist_ok=True)
+    path = os.path.join(COMFY_OUTPUT_DIR, os.path.basename(filename))
+    tmp_path = os.path.join(COMFY_OUTPUT_DIR, f".{os.path.basename(filename)}.download")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    # Rename so the watcher only ever sees the complete file
+    os.replace(tmp_path, path)
 
-def wait_for_generation(max_wait=None):
-    """Wait for ComfyUI to generate an image by polling the local output dir and return the filename."""
+async def wait_for_outputs(prompt_id, max_wait=None, on_progress=None, comfyui_host=None):
+    """Wait for ComfyUI to finish prompt_id and return all its output images once they are in COMFY_OUTPUT_DIR.
+
+    Each image is ComfyUI's {'filename', 'subfolder', 'type'} dict plus the
+    'node' that saved it; None means the prompt failed or timed out.
+    """
     if not max_wait:
         max_wait = config.MAX_WAIT_TIME
 
-    output_dir = COMFY_OUTPUT_DIR
-    if not os.path.exists(output_dir):
-        print(f"[DEBUG] Output dir not found locally: {output_dir}")
+    backend = comfy_pool.get(comfyui_host)
+    started = time.monotonic()
+    # PromptLost propagates once the node has been down for COMFY_LOST_AFTER seconds
+    result = await backend.tracker.wait_async(prompt_id, max_wait, on_progress=on_progress, lost=backend.lost)
+    STAGE_SECONDS.observe(time.monotonic() - started, stage='sampling')
+    if result is None:
+        log.warning("Generation timeout - prompt %s not finished after %s seconds", prompt_id, max_wait)
+        return None
+    if result.status != 'success' or not result.images:
+        log.warning("Generation failed for prompt %s: %s", prompt_id, result.error or 'no output images')
         return None
 
-    files_before = get_files_in_directory(output_dir)
-    print(f"[DEBUG] Watching ComfyUI output dir: {output_dir}; baseline files: {len(files_before)}")
+    log.debug("Prompt %s produced: %s", prompt_id, [image['filename'] for image in result.images])
+    started = time.monotonic()
+    # Nodes that do not write into our output folder have their results fetched over /view
+    local = backend.host in config.COMFY_LOCAL_OUTPUT_HOSTS
+    for image in result.images:
+        filename = image['filename']
+        if local and await output_watcher.wait_for_file_async(filename, config.OUTPUT_FILE_GRACE):
+            continue
+        if not await fetch_output_image(image, backend.host):
+            log.warning("%s not visible in %s and could not be fetched from %s", filename, COMFY_OUTPUT_DIR, backend.host)
+    STAGE_SECONDS.observe(time.monotonic() - started, stage='file_detection')
+    return result.images
 
-    waited = 0
-    while waited < max_wait:
-        time.sleep(2)
-        waited += 2
+@app.route('/gallery')
+def gallery():
+    """Page through generated images, newest first.
 
-        files_after = get_files_in_directory(output_dir)
-        new_files = [p for p in files_after.keys() if p not in files_before]
-        if new_files:
-            latest_file = max(new_files, key=lambda x: files_after[x])
-            print(f"[DEBUG] FS watcher found new generated file: {latest_file}")
-            return os.path.basename(latest_file)
+    ?limit=&cursor= walks the gallery one page at a time; ?since=<version>
+    returns only what was added or removed after a previous response.
+    """
+    limit = max(1, min(request.args.get('limit', config.GALLERY_PAGE_SIZE, type=int), config.GALLERY_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+    since = request.args.get('since', type=int)
 
-        if waited % 10 == 0:  # Print status every 10 seconds
-            print(f"Still waiting for generation... ({waited}/{max_wait} seconds)")
+    # The index version changes on every add/remove, so it validates any listing
+    etag = f"g{gallery_index.version}-{zlib.crc32(request.query_string):08x}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    elif since is not None:
+        added, removed, version, more = gallery_index.changes(since, limit)
+        response = jsonify({'images': added, 'removed': removed, 'version': version, 'more': more})
+    else:
+        version = gallery_index.version
+        images, next_cursor = gallery_index.page(limit, cursor)
+        response = jsonify({'images': images, 'next_cursor': next_cursor, 'version': version})
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
-    print("Generation timeout - no new images found")
-    return None
+def resolve_output_file(filename):
+    """Map a requested filename to a finished image in the output dir, or 404"""
+    if os.sep in filename or (os.altsep and os.altsep in filename) or filename.startswith('.'):
+        abort(404)
+    if not filename.lower().endswith(IMAGE_EXTENSIONS):
+        abort(404)
+    path = safe_join(COMFY_OUTPUT_DIR, filename)
+    if not path or not os.path.isfile(path):
+        abort(404)
+    return path
 
-@app.route('/gallery')
-def gallery():
-    """Get list of generated images directly from ComfyUI output directory."""
-    images = []
-    if os.path.exists(COMFY_OUTPUT_DIR):
-        for filename in os.listdir(COMFY_OUTPUT_DIR):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                images.append(filename)
-        images.sort(key=lambda x: os.path.getctime(os.path.join(COMFY_OUTPUT_DIR, x)), reverse=True)
-    return jsonify({'images': images})
+def send_immutable_file(path, etag, mimetype=None, as_attachment=False, download_name=None):
+    """send_file for files that never change once written.
+
+    Strong content-hash ETags give 304s on revalidation, conditional=True adds
+    byte-range support, and Werkzeug hands the open file to the server's
+    wsgi.file_wrapper (sendfile) or to X-Sendfile when USE_X_SENDFILE is on.
+    """
+    response = send_file(path, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name,
+                         conditional=True, etag=etag, max_age=config.IMAGE_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/generated/<filename>')
 def serve_generated_image(filename):
-    """Serve generated images from ComfyUI output directory."""
-    return send_file(os.path.join(COMFY_OUTPUT_DIR, filename))
+    """Serve generated images from ComfyUI output directory.
+
+    ?w=<width> and/or ?fmt=webp|jpeg|png serve a cached derived variant instead;
+    widths above the original are nearest-neighbour pixel-art upscales.
+    """
+    path = resolve_output_file(filename)
+    output_retention.touch(filename)
+    if 'w' not in request.args and 'fmt' not in request.args:
+        return send_immutable_file(path, file_sha256(path))
+
+    width = request.args.get('w', type=int)
+    fmt = request.args.get('fmt', 'png').lower().replace('jpg', 'jpeg')
+    if ('w' in request.args and width not in config.VARIANT_WIDTHS) or fmt not in VARIANT_FORMATS:
+        return jsonify({'error': f"Unsupported variant; w must be one of {list(config.VARIANT_WIDTHS)} "
+                                 f"and fmt one of {list(VARIANT_FORMATS)}"}), 400
+    try:
+        variant_path, mimetype = variant_cache.get(path, width, fmt)
+    except UndecodableImage as e:
+        log.warning("Cannot render a variant of %s: %s", filename, e)
+        return jsonify({'error': 'Image cannot be decoded'}), 422
+    # Variant files are named by their content-addressed cache key
+    etag = os.path.splitext(os.path.basename(variant_path))[0]
+    return send_immutable_file(variant_path, etag, mimetype=mimetype)
 
 @app.route('/download/<filename>')
 def download_image(filename):
     """Download generated image from ComfyUI output directory."""
-    return send_file(os.path.join(COMFY_OUTPUT_DIR, filename), as_attachment=True)
+    path = resolve_output_file(filename)
+    output_retention.touch(filename)
+    return send_immutable_file(path, file_sha256(path), as_attachment=True, download_name=filename)
+
+@app.route('/generated/<filename>/pin', methods=['PUT', 'DELETE'])
+def pin_image(filename):
+    """Pin a portrait so retention never removes it (PUT), or let it age out again (DELETE)"""
+    if request.method == 'PUT':
+        resolve_output_file(filename)
+        gallery_index.pin(filename)
+    else:
+        gallery_index.unpin(filename)
+    return jsonify({'success': True, 'filename': filename, 'pinned': gallery_index.is_pinned(filename)})
+
+# Track ComfyUI prompt completion by prompt_id and poll backend health
+comfy_pool.start()
+admission.start()
+retention.start()
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
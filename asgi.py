@@ -0,0 +1,99 @@
+# ASGI entry point for production serving: uvicorn asgi:application (see start.sh)
+
+import asyncio
+import re
+import uuid
+
+from a2wsgi import WSGIMiddleware
+
+import config
+import logs
+from app import app, job_manager, sse_message
+from jobs import TERMINAL_EVENTS
+
+# Everything except event streams is short and goes to Flask on a thread pool
+flask_app = WSGIMiddleware(app, workers=config.SERVER_THREADS)
+
+EVENTS_PATH = re.compile(r'/jobs/(?P<job_id>[^/]+)/events')
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    match = EVENTS_PATH.fullmatch(scope['path']) if scope['type'] == 'http' else None
+    if match and scope['method'] == 'GET':
+        return await job_events(scope, receive, send, match['job_id'])
+    return await flask_app(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    # The job loop and ComfyUI watchers start when app is imported
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def job_events(scope, receive, send, job_id):
+    """app.job_events served on the event loop, so an open stream holds no thread"""
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    request_id = headers.get('x-request-id') or uuid.uuid4().hex[:16]
+    logs.request_id.set(request_id)
+    response_headers = [(b'x-request-id', request_id.encode('latin-1'))]
+
+    job = job_manager.get(job_id)
+    if not job:
+        await send({'type': 'http.response.start', 'status': 404,
+                    'headers': response_headers + [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': b'{"error": "Unknown job"}\n'})
+        return
+    try:
+        seq = int(headers.get('last-event-id', 0))
+    except ValueError:
+        seq = 0
+    if job.past_end(seq):
+        # EventSource reconnects after the final event unless closed; 204 tells it to stop
+        await send({'type': 'http.response.start', 'status': 204, 'headers': response_headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers + [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]})
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    # An open stream keeps the job from being cancelled as abandoned
+    job.add_watcher()
+    try:
+        while True:
+            events = asyncio.ensure_future(job.events_after_async(seq, config.SSE_KEEPALIVE_INTERVAL))
+            await asyncio.wait((events, disconnected), return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                events.cancel()
+                return
+            chunk = ''
+            finished = not events.result() and job.past_end(seq)
+            for seq, event, data in events.result():
+                chunk += sse_message(seq, event, data)
+                if event in TERMINAL_EVENTS:
+                    finished = True
+                    break
+            # Comment line keeps proxies from closing an idle stream
+            if not chunk and not finished:
+                chunk = ': keep-alive\n\n'
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'),
+                        'more_body': not finished})
+            if finished:
+                return
+    finally:
+        disconnected.cancel()
+        job.remove_watcher()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
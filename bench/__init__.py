@@ -0,0 +1 @@
+# Offline load-testing harness: stub Ollama and ComfyUI servers plus a load driver (python -m bench.run)
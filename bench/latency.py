@@ -0,0 +1,54 @@
+# Latency distributions for the stub servers, parsed from command-line specs
+
+import random
+import time
+
+
+class Latency:
+    """Delay in seconds drawn from a distribution written as a spec string.
+
+        0.5               always 0.5s
+        uniform:0.2:1.5   evenly spread between 0.2s and 1.5s
+        normal:2:0.5      mean 2s, standard deviation 0.5s
+        lognormal:2:0.4   median 2s with a long right tail (sigma of the underlying normal)
+        exp:1             exponential with mean 1s
+
+    Samples are clipped at zero, so a spec can be passed as an argparse type.
+    """
+
+    def __init__(self, spec):
+        self.spec = str(spec)
+        kind, _, args = self.spec.partition(':')
+        try:
+            params = [float(arg) for arg in args.split(':')] if args else []
+            if not params:
+                value = float(kind)
+                self._draw = lambda: value
+            elif kind == 'uniform' and len(params) == 2:
+                self._draw = lambda: random.uniform(*params)
+            elif kind == 'normal' and len(params) == 2:
+                self._draw = lambda: random.gauss(*params)
+            elif kind == 'lognormal' and len(params) == 2 and params[0] > 0:
+                median, sigma = params
+                self._draw = lambda: median * random.lognormvariate(0, sigma)
+            elif kind == 'exp' and len(params) == 1 and params[0] > 0:
+                self._draw = lambda: random.expovariate(1 / params[0])
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"Unsupported latency spec {spec!r}")
+
+    def sample(self):
+        return max(0.0, self._draw())
+
+    def sleep(self):
+        seconds = self.sample()
+        time.sleep(seconds)
+        return seconds
+
+    def __reduce__(self):
+        # Rebuilt from the spec, so settings can be handed to the stub process
+        return Latency, (self.spec,)
+
+    def __repr__(self):
+        return f"Latency({self.spec!r})"
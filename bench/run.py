@@ -0,0 +1,535 @@
+# Load-test driver: starts stub Ollama/ComfyUI servers and the app, drives /generate and /gallery,
+# and reports throughput, latency percentiles and error rates per stage
+
+import argparse
+import ast
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+from PIL import Image
+
+from bench.latency import Latency
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GALLERY_RELOAD_EVERY = 10  # gallery clients re-read the first page after this many ?since= polls
+PERCENTILES = (50, 95, 99)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def int_list(value):
+    return [int(part) for part in value.split(',') if part.strip()]
+
+
+def size(value):
+    width, _, height = value.lower().partition('x')
+    return int(width), int(height)
+
+
+def setting(value):
+    """KEY=VALUE for a config override; VALUE is a Python literal, or a plain string"""
+    key, sep, raw = value.partition('=')
+    if not sep or not key.isupper():
+        raise ValueError(value)
+    try:
+        return key, ast.literal_eval(raw)
+    except (ValueError, SyntaxError):
+        return key, raw
+
+
+def output_subfolder(workflow_path):
+    """Subfolder of ComfyUI's output dir the workflow's SaveImage node writes into"""
+    with open(workflow_path) as f:
+        prompt = json.load(f)['prompt']
+    for node in prompt.values():
+        if node.get('class_type', '').startswith('SaveImage'):
+            inputs = node['inputs']
+            return os.path.join(inputs.get('subdirectory_name') or '', os.path.dirname(inputs.get('filename_prefix', ''))).rstrip('/')
+    return ''
+
+
+# Processes
+
+def serve_stubs(options, ollama_port, comfy_ports, output_dir):
+    """Run the Ollama stub and one ComfyUI stub per port until killed"""
+    from bench.stub_comfyui import ComfyStub
+    from bench.stub_ollama import OllamaStub
+    OllamaStub(options['ollama_chat'], options['ollama_vision'], options['ollama_load'],
+               parallel=options['ollama_parallel'], error_rate=options['ollama_errors']).serve(port=ollama_port)
+    for port in comfy_ports:
+        ComfyStub(output_dir, options['comfy_sample'], options['comfy_upload'], workers=options['comfy_workers'],
+                  error_rate=options['comfy_errors']).serve(port=port)
+    threading.Event().wait()
+
+
+def serve_app(port, overrides, server='uvicorn'):
+    """Import the app with config overridden and serve it the way start.sh does (or on threaded Werkzeug)"""
+    sys.path.insert(0, REPO_DIR)
+    import config
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    if server == 'werkzeug':
+        import app
+        from werkzeug.serving import make_server
+        # Per-request access lines would cost the server more than the requests being measured
+        logging.getLogger('werkzeug').setLevel(config.LOG_LEVEL)
+        make_server('127.0.0.1', port, app.app, threaded=True).serve_forever()
+        return
+    import asgi
+    import uvicorn
+    uvicorn.run(asgi.application, host='127.0.0.1', port=port, workers=1, timeout_keep_alive=30,
+                timeout_graceful_shutdown=10, access_log=False, log_level=config.LOG_LEVEL.lower())
+
+
+def wait_until_up(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=2).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"{url} did not come up within {timeout}s")
+
+
+def prefill_gallery(directory, count):
+    """Existing outputs, so /gallery has pages to list from the start"""
+    os.makedirs(directory, exist_ok=True)
+    for n in range(count):
+        image = Image.frombytes('RGB', (8, 8), os.urandom(8 * 8 * 3)).resize((128, 128), Image.NEAREST)
+        image.save(os.path.join(directory, f"Prefill_{n:05}_.png"), 'PNG')
+
+
+def make_photo(dimensions):
+    """A distinct JPEG "photo", so vision and result caches miss as they would for new visitors"""
+    grid = Image.frombytes('RGB', (8, 6), os.urandom(8 * 6 * 3))
+    buffer = io.BytesIO()
+    grid.resize(dimensions, Image.BILINEAR).save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+# Load generation
+
+class Samples:
+    """Latencies and outcomes per phase, shared by the client threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}  # phase -> {'seconds': [successful latencies], 'errors': n}
+        self.counters = {}
+
+    def add(self, phase, seconds=None, ok=True):
+        with self._lock:
+            entry = self._phases.setdefault(phase, {'seconds': [], 'errors': 0})
+            if ok:
+                entry['seconds'].append(seconds)
+            else:
+                entry['errors'] += 1
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            phases = {}
+            for phase, entry in sorted(self._phases.items()):
+                seconds = sorted(entry['seconds'])
+                total = len(seconds) + entry['errors']
+                phases[phase] = dict({
+                    'count': total,
+                    'errors': entry['errors'],
+                    'error_rate': entry['errors'] / total if total else 0.0,
+                    'mean': sum(seconds) / len(seconds) if seconds else None,
+                }, **{f"p{p}": percentile(seconds, p) for p in PERCENTILES})
+            return phases
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    return ordered[max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+class Client:
+    """One simulated visitor with its own keep-alive connection"""
+
+    def __init__(self, base_url, options, samples):
+        self.base_url = base_url.rstrip('/')
+        self.options = options
+        self.samples = samples
+        self.session = requests.Session()
+
+    def url(self, path):
+        return path if path.startswith('http') else self.base_url + path
+
+    def timed(self, phase, method, path, ok_status=(200,), **kwargs):
+        """Send one request and record it under phase; returns the response, or None on a transport error"""
+        kwargs.setdefault('timeout', 30)
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, self.url(path), **kwargs)
+        except requests.RequestException:
+            self.samples.add(phase, ok=False)
+            return None
+        self.samples.add(phase, time.monotonic() - started, ok=response.status_code in ok_status)
+        return response
+
+    def generate(self, photo):
+        """Submit one /generate, follow the job to the end and fetch its image"""
+        form = {'generation_type': 'random'}
+        if self.options.workflow:
+            form['workflow'] = self.options.workflow
+        started = time.monotonic()
+        response = self.timed('submit', 'POST', '/generate', ok_status=(202,), data=form,
+                              files={'photo': ('photo.jpg', photo, 'image/jpeg')})
+        if response is None or response.status_code != 202:
+            self.refused(response, 'end_to_end')
+            return
+        submitted = response.json()
+        job = self.follow(submitted)
+        if job is None:
+            self.samples.add('end_to_end', ok=False)
+            self.samples.add('stage:timeout', ok=False)
+            return
+        completed = job['status'] == 'completed'
+        self.samples.add('end_to_end', time.monotonic() - started, ok=completed)
+        # A failed job is charged to the stage it had reached
+        failed_stage = None if completed else job.get('stage')
+        for stage, seconds in job.get('timings', {}).items():
+            self.samples.add(f"stage:{stage}", seconds, ok=stage != failed_stage)
+        if failed_stage and failed_stage not in job.get('timings', {}):
+            self.samples.add(f"stage:{failed_stage}", ok=False)
+        if completed:
+            if job['result'].get('cached'):
+                self.samples.count('cached')
+            if not self.options.no_image_fetch:
+                self.timed('image', 'GET', f"/generated/{job['result']['generated_image']}")
+
+    def party(self, photo):
+        """Submit one /party of --party-size members (a batch job) and follow it to the end"""
+        started = time.monotonic()
+        response = self.timed('party_submit', 'POST', '/party', ok_status=(202,), data={'size': self.options.party_size},
+                              files={'photo': ('photo.jpg', photo, 'image/jpeg')})
+        if response is None or response.status_code != 202:
+            self.refused(response, 'party_end_to_end')
+            return
+        job = self.follow(response.json())
+        completed = job is not None and job['status'] == 'completed'
+        self.samples.add('party_end_to_end', time.monotonic() - started if completed else None, ok=completed)
+
+    def refused(self, response, phase):
+        """Count a submission the app did not accept, and back off as asked when it sheds load"""
+        if response is not None and response.status_code in (429, 503):
+            self.samples.count('rejected')
+        else:
+            self.samples.add(phase, ok=False)
+        retry_after = response is not None and response.headers.get('Retry-After')
+        time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else 0.5)
+
+    def follow(self, submitted):
+        """The finished job's status dict, or None if it did not finish within --job-timeout"""
+        deadline = time.monotonic() + self.options.job_timeout
+        if self.options.wait == 'events':
+            try:
+                with self.session.get(self.url(submitted['events_url']), stream=True,
+                                      timeout=(5, self.options.job_timeout)) as response:
+                    event = None
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line.startswith('event:'):
+                            event = line[6:].strip()
+                        if event in ('done', 'failed', 'cancelled') or time.monotonic() > deadline:
+                            break
+            except requests.RequestException:
+                pass
+        while time.monotonic() < deadline:
+            try:
+                job = self.session.get(self.url(submitted['status_url']), timeout=10).json()
+            except (requests.RequestException, ValueError):
+                job = {}
+            if job.get('status') in ('completed', 'failed', 'cancelled'):
+                return job
+            time.sleep(self.options.poll_interval)
+        return None
+
+    def browse_gallery(self, deadline):
+        """Load the gallery, then poll ?since= like the page does"""
+        version = None
+        polls = 0
+        while time.monotonic() < deadline:
+            if version is None or polls >= GALLERY_RELOAD_EVERY:
+                response = self.timed('gallery', 'GET', '/gallery')
+                polls = 0
+            else:
+                response = self.timed('gallery_since', 'GET', f"/gallery?since={version}")
+                polls += 1
+            if response is not None and response.status_code == 200:
+                version = response.json()['version']
+            time.sleep(self.options.gallery_think)
+
+
+def run_level(base_url, concurrency, options, photos):
+    samples = Samples()
+    started = time.monotonic()
+    deadline = started + options.duration
+
+    def generate_loop():
+        client = Client(base_url, options, samples)
+        while time.monotonic() < deadline:
+            client.generate(random.choice(photos) if photos else make_photo(options.photo_size))
+
+    def gallery_loop():
+        Client(base_url, options, samples).browse_gallery(deadline)
+
+    def party_loop():
+        client = Client(base_url, options, samples)
+        while time.monotonic() < deadline:
+            client.party(random.choice(photos) if photos else make_photo(options.photo_size))
+
+    threads = [threading.Thread(target=generate_loop, daemon=True) for _ in range(concurrency)]
+    threads += [threading.Thread(target=gallery_loop, daemon=True) for _ in range(options.gallery_concurrency)]
+    threads += [threading.Thread(target=party_loop, daemon=True) for _ in range(options.party_concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    phases = samples.summary()
+    end_to_end = phases.get('end_to_end', {'count': 0, 'errors': 0})
+    gallery_requests = sum(phases.get(phase, {}).get('count', 0) for phase in ('gallery', 'gallery_since'))
+    completed = end_to_end['count'] - end_to_end['errors']
+    return {
+        'concurrency': concurrency,
+        'gallery_concurrency': options.gallery_concurrency,
+        'party_concurrency': options.party_concurrency,
+        'elapsed': elapsed,
+        'completed': completed,
+        'failed': end_to_end['errors'],
+        'cached': samples.counters.get('cached', 0),
+        'rejected': samples.counters.get('rejected', 0),
+        'throughput': completed / elapsed,
+        'gallery_throughput': gallery_requests / elapsed,
+        'phases': phases,
+    }
+
+
+# Reporting
+
+def format_seconds(value):
+    if value is None:
+        return '-'
+    return f"{value * 1000:.0f}ms" if value < 10 else f"{value:.1f}s"
+
+
+def format_change(old, new):
+    if not old or new is None:
+        return '-'
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def print_level(level, baseline=None):
+    parties = f", {level['party_concurrency']} party clients" if level.get('party_concurrency') else ''
+    print(f"\n== concurrency {level['concurrency']} (+{level['gallery_concurrency']} gallery clients{parties}), "
+          f"{level['elapsed']:.1f}s ==")
+    line = (f"completed {level['completed']} jobs ({level['throughput']:.2f}/s), failed {level['failed']}, "
+            f"cached {level['cached']}, rejected {level.get('rejected', 0)}; gallery {level['gallery_throughput']:.1f} req/s")
+    if baseline:
+        line += (f"  [baseline {baseline['throughput']:.2f}/s {format_change(baseline['throughput'], level['throughput'])}, "
+                 f"gallery {format_change(baseline['gallery_throughput'], level['gallery_throughput'])}]")
+    print(line)
+    print(f"{'phase':<24}{'n':>6}{'err%':>7}" + ''.join(f"{'p' + str(p):>9}" for p in PERCENTILES)
+          + ('   vs baseline p50 / p95' if baseline else ''))
+    for phase, stats in level['phases'].items():
+        row = (f"{phase:<24}{stats['count']:>6}{stats['error_rate'] * 100:>6.1f}%"
+               + ''.join(f"{format_seconds(stats[f'p{p}']):>9}" for p in PERCENTILES))
+        old = (baseline or {}).get('phases', {}).get(phase)
+        if old:
+            row += f"   {format_change(old['p50'], stats['p50']):>6} / {format_change(old['p95'], stats['p95'])}"
+        print(row)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# Entry point
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m bench.run',
+        description='Load-test the app against local stub Ollama and ComfyUI servers. '
+                    'Latencies are distribution specs: 0.5, uniform:0.2:1.5, normal:2:0.5, lognormal:2:0.4, exp:1.')
+    load = parser.add_argument_group('load')
+    load.add_argument('--concurrency', type=int_list, default=[1, 4, 8],
+                      help='comma-separated /generate client counts, one run each (default 1,4,8)')
+    load.add_argument('--duration', type=float, default=30, help='seconds of load per concurrency level')
+    load.add_argument('--warmup', type=int, default=1, help='unrecorded generations before the first level')
+    load.add_argument('--gallery-concurrency', type=int, default=2, help='clients browsing /gallery meanwhile')
+    load.add_argument('--gallery-think', type=float, default=0.5, help='seconds between a gallery client\'s polls')
+    load.add_argument('--gallery-prefill', type=int, default=200, help='images in the output dir before starting')
+    load.add_argument('--party-concurrency', type=int, default=0,
+                      help='clients submitting /party batch jobs meanwhile, to see how they affect /generate')
+    load.add_argument('--party-size', type=int, default=4, help='members per /party job')
+    load.add_argument('--photos', type=int, default=0,
+                      help='size of a pool of photos to reuse (cache hits); 0 sends a new photo every time')
+    load.add_argument('--photo-size', type=size, default=(1280, 960), help='WIDTHxHEIGHT of uploaded photos')
+    load.add_argument('--workflow', help='workflow form field for /generate')
+    load.add_argument('--wait', choices=('events', 'poll'), default='events',
+                      help='follow jobs over /jobs/<id>/events like the page, or by polling /jobs/<id>')
+    load.add_argument('--poll-interval', type=float, default=0.5)
+    load.add_argument('--job-timeout', type=float, default=300)
+    load.add_argument('--no-image-fetch', action='store_true', help='skip GET /generated/<image> after each job')
+
+    stubs = parser.add_argument_group('stub servers')
+    stubs.add_argument('--ollama-chat', type=Latency, default=Latency('lognormal:0.8:0.3'))
+    stubs.add_argument('--ollama-vision', type=Latency, default=Latency('lognormal:0.5:0.3'))
+    stubs.add_argument('--ollama-load', type=Latency, default=Latency('0.3'), help='model swap cost')
+    stubs.add_argument('--ollama-parallel', type=int, default=1)
+    stubs.add_argument('--ollama-errors', type=float, default=0.0, help='fraction of chat calls answered with 500')
+    stubs.add_argument('--comfy-sample', type=Latency, default=Latency('lognormal:2:0.2'))
+    stubs.add_argument('--comfy-upload', type=Latency, default=Latency('0.02'))
+    stubs.add_argument('--comfy-workers', type=int, default=1, help='prompts each ComfyUI stub runs at once')
+    stubs.add_argument('--comfy-backends', type=int, default=1, help='ComfyUI stubs (COMFYUI_HOSTS)')
+    stubs.add_argument('--comfy-errors', type=float, default=0.0, help='fraction of prompts ending in execution_error')
+    stubs.add_argument('--ollama-port', type=int, default=0, help='fixed port for the Ollama stub')
+    stubs.add_argument('--comfy-port', type=int, default=0, help='fixed port of the first ComfyUI stub')
+
+    app = parser.add_argument_group('app')
+    app.add_argument('--app-url', help='benchmark an app that is already running (pointed at fixed stub ports)')
+    app.add_argument('--comfy-output', help='ComfyUI output root for the stubs (default: a temp dir)')
+    app.add_argument('--set', dest='overrides', type=setting, action='append', default=[], metavar='KEY=VALUE',
+                     help='override a config.py setting in the app, e.g. --set JOB_WORKERS=8')
+    app.add_argument('--app-log-level', default='WARNING')
+    app.add_argument('--server', choices=('uvicorn', 'werkzeug'), default='uvicorn',
+                     help='serve the app through asgi.py under uvicorn, as start.sh does, or on threaded Werkzeug')
+
+    output = parser.add_argument_group('output')
+    output.add_argument('--output', help='write results as JSON, to use as a --baseline later')
+    output.add_argument('--baseline', help='JSON from an earlier --output to compare against')
+    output.add_argument('--stubs-only', action='store_true', help='only run the stub servers, until Ctrl+C')
+    output.add_argument('--keep', action='store_true', help='keep the temp dir with outputs and app state')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='adventure-bench-')
+    comfy_root = os.path.abspath(options.comfy_output or os.path.join(workdir, 'comfy_output'))
+    workflow_dir = os.path.join(REPO_DIR, 'workflows')
+    sys.path.insert(0, REPO_DIR)
+    import config
+    workflow_name = options.workflow or config.DEFAULT_WORKFLOW
+    output_dir = os.path.join(comfy_root, output_subfolder(os.path.join(workflow_dir, f"{workflow_name}.json")))
+    prefill_gallery(output_dir, options.gallery_prefill)
+
+    ollama_port = options.ollama_port or free_port()
+    comfy_ports = [options.comfy_port + n if options.comfy_port else free_port() for n in range(options.comfy_backends)]
+    comfy_hosts = [f"127.0.0.1:{port}" for port in comfy_ports]
+    stub_options = {key: value for key, value in vars(options).items() if key.startswith(('ollama_', 'comfy_'))}
+
+    if options.stubs_only:
+        print(f"Ollama stub:   OLLAMA_HOST = '127.0.0.1:{ollama_port}'")
+        print(f"ComfyUI stubs: COMFYUI_HOSTS = COMFY_LOCAL_OUTPUT_HOSTS = {comfy_hosts}")
+        print(f"Output dir:    COMFY_OUTPUT_DIR = '{output_dir}'")
+        try:
+            serve_stubs(stub_options, ollama_port, comfy_ports, comfy_root)
+        except KeyboardInterrupt:
+            return
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=serve_stubs, args=(stub_options, ollama_port, comfy_ports, comfy_root),
+                                 daemon=True)]
+    base_url = options.app_url
+    if not base_url:
+        data_dir = os.path.join(workdir, 'data')
+        overrides = {
+            'OLLAMA_HOST': f"127.0.0.1:{ollama_port}",
+            'COMFYUI_HOST': comfy_hosts[0],
+            'COMFYUI_HOSTS': comfy_hosts,
+            'COMFY_LOCAL_OUTPUT_HOSTS': comfy_hosts,
+            'COMFY_OUTPUT_DIR': output_dir,
+            'GENERATED_FOLDER': comfy_root,
+            'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+            'WORKFLOW_DIR': workflow_dir,
+            'DATA_FOLDER': data_dir,
+            'GALLERY_INDEX_PATH': os.path.join(data_dir, 'gallery.sqlite3'),
+            'PHOTO_CACHE_DIR': os.path.join(data_dir, 'photos'),
+            'VISION_CACHE_PATH': os.path.join(data_dir, 'vision_cache.sqlite3'),
+            'RESULT_CACHE_PATH': os.path.join(data_dir, 'results.sqlite3'),
+            'VARIANT_CACHE_DIR': os.path.join(data_dir, 'variants'),
+            'LOG_LEVEL': options.app_log_level,
+            # Every simulated user connects from 127.0.0.1
+            'MAX_JOBS_PER_CLIENT': 0,
+        }
+        overrides.update(options.overrides)
+        app_port = free_port()
+        base_url = f"http://127.0.0.1:{app_port}"
+        processes.append(context.Process(target=serve_app, args=(app_port, overrides, options.server), daemon=True))
+
+    try:
+        for process in processes:
+            process.start()
+        wait_until_up(f"http://127.0.0.1:{ollama_port}/api/tags")
+        for host in comfy_hosts:
+            wait_until_up(f"http://{host}/queue")
+        wait_until_up(f"{base_url}/workflows")
+
+        photos = [make_photo(options.photo_size) for _ in range(options.photos)]
+        warmup = Client(base_url, options, Samples())
+        for _ in range(options.warmup):
+            warmup.generate(make_photo(options.photo_size))
+
+        baseline = None
+        if options.baseline:
+            with open(options.baseline) as f:
+                baseline = {level['concurrency']: level for level in json.load(f)['levels']}
+        levels = []
+        for concurrency in options.concurrency:
+            level = run_level(base_url, concurrency, options, photos)
+            levels.append(level)
+            print_level(level, (baseline or {}).get(concurrency))
+
+        if options.output:
+            settings = {key: repr(value) if isinstance(value, Latency) else value
+                        for key, value in vars(options).items() if key not in ('output', 'baseline')}
+            with open(options.output, 'w') as f:
+                json.dump({'created': datetime.now(timezone.utc).isoformat(), 'commit': git_commit(),
+                           'settings': settings, 'levels': levels}, f, indent=2, default=str)
+            print(f"\nResults written to {options.output}")
+    finally:
+        for process in processes:
+            process.terminate()
+        if options.keep:
+            print(f"Kept {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
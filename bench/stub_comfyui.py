@@ -0,0 +1,351 @@
+# Stand-in for a ComfyUI server: uploads, prompt queue, /history, /view and /ws execution events
+
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from email.parser import BytesParser
+from email.policy import HTTP
+
+from PIL import Image
+
+from bench.latency import Latency
+from bench.stub_http import StubServer, StubHandler
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+HISTORY_ENTRIES = 1000
+
+
+class WebSocket:
+    """Server end of one /ws connection; ComfyUI only ever sends JSON text frames to its clients"""
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def send(self, message):
+        self.send_frame(0x1, json.dumps(message).encode('utf-8'))
+
+    def send_frame(self, opcode, data):
+        if len(data) < 126:
+            header = struct.pack('!BB', 0x80 | opcode, len(data))
+        elif len(data) < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, len(data))
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, len(data))
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self._wfile.write(header + data)
+                self._wfile.flush()
+            except OSError:
+                self.closed = True
+
+
+def read_frame(rfile):
+    """(opcode, payload) of the next client frame, or (None, b'') when the connection is gone"""
+    head = rfile.read(2)
+    if len(head) < 2:
+        return None, b''
+    opcode, length = head[0] & 0x0F, head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', rfile.read(8))[0]
+    mask = rfile.read(4) if head[1] & 0x80 else b'\0\0\0\0'
+    payload = bytes(byte ^ mask[n % 4] for n, byte in enumerate(rfile.read(length)))
+    return opcode, payload
+
+
+class ComfyStub:
+    """Fake ComfyUI that "runs" prompts on `workers` simulated GPUs.
+
+    /prompt validates that every LoadImage input was uploaded, as ComfyUI
+    does, then queues the prompt (ahead of the others with `front`, newest
+    first, as ComfyUI does). A worker takes prompts in order, reports
+    executing/progress events for each node over /ws (one progress event
+    per sampler step, spread over sample_latency per image), writes a real PNG into
+    output_dir for every SaveImage node the way ComfyUI names them, records
+    the /history entry and finally sends execution_success. error_rate makes
+    that fraction of prompts end in execution_error instead. POST /queue
+    {'delete': [...]} drops pending prompts and POST /interrupt stops a
+    running one at its next sampler step with execution_interrupted.
+    """
+
+    def __init__(self, output_dir, sample_latency, upload_latency=None, workers=1, error_rate=0.0):
+        self.output_dir = output_dir
+        self.sample_latency = sample_latency
+        self.upload_latency = upload_latency or Latency(0)
+        self.error_rate = error_rate
+        self._uploads = set()
+        self._pending = deque()  # [number, prompt_id, prompt, extra, outputs] as /queue reports them
+        self._running = {}
+        self._interrupted = set()  # running prompt ids to stop at the next step
+        self._history = OrderedDict()
+        self._sockets = {}  # client_id -> WebSocket
+        self._cond = threading.Condition()
+        self._number = 0
+        self._counters = {}  # output path prefix -> last counter, like ComfyUI's save-image counter
+        for n in range(workers):
+            threading.Thread(target=self._worker, name=f'comfy-stub-{n}', daemon=True).start()
+
+    def serve(self, host='127.0.0.1', port=0):
+        return StubServer((host, port), ComfyHandler, self).start()
+
+    # HTTP-facing operations
+
+    def upload(self, name):
+        self.upload_latency.sleep()
+        with self._cond:
+            self._uploads.add(name)
+        return {'name': name, 'subfolder': '', 'type': 'input'}
+
+    def queue_prompt(self, prompt, client_id, front=False):
+        """(status, body) for POST /prompt"""
+        node_errors = {}
+        for node_id, node in prompt.items():
+            if node.get('class_type') == 'LoadImage' and node['inputs'].get('image') not in self._uploads:
+                node_errors[node_id] = {'errors': [{'type': 'value_not_in_list',
+                                                    'message': 'Value not in list',
+                                                    'details': f"image: '{node['inputs'].get('image')}' not in []"}],
+                                        'class_type': 'LoadImage'}
+        if node_errors:
+            return 400, {'error': {'type': 'prompt_outputs_failed_validation',
+                                   'message': 'Prompt outputs failed validation'},
+                         'node_errors': node_errors}
+        prompt_id = str(uuid.uuid4())
+        with self._cond:
+            self._number += 1
+            item = [-self._number if front else self._number, prompt_id, prompt, {'client_id': client_id}, []]
+            if front:
+                self._pending.appendleft(item)
+            else:
+                self._pending.append(item)
+            self._cond.notify()
+        return 200, {'prompt_id': prompt_id, 'number': item[0], 'node_errors': {}}
+
+    def delete(self, prompt_ids):
+        with self._cond:
+            self._pending = deque(item for item in self._pending if item[1] not in prompt_ids)
+
+    def interrupt(self, prompt_id=None):
+        """Stop prompt_id if it is running, or every running prompt without one"""
+        with self._cond:
+            self._interrupted.update(running for running in self._running if prompt_id in (None, running))
+
+    def queue_state(self):
+        with self._cond:
+            return {'queue_running': list(self._running.values()), 'queue_pending': list(self._pending)}
+
+    def history(self, prompt_id=None):
+        with self._cond:
+            if prompt_id:
+                entry = self._history.get(prompt_id)
+                return {prompt_id: entry} if entry else {}
+            return dict(self._history)
+
+    def connect(self, client_id, socket):
+        with self._cond:
+            self._sockets[client_id] = socket
+            remaining = len(self._pending) + len(self._running)
+        socket.send({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': remaining}},
+                                                'sid': client_id}})
+
+    def disconnect(self, client_id, socket):
+        with self._cond:
+            if self._sockets.get(client_id) is socket:
+                del self._sockets[client_id]
+
+    # Execution
+
+    def _send(self, client_id, msg_type, data):
+        socket = self._sockets.get(client_id)
+        if socket:
+            socket.send({'type': msg_type, 'data': data})
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                item = self._pending.popleft()
+                self._running[item[1]] = item
+            try:
+                self._execute(item)
+            finally:
+                with self._cond:
+                    self._running.pop(item[1], None)
+                    self._interrupted.discard(item[1])
+
+    def _execute(self, item):
+        number, prompt_id, prompt, extra, _ = item
+        client_id = extra.get('client_id')
+        started = {'prompt_id': prompt_id, 'timestamp': int(time.time() * 1000)}
+        self._send(client_id, 'execution_start', started)
+        samplers = [node_id for node_id, node in prompt.items() if 'KSampler' in node.get('class_type', '')]
+        # Each image saved costs one sample_latency draw, so a party prompt runs as long as its members would
+        images = sum(node.get('class_type', '').startswith('SaveImage') for node in prompt.values())
+        sample_seconds = sum(self.sample_latency.sample() for _ in range(max(1, images))) / max(1, len(samplers))
+        failed = random.random() < self.error_rate
+        outputs = {}
+        # Samplers before the SaveImage nodes that consume their output
+        ordered = sorted(prompt.items(), key=lambda item: item[1].get('class_type', '').startswith('SaveImage'))
+        for node_id, node in ordered:
+            self._send(client_id, 'executing', {'node': node_id, 'display_node': node_id, 'prompt_id': prompt_id})
+            if node_id in samplers:
+                steps = node['inputs'].get('steps')
+                steps = steps if isinstance(steps, int) and steps > 0 else 20
+                for step in range(1, steps + 1):
+                    time.sleep(sample_seconds / steps)
+                    if prompt_id in self._interrupted:
+                        self._send(client_id, 'execution_interrupted', {'prompt_id': prompt_id, 'node_id': node_id,
+                                                                        'node_type': node['class_type'],
+                                                                        'executed': []})
+                        self._record(prompt_id, item, {}, 'error', started)
+                        return
+                    self._send(client_id, 'progress', {'value': step, 'max': steps,
+                                                       'prompt_id': prompt_id, 'node': node_id})
+                if failed:
+                    self._send(client_id, 'execution_error', {'prompt_id': prompt_id, 'node_id': node_id,
+                                                              'node_type': node['class_type'],
+                                                              'exception_message': 'Simulated failure',
+                                                              'exception_type': 'RuntimeError'})
+                    self._record(prompt_id, item, {}, 'error', started)
+                    return
+            elif node.get('class_type', '').startswith('SaveImage'):
+                outputs[node_id] = {'images': [self._save_image(prompt, node)]}
+        finished = {'prompt_id': prompt_id, 'timestamp': int(time.time() * 1000)}
+        self._record(prompt_id, item, outputs, 'success', started, finished)
+        self._send(client_id, 'execution_success', finished)
+        self._send(client_id, 'executing', {'node': None, 'prompt_id': prompt_id})
+
+    def _record(self, prompt_id, item, outputs, status, started, finished=None):
+        messages = [['execution_start', started]] + ([['execution_success', finished]] if finished else [])
+        with self._cond:
+            self._history[prompt_id] = {
+                'prompt': item[:4] + [list(outputs)],
+                'outputs': outputs,
+                'status': {'status_str': status, 'completed': status == 'success', 'messages': messages},
+            }
+            while len(self._history) > HISTORY_ENTRIES:
+                self._history.popitem(last=False)
+
+    def _save_image(self, prompt, node):
+        """Write a PNG named like ComfyUI's <prefix>_<counter:05>_.png and return its output record"""
+        inputs = node['inputs']
+        prefix = inputs.get('filename_prefix') or 'ComfyUI'
+        subfolder = '/'.join(part for part in (inputs.get('subdirectory_name'), os.path.dirname(prefix)) if part)
+        prefix = os.path.basename(prefix)
+        width = height = 512
+        for other in prompt.values():
+            if other.get('class_type') == 'EmptyLatentImage':
+                width, height = other['inputs'].get('width', width), other['inputs'].get('height', height)
+        directory = os.path.join(self.output_dir, subfolder)
+        os.makedirs(directory, exist_ok=True)
+        with self._cond:
+            key = os.path.join(directory, prefix)
+            self._counters[key] = self._counters.get(key, 0) + 1
+            filename = f"{prefix}_{self._counters[key]:05}_.png"
+        # Random 16x16 pixel art scaled up: every output is distinct but cheap to encode
+        image = Image.frombytes('RGB', (16, 16), os.urandom(16 * 16 * 3)).resize((width, height), Image.NEAREST)
+        image.save(os.path.join(directory, filename), 'PNG')
+        return {'filename': filename, 'subfolder': subfolder, 'type': 'output'}
+
+
+class ComfyHandler(StubHandler):
+    def do_GET(self):
+        route = self.route
+        if route == '/ws':
+            return self._websocket()
+        if route == '/queue':
+            return self.send_json(self.stub.queue_state())
+        if route == '/system_stats':
+            return self.send_json({'system': {'os': 'stub', 'comfyui_version': 'stub'},
+                                   'devices': [{'name': 'stub', 'type': 'cuda', 'index': 0,
+                                                'vram_total': 24 << 30, 'vram_free': 20 << 30}]})
+        if route == '/history':
+            return self.send_json(self.stub.history())
+        if route.startswith('/history/'):
+            return self.send_json(self.stub.history(route.rsplit('/', 1)[1]))
+        if route == '/view':
+            return self._view()
+        self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        if self.route == '/upload/image':
+            image = self._multipart_file('image')
+            if not image:
+                return self.send_json({'error': 'no image'}, 400)
+            return self.send_json(self.stub.upload(os.path.basename(image)))
+        if self.route == '/prompt':
+            body = json.loads(self.read_body() or b'{}')
+            status, response = self.stub.queue_prompt(body.get('prompt') or {}, body.get('client_id'),
+                                                      bool(body.get('front')))
+            return self.send_json(response, status)
+        if self.route == '/queue':
+            body = json.loads(self.read_body() or b'{}')
+            self.stub.delete(set(body.get('delete') or []))
+            return self.send_json({})
+        if self.route == '/interrupt':
+            body = json.loads(self.read_body() or b'{}')
+            self.stub.interrupt(body.get('prompt_id'))
+            return self.send_json({})
+        self.read_body()
+        self.send_json({'error': 'not found'}, 404)
+
+    def _multipart_file(self, field):
+        """Filename of the named file part; the image bytes themselves are not kept"""
+        header = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode('utf-8')
+        message = BytesParser(policy=HTTP).parsebytes(header + self.read_body())
+        for part in message.iter_parts():
+            if part.get_param('name', header='content-disposition') == field:
+                return part.get_filename()
+        return None
+
+    def _view(self):
+        query = self.query
+        path = os.path.normpath(os.path.join(self.stub.output_dir, query.get('subfolder', ''),
+                                             os.path.basename(query.get('filename', ''))))
+        if query.get('type', 'output') != 'output' or not path.startswith(self.stub.output_dir) \
+                or not os.path.isfile(path):
+            return self.send_json({'error': 'not found'}, 404)
+        with open(path, 'rb') as f:
+            self.send_bytes(f.read(), 'image/png')
+
+    def _websocket(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if not key:
+            return self.send_json({'error': 'expected a websocket upgrade'}, 400)
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        client_id = self.query.get('clientId') or uuid.uuid4().hex
+        socket = WebSocket(self.wfile)
+        self.stub.connect(client_id, socket)
+        try:
+            # Only control frames matter: answer pings, stop on close or EOF
+            while True:
+                opcode, payload = read_frame(self.rfile)
+                if opcode is None or opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    socket.send_frame(0xA, payload)
+        except OSError:
+            pass
+        finally:
+            socket.closed = True
+            self.stub.disconnect(client_id, socket)
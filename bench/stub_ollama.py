@@ -0,0 +1,125 @@
+# Stand-in for the Ollama chat API, so the app can be load-tested without an inference box
+
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from bench.latency import Latency
+from bench.stub_http import StubServer, StubHandler
+
+VISION_REPLY = ('A person in their thirties with shoulder-length wavy brown hair, a short beard, '
+                'green eyes, a narrow face with high cheekbones and an athletic build.')
+CHAT_REPLY = ('Clad in dented plate armour etched with silver runes, the hero grips a longsword '
+              'wreathed in pale blue flame. A weathered travelling cloak hangs from broad shoulders, '
+              'a pouch of spell components at the belt, standing on a windswept ridge above a ruined keep '
+              'at dusk, torchlight catching the determined set of the jaw.')
+
+
+class OllamaStub:
+    """Answers POST /api/chat the way Ollama does, after a configurable delay.
+
+    Calls carrying images take vision_latency, all others chat_latency; a
+    call for a model other than the resident one first pays load_latency,
+    and at most `parallel` calls run at once, like OLLAMA_NUM_PARALLEL.
+    Streamed replies arrive as NDJSON chunks spread over the call's latency,
+    and a `format` schema gets a JSON reply with one entry per "Name:" line
+    of the prompt. error_rate fails that fraction of calls with a 500.
+    """
+
+    def __init__(self, chat_latency, vision_latency, load_latency=None, parallel=1, error_rate=0.0):
+        self.chat_latency = chat_latency
+        self.vision_latency = vision_latency
+        self.load_latency = load_latency or Latency(0)
+        self.error_rate = error_rate
+        self._slots = threading.Semaphore(parallel)
+        self._lock = threading.Lock()
+        self._resident = None
+        self.calls = 0
+        self.loads = 0
+
+    def serve(self, host='127.0.0.1', port=0):
+        return StubServer((host, port), OllamaHandler, self).start()
+
+    def _reply(self, body):
+        messages = body.get('messages') or [{}]
+        if any(message.get('images') for message in messages):
+            return VISION_REPLY, self.vision_latency
+        if body.get('format'):
+            members = max(1, messages[-1].get('content', '').count('Name:'))
+            reply = json.dumps({'characters': [{'name': f'Member {n}', 'description': CHAT_REPLY}
+                                               for n in range(1, members + 1)]})
+            return reply, self.chat_latency
+        return CHAT_REPLY, self.chat_latency
+
+    def chat(self, body, on_chunk=None):
+        """Simulate one call; returns the final response dict, or None for an injected failure"""
+        text, latency = self._reply(body)
+        model = body.get('model')
+        with self._slots:
+            started = time.monotonic()
+            with self._lock:
+                self.calls += 1
+                swapping = model != self._resident
+                self._resident = model
+                self.loads += swapping
+            load_seconds = self.load_latency.sleep() if swapping else 0.0
+            if random.random() < self.error_rate:
+                return None
+            seconds = latency.sample()
+            if on_chunk:
+                # Words are streamed evenly across the call
+                words = text.split(' ')
+                for n, word in enumerate(words):
+                    time.sleep(seconds / len(words))
+                    on_chunk(_chunk(model, word if n == 0 else ' ' + word))
+            else:
+                time.sleep(seconds)
+            return dict(_chunk(model, '' if on_chunk else text), done=True, done_reason='stop',
+                        total_duration=int((time.monotonic() - started) * 1e9),
+                        load_duration=int(load_seconds * 1e9),
+                        prompt_eval_count=64, eval_count=len(text.split()))
+
+
+def _chunk(model, content):
+    return {
+        'model': model,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'message': {'role': 'assistant', 'content': content},
+        'done': False,
+    }
+
+
+class OllamaHandler(StubHandler):
+    def do_GET(self):
+        if self.route == '/api/tags':
+            return self.send_json({'models': []})
+        if self.route == '/api/version':
+            return self.send_json({'version': '0.0.0-stub'})
+        self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        body = json.loads(self.read_body() or b'{}')
+        if self.route != '/api/chat':
+            return self.send_json({'error': 'not found'}, 404)
+        if not body.get('stream', True):
+            response = self.stub.chat(body)
+            if response is None:
+                return self.send_json({'error': 'simulated failure'}, 500)
+            return self.send_json(response)
+
+        started = []
+
+        def send(chunk):
+            if not started:
+                self.start_chunked('application/x-ndjson')
+                started.append(True)
+            self.write_chunk(json.dumps(chunk).encode('utf-8') + b'\n')
+
+        response = self.stub.chat(body, on_chunk=send)
+        if response is None and not started:
+            return self.send_json({'error': 'simulated failure'}, 500)
+        if response is not None:
+            send(response)
+        self.end_chunked()
@@ -0,0 +1,164 @@
+# Pooled, timeout-bounded HTTP client for one ComfyUI server
+
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+RETRYABLE_STATUS = {502, 503, 504}
+
+
+def view_params(filename, subfolder=None, image_type=None):
+    params = {'filename': filename}
+    if subfolder is not None:
+        params['subfolder'] = subfolder
+    if image_type is not None:
+        params['type'] = image_type
+    return params
+
+
+class ComfyClient:
+    """Keep-alive session for every ComfyUI HTTP call.
+
+    Each operation has its own (connect, read) timeout from config.COMFY_TIMEOUTS;
+    idempotent calls (GETs) are retried on connection errors, timeouts and
+    502/503/504 with jittered exponential backoff. Latency and error counters
+    are kept per operation. The *_async twins make the same calls over a
+    non-blocking httpx client for pipeline coroutines on the job loop.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.base_url = f"http://{host}"
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.COMFY_POOL_SIZE, max_retries=0)
+        self.session.mount('http://', adapter)
+        self._async_session = None  # httpx.AsyncClient, created on the loop that first uses it
+        self._stats = {}  # operation -> {'count', 'errors', 'retries', 'total', 'max'}
+        self._lock = threading.Lock()
+
+    def _record(self, operation, seconds, error=False, retry=False):
+        with self._lock:
+            stats = self._stats.setdefault(operation, {'count': 0, 'errors': 0, 'retries': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['errors'] += error
+            stats['retries'] += retry
+
+    def request(self, operation, method, path, idempotent=False, **kwargs):
+        """Send one request with the operation's timeouts; raises on final failure"""
+        timeout = (config.COMFY_CONNECT_TIMEOUT, config.COMFY_TIMEOUTS.get(operation, config.COMFY_DEFAULT_TIMEOUT))
+        attempts = config.COMFY_RETRIES + 1 if idempotent else 1
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(operation, time.monotonic() - started, error=True, retry=not last)
+                if last:
+                    raise
+            else:
+                retry = response.status_code in RETRYABLE_STATUS and not last
+                self._record(operation, time.monotonic() - started, error=response.status_code >= 500, retry=retry)
+                if not retry:
+                    return response
+            time.sleep(config.COMFY_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    async def request_async(self, operation, method, path, idempotent=False, **kwargs):
+        """request() for coroutines; same timeouts, retries and counters"""
+        if self._async_session is None:
+            self._async_session = httpx.AsyncClient(
+                base_url=self.base_url, limits=httpx.Limits(max_connections=config.COMFY_POOL_SIZE))
+        timeout = httpx.Timeout(config.COMFY_TIMEOUTS.get(operation, config.COMFY_DEFAULT_TIMEOUT),
+                                connect=config.COMFY_CONNECT_TIMEOUT)
+        attempts = config.COMFY_RETRIES + 1 if idempotent else 1
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            started = time.monotonic()
+            try:
+                response = await self._async_session.request(method, path, timeout=timeout, **kwargs)
+            except httpx.TransportError:
+                self._record(operation, time.monotonic() - started, error=True, retry=not last)
+                if last:
+                    raise
+            else:
+                retry = response.status_code in RETRYABLE_STATUS and not last
+                self._record(operation, time.monotonic() - started, error=response.status_code >= 500, retry=retry)
+                if not retry:
+                    return response
+            await asyncio.sleep(config.COMFY_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    async def upload_image_async(self, data, name, mimetype='image/png'):
+        """POST /upload/image; returns the name ComfyUI stored it under"""
+        response = await self.request_async('upload', 'POST', '/upload/image', files={'image': (name, data, mimetype)})
+        response.raise_for_status()
+        return response.json().get('name', name)
+
+    async def queue_prompt_async(self, prompt, client_id, front=False):
+        """POST /prompt; returns the prompt_id. front=True puts it ahead of everything already pending"""
+        body = {'prompt': prompt, 'client_id': client_id}
+        if front:
+            body['front'] = True
+        response = await self.request_async('prompt', 'POST', '/prompt', json=body)
+        response.raise_for_status()
+        return response.json().get('prompt_id')
+
+    def history(self, prompt_id=None):
+        path = f"/history/{prompt_id}" if prompt_id else '/history'
+        response = self.request('history', 'GET', path, idempotent=True)
+        response.raise_for_status()
+        return response.json()
+
+    async def history_async(self, prompt_id=None):
+        path = f"/history/{prompt_id}" if prompt_id else '/history'
+        response = await self.request_async('history', 'GET', path, idempotent=True)
+        response.raise_for_status()
+        return response.json()
+
+    async def view_async(self, filename, subfolder=None, image_type=None):
+        response = await self.request_async('view', 'GET', '/view', idempotent=True,
+                                            params=view_params(filename, subfolder, image_type))
+        response.raise_for_status()
+        return response.content
+
+    def queue_status(self):
+        """GET /queue: {'queue_running': [...], 'queue_pending': [...]}"""
+        response = self.request('status', 'GET', '/queue', idempotent=True)
+        response.raise_for_status()
+        return response.json()
+
+    def delete_queued(self, prompt_ids):
+        """POST /queue {'delete': [...]}: drop prompts that have not started"""
+        response = self.request('cancel', 'POST', '/queue', json={'delete': list(prompt_ids)})
+        response.raise_for_status()
+
+    def interrupt(self, prompt_id):
+        """POST /interrupt: stop the running prompt (newer ComfyUI only does so if it is prompt_id)"""
+        response = self.request('cancel', 'POST', '/interrupt', json={'prompt_id': prompt_id})
+        response.raise_for_status()
+
+    def system_stats(self):
+        response = self.request('status', 'GET', '/system_stats', idempotent=True)
+        response.raise_for_status()
+        return response.json()
+
+    def stats(self):
+        with self._lock:
+            return {
+                operation: {
+                    'count': s['count'],
+                    'errors': s['errors'],
+                    'retries': s['retries'],
+                    'avg_ms': round(1000 * s['total'] / s['count'], 1) if s['count'] else 0,
+                    'max_ms': round(1000 * s['max'], 1),
+                }
+                for operation, s in self._stats.items()
+            }
@@ -0,0 +1,318 @@
+# Queue-aware dispatch across several ComfyUI backends
+
+import logging
+import mimetypes
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from aio import run_blocking
+from comfy_client import ComfyClient
+from comfy_tracker import ComfyTracker
+from hashing import file_sha256
+from metrics import Counter, register_collector
+
+log = logging.getLogger(__name__)
+
+BACKEND_FAILURES = Counter('adventure_comfy_backend_failures_total', 'Times a ComfyUI backend was marked down', ['host'])
+PROMPTS_CANCELLED = Counter('adventure_comfy_prompts_cancelled_total', 'Abandoned prompts taken off a ComfyUI backend',
+                            ['host', 'action'])
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class NoBackendAvailable(Exception):
+    """Raised when every ComfyUI backend is down or has already been tried"""
+
+
+class ComfyBackend:
+    def __init__(self, index, host):
+        self.index = index
+        self.host = host
+        self.client = ComfyClient(host)
+        self.tracker = ComfyTracker(host, self._fetch_history, self._fetch_history_async)
+        # Distinct output names per node so files fetched from different nodes never collide
+        self.filename_prefix = None if index == 0 else f"ComfyUI_n{index}"
+        self.healthy = True
+        self.queue_depth = 0  # running + pending on the server, from /queue
+        self.queue_ids = []  # their prompt ids, running first, then pending in execution order
+        self.vram_free = 0
+        self.in_flight = 0  # prompts we queued here and are still waiting on
+        self.in_flight_images = 0  # images those prompts sample
+        self.prompt_images = {}  # prompt id -> images it samples, for ours; any other prompt counts as one
+        self.claimed = 0  # images of jobs sent here that have not queued their prompt yet (uploading, or waiting for room)
+        self.last_error = None
+        self.checked_at = None
+        self.down_since = None  # monotonic time it was marked down
+        self._uploads = OrderedDict()  # sha256 of an uploaded photo -> name ComfyUI stored it under
+        self._uploads_lock = threading.Lock()
+        self.upload_hits = 0
+        self.upload_misses = 0
+
+    def _fetch_history(self, prompt_id):
+        try:
+            return self.client.history(prompt_id)
+        except Exception as e:
+            log.warning("Error getting ComfyUI history from %s: %s", self.host, e)
+            return None
+
+    async def _fetch_history_async(self, prompt_id):
+        try:
+            return await self.client.history_async(prompt_id)
+        except Exception as e:
+            log.warning("Error getting ComfyUI history from %s: %s", self.host, e)
+            return None
+
+    def _uploaded_name(self, digest):
+        with self._uploads_lock:
+            name = self._uploads.get(digest)
+            if name:
+                self._uploads.move_to_end(digest)
+                self.upload_hits += 1
+            else:
+                self.upload_misses += 1
+            return name
+
+    def _remember_upload(self, digest, name):
+        with self._uploads_lock:
+            self._uploads[digest] = name
+            while len(self._uploads) > config.COMFY_UPLOAD_CACHE_ENTRIES:
+                self._uploads.popitem(last=False)
+
+    async def upload_image_async(self, path):
+        """Upload a photo unless this node already has the same bytes; returns its ComfyUI image name"""
+        digest = await run_blocking(file_sha256, path)
+        name = self._uploaded_name(digest)
+        if name:
+            return name
+        # Name the file by its hash so ComfyUI's input folder is content-addressed too
+        mimetype = mimetypes.guess_type(path)[0] or 'image/png'
+        data = await run_blocking(read_file, path)
+        name = await self.client.upload_image_async(data, f"{digest}{os.path.splitext(path)[1]}", mimetype)
+        self._remember_upload(digest, name)
+        return name
+
+    def forget_uploads(self):
+        """Drop the upload map, e.g. after the node went away and may have lost its input folder"""
+        with self._uploads_lock:
+            self._uploads.clear()
+
+    def images(self, prompt_ids):
+        """Images the given prompts sample, charging each of ours its own count"""
+        prompt_images = self.prompt_images
+        return sum(prompt_images.get(prompt_id, 1) for prompt_id in prompt_ids)
+
+    @property
+    def load(self):
+        """Images running or pending on the node, so a queued party weighs as much as its members"""
+        # Our own in-flight count covers prompts queued since the last /queue poll
+        return max(self.images(self.queue_ids), self.in_flight_images)
+
+    def lost(self):
+        """Whether the node has been down so long that prompts waiting on it should be run elsewhere"""
+        down_since = self.down_since
+        return down_since is not None and time.monotonic() - down_since >= config.COMFY_LOST_AFTER
+
+    def position(self, prompt_id):
+        """Images ahead of prompt_id on this node as of the last /queue poll; 0 once it is running"""
+        if self.tracker.is_running(prompt_id):
+            return 0
+        queue_ids = self.queue_ids
+        return self.images(queue_ids[:queue_ids.index(prompt_id)] if prompt_id in queue_ids else queue_ids)
+
+    def cancel_prompt(self, prompt_id):
+        """Take an abandoned prompt off this node: drop it from the queue, or interrupt it if it is running.
+
+        Returns 'deleted', 'interrupted', or None when it had already finished.
+        """
+        def running(queue):
+            return any(item[1] == prompt_id for item in queue.get('queue_running', []))
+
+        queue = self.client.queue_status()
+        action = None
+        if any(item[1] == prompt_id for item in queue.get('queue_pending', [])):
+            self.client.delete_queued([prompt_id])
+            action = 'deleted'
+            # It may have started between the two calls
+            queue = self.client.queue_status()
+        if running(queue):
+            self.client.interrupt(prompt_id)
+            action = 'interrupted'
+        if action:
+            PROMPTS_CANCELLED.inc(host=self.host, action=action)
+        return action
+
+    def to_dict(self):
+        return {
+            'host': self.host,
+            'healthy': self.healthy,
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'claimed': self.claimed,
+            'sample_seconds': self.tracker.sample_seconds,
+            'vram_free': self.vram_free,
+            'last_error': self.last_error,
+            'checked_at': self.checked_at,
+            'upload_hits': self.upload_hits,
+            'upload_misses': self.upload_misses,
+        }
+
+
+class ComfyPool:
+    """Polls each backend's /queue and /system_stats and routes work to the least-loaded healthy node.
+
+    Callers keep a job on one backend from upload to download; when a call to
+    it fails they mark it down and ask choose() for another, excluding the
+    nodes already tried. Jobs sent to a node count against it from the
+    moment it is chosen until their prompt is queued there, so a burst of
+    jobs still in the app spreads out instead of tying on the /queue depth
+    it has not reached yet. A job already waiting on a node moves once the node
+    has been down for COMFY_LOST_AFTER seconds (ComfyBackend.lost()). Down
+    nodes rejoin after their next good health check.
+    """
+
+    def __init__(self, hosts):
+        if not hosts:
+            raise ValueError('At least one ComfyUI host is required')
+        self.backends = [ComfyBackend(index, host) for index, host in enumerate(hosts)]
+        self._by_host = {backend.host: backend for backend in self.backends}
+        self._claims = {}  # claim key (a job id) -> (backend the job was sent to, images it will sample)
+        self._lock = threading.Lock()
+        self._thread = None
+        register_collector(self._collect)
+
+    def start(self):
+        for backend in self.backends:
+            backend.tracker.start()
+        if not self._thread:
+            self._thread = threading.Thread(target=self._poll_health, name='comfy-health', daemon=True)
+            self._thread.start()
+
+    def get(self, host=None):
+        """Backend for host (the first configured one by default); unknown hosts get an ad-hoc backend"""
+        if not host:
+            return self.backends[0]
+        with self._lock:
+            backend = self._by_host.get(host)
+            if backend is None:
+                backend = self._by_host[host] = ComfyBackend(len(self._by_host), host)
+            return backend
+
+    def _poll_health(self):
+        while True:
+            for backend in self.backends:
+                self.check(backend)
+            time.sleep(config.COMFY_HEALTH_INTERVAL)
+
+    def check(self, backend):
+        try:
+            queue = backend.client.queue_status()
+            stats = backend.client.system_stats()
+            devices = stats.get('devices') or [{}]
+            with self._lock:
+                # Items are [number, prompt_id, prompt, extra_data, outputs]; pending runs in number order
+                pending = sorted(queue.get('queue_pending', []), key=lambda item: item[0])
+                backend.queue_ids = [item[1] for item in queue.get('queue_running', []) + pending]
+                backend.queue_depth = len(backend.queue_ids)
+                backend.vram_free = devices[0].get('vram_free', 0)
+                if not backend.healthy:
+                    log.info("ComfyUI backend %s is back", backend.host)
+                backend.healthy = True
+                backend.down_since = None
+                backend.last_error = None
+        except Exception as e:
+            self.mark_failed(backend, e)
+        backend.checked_at = time.time()
+
+    def mark_failed(self, backend, error):
+        with self._lock:
+            if backend.healthy:
+                log.warning("ComfyUI backend %s marked down: %s", backend.host, error)
+                BACKEND_FAILURES.inc(host=backend.host)
+                backend.down_since = time.monotonic()
+            backend.healthy = False
+            backend.last_error = str(error)
+        backend.forget_uploads()
+
+    def choose(self, exclude=(), claim=None, images=1):
+        """Least-loaded healthy backend not in exclude; falls back to untried down nodes.
+
+        With a claim key, the job's images count against the chosen backend
+        (in place of any backend it claimed before) until unclaim(claim).
+        """
+        with self._lock:
+            candidates = [b for b in self.backends if b.host not in exclude]
+            if not candidates:
+                raise NoBackendAvailable('All ComfyUI backends failed')
+            healthy = [b for b in candidates if b.healthy] or candidates
+            backend = min(healthy, key=lambda b: (b.load + b.claimed, -b.vram_free, b.index))
+            if claim is not None:
+                self._unclaim_locked(claim)
+                self._claims[claim] = (backend, images)
+                backend.claimed += images
+            return backend
+
+    def unclaim(self, claim):
+        """Stop counting a claimed job against its backend (its prompt is queued, or it ended); safe to repeat"""
+        with self._lock:
+            self._unclaim_locked(claim)
+
+    def _unclaim_locked(self, claim):
+        backend, images = self._claims.pop(claim, (None, 0))
+        if backend is not None:
+            backend.claimed -= images
+
+    def started(self, backend, prompt_id=None, images=1):
+        with self._lock:
+            backend.in_flight += 1
+            backend.in_flight_images += images
+            if prompt_id:
+                backend.prompt_images[prompt_id] = images
+            # ComfyUI runs prompts in order, so until the next /queue poll ours waits behind everything seen so far
+            if prompt_id and prompt_id not in backend.queue_ids:
+                backend.queue_ids = backend.queue_ids + [prompt_id]
+
+    def finished(self, backend, prompt_id=None, images=1):
+        with self._lock:
+            backend.in_flight -= 1
+            backend.in_flight_images -= images
+            backend.prompt_images.pop(prompt_id, None)
+            if prompt_id in backend.queue_ids:
+                backend.queue_ids = [queued for queued in backend.queue_ids if queued != prompt_id]
+
+    def stats(self):
+        with self._lock:
+            return [backend.to_dict() for backend in self.backends]
+
+    def _collect(self):
+        backends = self.stats()
+        requests = [(backend.host, operation, stats)
+                    for backend in self.backends for operation, stats in backend.client.stats().items()]
+
+        def per_backend(field):
+            return [({'host': backend['host']}, int(backend[field])) for backend in backends]
+
+        def per_request(field):
+            return [({'host': host, 'operation': operation}, stats[field]) for host, operation, stats in requests]
+
+        return [
+            ('adventure_comfy_healthy', 'gauge', 'Whether a ComfyUI backend passed its last health check',
+             per_backend('healthy')),
+            ('adventure_comfy_queue_depth', 'gauge', 'Prompts running or pending on a ComfyUI backend',
+             per_backend('queue_depth')),
+            ('adventure_comfy_in_flight', 'gauge', 'Prompts this app is waiting on, per ComfyUI backend',
+             per_backend('in_flight')),
+            ('adventure_comfy_upload_cache_total', 'counter', 'Photo uploads per backend, by whether it already had them',
+             [({'host': backend['host'], 'result': 'hit'}, backend['upload_hits']) for backend in backends] +
+             [({'host': backend['host'], 'result': 'miss'}, backend['upload_misses']) for backend in backends]),
+            ('adventure_comfy_requests_total', 'counter', 'HTTP calls to ComfyUI', per_request('count')),
+            ('adventure_comfy_request_errors_total', 'counter', 'ComfyUI calls that failed or returned 5xx',
+             per_request('errors')),
+            ('adventure_comfy_request_retries_total', 'counter', 'ComfyUI calls that were retried',
+             per_request('retries')),
+        ]
@@ -0,0 +1,230 @@
+# Completion tracking for ComfyUI prompts, keyed by the prompt_id returned from /prompt
+
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import config
+from aio import LoopEvent
+
+log = logging.getLogger(__name__)
+
+try:
+    import websocket  # websocket-client
+except ImportError:
+    websocket = None
+
+
+class PromptLost(Exception):
+    """Raised by wait_async() when the node running the prompt is considered gone"""
+
+
+class PromptResult:
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.event = threading.Event()
+        self.status = 'pending'  # pending -> success | error
+        self.images = []
+        self.error = None
+        self.started_at = None  # monotonic time of ComfyUI's execution_start event
+        self.run_seconds = None
+        self.image_count = 1  # images the prompt samples (a party prompt samples one per member); see expect()
+        self._waiters = []  # LoopEvents of waiting coroutines
+
+    def add_waiter(self, waiter):
+        self._waiters.append(waiter)
+        if self.event.is_set():
+            waiter.set()
+
+    def resolve(self, status, images=None, error=None):
+        self.status = status
+        self.images = images or []
+        self.error = error
+        self.event.set()
+        for waiter in list(self._waiters):
+            waiter.set()
+
+
+def images_from_history(entry):
+    """Pull the saved output images out of a /history/<prompt_id> entry, tagged with the node that saved them"""
+    images = []
+    for node_id, node_output in entry.get('outputs', {}).items():
+        for image in node_output.get('images', []):
+            if image.get('type', 'output') == 'output':
+                images.append(dict(image, node=node_id))
+    return images
+
+
+class ComfyTracker:
+    """Resolves prompt_ids from ComfyUI's /ws execution events, with /history polling as fallback"""
+
+    def __init__(self, host, fetch_history, fetch_history_async=None):
+        self.host = host
+        self.client_id = uuid.uuid4().hex
+        self._fetch_history = fetch_history
+        self._fetch_history_async = fetch_history_async
+        self._results = OrderedDict()
+        self._progress = {}  # prompt_id -> callback(data) for sampler step events
+        self.sample_seconds = None  # moving average of run time per image sampled, from execution start to finish
+        self._lock = threading.Lock()
+        self._ws_connected = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the websocket listener if websocket-client is installed"""
+        if websocket is None or self._thread:
+            return
+        self._thread = threading.Thread(target=self._listen, name='comfy-ws', daemon=True)
+        self._thread.start()
+
+    def _result(self, prompt_id):
+        with self._lock:
+            result = self._results.get(prompt_id)
+            if result is None:
+                result = self._results[prompt_id] = PromptResult(prompt_id)
+                # Remember recent prompts so a completion that beats its waiter is not lost
+                while len(self._results) > config.COMFY_TRACKED_PROMPTS:
+                    self._results.popitem(last=False)
+            return result
+
+    def expect(self, prompt_id, images):
+        """Note how many images prompt_id samples, so its run time is charged per image"""
+        self._result(prompt_id).image_count = images
+
+    def _forget(self, prompt_id):
+        with self._lock:
+            result = self._results.get(prompt_id)
+            # A finished one stays (among the recent ones) so that the second completion message
+            # ComfyUI sends finds it done instead of resolving, and timing, a fresh copy
+            if result is not None and not result.event.is_set():
+                del self._results[prompt_id]
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            ws = websocket.WebSocket()
+            try:
+                ws.connect(f"ws://{self.host}/ws?clientId={self.client_id}", timeout=10)
+                ws.settimeout(None)
+                self._ws_connected.set()
+                backoff = 1
+                while True:
+                    message = ws.recv()
+                    if isinstance(message, str):
+                        self._handle_message(json.loads(message))
+            except Exception as e:
+                log.warning("ComfyUI websocket error on %s: %s", self.host, e)
+            finally:
+                self._ws_connected.clear()
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def _handle_message(self, message):
+        msg_type = message.get('type')
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+        if msg_type == 'execution_start':
+            self._result(prompt_id).started_at = time.monotonic()
+        elif msg_type == 'progress':
+            callback = self._progress.get(prompt_id)
+            if callback:
+                callback(data)
+        elif msg_type == 'execution_success' or (msg_type == 'executing' and data.get('node') is None):
+            self._complete_from_history(prompt_id)
+        elif msg_type in ('execution_error', 'execution_interrupted'):
+            error = data.get('exception_message') or msg_type.replace('_', ' ')
+            self._result(prompt_id).resolve('error', error=error)
+
+    def _complete_from_history(self, prompt_id):
+        """Resolve a prompt from its /history entry; returns False while it is still running"""
+        result = self._result(prompt_id)
+        if result.event.is_set():
+            return True
+        return self._resolve_from_history(result, self._fetch_history(prompt_id))
+
+    async def _complete_from_history_async(self, prompt_id):
+        result = self._result(prompt_id)
+        if result.event.is_set():
+            return True
+        if self._fetch_history_async is None:
+            return await asyncio.to_thread(self._complete_from_history, prompt_id)
+        return self._resolve_from_history(result, await self._fetch_history_async(prompt_id))
+
+    def _resolve_from_history(self, result, history):
+        prompt_id = result.prompt_id
+        entry = (history or {}).get(prompt_id)
+        if not entry:
+            return False
+        status = entry.get('status', {})
+        if status.get('status_str') == 'error':
+            result.resolve('error', error='ComfyUI reported an execution error')
+        elif status.get('completed', True):
+            result.resolve('success', images=images_from_history(entry))
+            self._record_run_time(result, status)
+        else:
+            return False
+        return True
+
+    def _record_run_time(self, result, status):
+        """Fold a finished prompt's run time per image into sample_seconds, preferring ComfyUI's own timestamps"""
+        stamps = {message[0]: message[1].get('timestamp') for message in status.get('messages') or []
+                  if len(message) == 2 and isinstance(message[1], dict)}
+        if stamps.get('execution_start') and stamps.get('execution_success'):
+            seconds = (stamps['execution_success'] - stamps['execution_start']) / 1000
+        elif result.started_at is not None:
+            seconds = time.monotonic() - result.started_at
+        else:
+            return
+        with self._lock:
+            if result.run_seconds is not None:
+                return  # already resolved by the websocket and the history safety net
+            result.run_seconds = seconds
+            seconds /= max(result.image_count, 1)
+            self.sample_seconds = seconds if self.sample_seconds is None else (
+                0.8 * self.sample_seconds + 0.2 * seconds)
+
+    def is_running(self, prompt_id):
+        """Whether ComfyUI has started executing prompt_id"""
+        with self._lock:
+            result = self._results.get(prompt_id)
+        return result is not None and result.started_at is not None
+
+    async def wait_async(self, prompt_id, timeout, on_progress=None, lost=None):
+        """Wait until prompt_id finishes; returns its PromptResult, or None on timeout.
+
+        Completion is awaited on the loop instead of blocking a thread.
+        on_progress(data) receives ComfyUI's /ws 'progress' payloads
+        ({'value', 'max', 'node', 'prompt_id'}) while the prompt runs.
+        lost() is asked between checks; once it returns True the wait gives up with PromptLost.
+        """
+        result = self._result(prompt_id)
+        done = LoopEvent()
+        result.add_waiter(done)
+        if on_progress:
+            self._progress[prompt_id] = on_progress
+        deadline = time.monotonic() + timeout
+        try:
+            while not result.event.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if lost and lost():
+                    raise PromptLost(f"{self.host} went away while running prompt {prompt_id}")
+                interval = (config.COMFY_HISTORY_SAFETY_INTERVAL if self._ws_connected.is_set()
+                            else config.COMFY_HISTORY_POLL_INTERVAL)
+                if not await done.wait(min(interval, remaining)):
+                    await self._complete_from_history_async(prompt_id)
+            return result
+        finally:
+            self._progress.pop(prompt_id, None)
+            self._forget(prompt_id)
@@ -15,232 +15,14 @@ import os
 import time
 import json
 
-# Get files before generation
-output_dir = '/home/ut/3Git/ComfyUI/output'
+# Get files before generation (the workflow saves into the adventure subfolder)
+output_dir = '/home/ut/3Git/ComfyUI/output/adventure'
 
 
-prompt_text = """{
-  "3": {
-    "inputs": {
-      "seed": 1016680605488490,
-      "steps": 30,
-      "cfg": 6.5,
-      "sampler_name": "ddpm",
-      "scheduler": "karras",
-      "denoise": 1,
-      "model": [
-        "21",
-        0
-      ],
-      "positive": [
-        "6",
-        0
-      ],
-      "negative": [
-        "7",
-        0
-      ],
-      "latent_image": [
-        "5",
-        0
-      ]
-    },
-    "class_type": "KSampler",
-    "_meta": {
-      "title": "KSampler"
-    }
-  },
-  "4": {
-    "inputs": {
-      "ckpt_name": "dreamshaper_8.safetensors"
-    },
-    "class_type": "CheckpointLoaderSimple",
-    "_meta": {
-      "title": "Load Checkpoint"
-    }
-  },
-  "5": {
-    "inputs": {
-      "width": 512,
-      "height": 512,
-      "batch_size": 1
-    },
-    "class_type": "EmptyLatentImage",
-    "_meta": {
-      "title": "Empty Latent Image"
-    }
-  },
-  "6": {
-    "inputs": {
-      "text": "pixel art, 8 bit style, Blue glasses.  Young woman rogue 33 years old wearing blue glasses wielding a stiletto dagger",
-      "clip": [
-        "34",
-        1
-      ]
-    },
-    "class_type": "CLIPTextEncode",
-    "_meta": {
-      "title": "CLIP Text Encode (Prompt)"
-    }
-  },
-  "7": {
-    "inputs": {
-      "text": "blurry, noisy, messy, lowres, jpeg, artifacts, ill, distorted, malformed, ",
-      "clip": [
-        "4",
-        1
-      ]
-    },
-    "class_type": "CLIPTextEncode",
-    "_meta": {
-      "title": "CLIP Text Encode (Prompt)"
-    }
-  },
-  "8": {
-    "inputs": {
-      "samples": [
-        "3",
-        0
-      ],
-      "vae": [
-        "4",
-        2
-      ]
-    },
-    "class_type": "VAEDecode",
-    "_meta": {
-      "title": "VAE Decode"
-    }
-  },
-  "12": {
-    "inputs": {
-      "image": "IMG_4858.jpg"
-    },
-    "class_type": "LoadImage",
-    "_meta": {
-      "title": "Load Image"
-    }
-  },
-  "18": {
-    "inputs": {
-      "weight": 0.8000000000000002,
-      "weight_faceidv2": -0.7700000000000001,
-      "weight_type": "linear",
-      "combine_embeds": "concat",
-      "start_at": 0,
-      "end_at": 1,
-      "embeds_scaling": "V only",
-      "model": [
-        "20",
-        0
-      ],
-      "ipadapter": [
-        "20",
-        1
-      ],
-      "image": [
-        "12",
-        0
-      ]
-    },
-    "class_type": "IPAdapterFaceID",
-    "_meta": {
-      "title": "IPAdapter FaceID"
-    }
-  },
-  "20": {
-    "inputs": {
-      "preset": "FACEID PLUS V2",
-      "lora_strength": 0.5000000000000001,
-      "provider": "CPU",
-      "model": [
-        "34",
-        0
-      ]
-    },
-    "class_type": "IPAdapterUnifiedLoaderFaceID",
-    "_meta": {
-      "title": "IPAdapter Unified Loader FaceID"
-    }
-  },
-  "21": {
-    "inputs": {
-      "weight": 0.4000000000000001,
-      "start_at": 0,
-      "end_at": 1,
-      "weight_type": "standard",
-      "model": [
-        "22",
-        0
-      ],
-      "ipadapter": [
-        "22",
-        1
-      ],
-      "image": [
-        "18",
-        1
-      ]
-    },
-    "class_type": "IPAdapter",
-    "_meta": {
-      "title": "IPAdapter"
-    }
-  },
-  "22": {
-    "inputs": {
-      "preset": "FULL FACE - SD1.5 only (portraits stronger)",
-      "model": [
-        "18",
-        0
-      ],
-      "ipadapter": [
-        "20",
-        1
-      ]
-    },
-    "class_type": "IPAdapterUnifiedLoader",
-    "_meta": {
-      "title": "IPAdapter Unified Loader"
-    }
-  },
-  "34": {
-    "inputs": {
-      "lora_name": "pixelart_style_eagle_v6.safetensors",
-      "strength_model": 1.0000000000000002,
-      "strength_clip": 1.0000000000000002,
-      "model": [
-        "4",
-        0
-      ],
-      "clip": [
-        "4",
-        1
-      ]
-    },
-    "class_type": "LoraLoader",
-    "_meta": {
-      "title": "Load LoRA"
-    }
-  },
-    "37": {
-            "inputs": {
-              "filename_prefix": "ComfyUI",
-              "subdirectory_name": "",
-              "output_format": "png",
-                "quality": "max",
-                "metadata_scope": "full",
-                "include_batch_num": "true",
-                "prefer_nearest": "true",
-                "images": ["8",0]
-                 },
-    "class_type": "SaveImageWithMetaData",
-    "_meta": {
-      "title": "Save Image With MetaData"
-          }
-    }
-}
-"""
+# The workflow is shared with the web app - see workflows/adventure.json
+workflow_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workflows', 'adventure.json')
+with open(workflow_path) as f:
+    workflow = json.load(f)
 
 def queue_prompt(prompt):
     p = {"prompt": prompt}
@@ -270,15 +52,19 @@ response = ollama.chat(model='llama3.2-vision', messages=[
             {'role': 'user','content': q,},], keep_alive=0)
 r1 = response['message']['content']
 
-prompt = json.loads(prompt_text)
+prompt = workflow["prompt"]
+patch_points = workflow["patch_points"]
 #set the text prompt for our positive CLIPTextEncode
-prompt["6"]["inputs"]["text"] = r1
+node, key = patch_points["positive"]
+prompt[node]["inputs"][key] = r1
 
 #set the seed for our KSampler node
-prompt["3"]["inputs"]["seed"] = 5
+node, key = patch_points["seed"]
+prompt[node]["inputs"][key] = 5
 
 #set image from user input
-prompt["12"]["inputs"]["image"] = sys.argv[2]
+node, key = patch_points["image"]
+prompt[node]["inputs"][key] = sys.argv[2]
 
 print(r1)
 print("Script name:", sys.argv[0])
@@ -3,19 +3,126 @@
 # Server Configuration
 OLLAMA_HOST = "0.0.0.0:11434"
 COMFYUI_HOST = "0.0.0.0:8188"
+COMFYUI_HOSTS = [COMFYUI_HOST]  # add more ComfyUI servers to load-balance across them
+COMFY_LOCAL_OUTPUT_HOSTS = [COMFYUI_HOST]  # hosts that save straight into COMFY_OUTPUT_DIR; others are fetched via /view
 
 # Models
 OLLAMA_MAIN_MODEL = "llama3.1"
 OLLAMA_VISION_MODEL = "granite3.2-vision"
 
+# Ollama Scheduling (calls are grouped per model to avoid reload thrashing)
+OLLAMA_PARALLEL = 1  # concurrent calls to the resident model; match OLLAMA_NUM_PARALLEL on the server
+OLLAMA_MAX_BATCH = 8  # consecutive calls for one model before yielding to a waiting model
+OLLAMA_BATCH_KEEP_ALIVE = "5m"  # keep_alive while more calls for the same model are queued
+OLLAMA_IDLE_KEEP_ALIVE = "5m"  # keep_alive when nothing else is queued
+
 # Generation Settings
 MAX_WAIT_TIME = 120  # seconds to wait for image generation
 IMAGE_UPLOAD_TIMEOUT = 30  # seconds for image upload
+PARTY_MAX_SIZE = 6  # most characters /party renders in one ComfyUI prompt
+
+# ComfyUI HTTP Client
+COMFY_POOL_SIZE = 16  # keep-alive connections per ComfyUI host
+COMFY_CONNECT_TIMEOUT = 3  # seconds
+COMFY_TIMEOUTS = {  # read timeout in seconds per operation
+    'upload': IMAGE_UPLOAD_TIMEOUT,
+    'prompt': 15,
+    'history': 10,
+    'view': 30,
+    'status': 5,
+    'cancel': 5,
+}
+COMFY_DEFAULT_TIMEOUT = 10
+COMFY_RETRIES = 2  # extra attempts for idempotent (GET) calls
+COMFY_RETRY_BACKOFF = 0.25  # seconds, doubled per attempt with +-50% jitter
+COMFY_UPLOAD_CACHE_ENTRIES = 10000  # photo hash -> ComfyUI image name, remembered per backend
+COMFY_HEALTH_INTERVAL = 5  # seconds between /queue and /system_stats polls of each backend
+COMFY_LOST_AFTER = 15  # seconds a backend may stay down before the prompts waiting on it are queued elsewhere
+COMFY_HISTORY_POLL_INTERVAL = 0.5  # seconds between /history checks when /ws is unavailable
+COMFY_HISTORY_SAFETY_INTERVAL = 5  # seconds between /history checks while /ws is connected
+COMFY_TRACKED_PROMPTS = 1000  # recent prompt results remembered for late waiters
+COMFY_QUEUE_WINDOW = 2  # our prompts in a backend's queue at once; the rest wait in the app by priority (interactive ones get a window of their own)
+
+# Job Settings
+JOB_WORKERS = 64  # generation pipelines in progress at once; one waiting on Ollama or ComfyUI holds no thread
+JOB_RESULT_TTL = 3600  # seconds to keep finished job results for polling
+STAGE_WORKERS = 16  # threads for the blocking parts of pipeline stages (image work, SQLite, file I/O)
+SSE_KEEPALIVE_INTERVAL = 15  # seconds between keep-alive comments on idle event streams
+JOB_ABANDON_TIMEOUT = 30  # seconds a followed job may go unpolled with no open event stream before it is cancelled; 0 never
+SERVER_THREADS = 32  # threads running ordinary Flask requests under the ASGI server (start.sh); event streams need none
+
+# Admission Control Settings
+MAX_PENDING_JOBS = 100  # unfinished generation jobs; further requests get 429 with Retry-After
+MAX_JOBS_PER_CLIENT = 3  # unfinished jobs per client address; 0 for no limit
+CLIENT_ADDRESS_HEADER = None  # e.g. 'X-Forwarded-For' behind a trusted reverse proxy; the peer address otherwise
+ADMISSION_MAX_WAIT = 90  # seconds a new job may expect to wait in ComfyUI's queue; keep below MAX_WAIT_TIME
+ADMISSION_SAMPLE_SECONDS = 20  # assumed ComfyUI run time per image until prompts have been timed
+QUEUE_POSITION_INTERVAL = 2  # seconds between queue position updates on job event streams
+
+# Logging Settings
+LOG_LEVEL = 'INFO'  # DEBUG for per-prompt output details
+LOG_FORMAT = 'text'  # 'json' for one JSON object per line
 
 # File Settings
 MAX_UPLOAD_SIZE = 16 * 1024 * 1024  # 16MB
+PHOTO_UPLOAD_MAX_BYTES = 10 * 1024 * 1024  # per photo; larger parts are rejected while still streaming in
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
 # Directory Settings
 UPLOAD_FOLDER = 'uploads'
 GENERATED_FOLDER = '/home/ut/3Git/ComfyUI/output'
+COMFY_OUTPUT_DIR = '/home/ut/3Git/ComfyUI/output/adventure'  # where the workflow's SaveImage node writes
+OUTPUT_SCAN_INTERVAL = 1  # seconds between directory scans when inotify_simple is not installed
+OUTPUT_FILE_GRACE = 5  # seconds to wait for a finished prompt's file to appear locally
+DATA_FOLDER = 'data'  # local state (indexes and caches)
+GALLERY_INDEX_PATH = DATA_FOLDER + '/gallery.sqlite3'
+
+# Retention Settings (0 = no cap); pinned portraits and photos of unfinished jobs are never removed
+UPLOAD_RETENTION_MAX_BYTES = 1024 * 1024 * 1024  # 1GB of uploaded photos
+UPLOAD_RETENTION_MAX_AGE = 7 * 24 * 3600  # seconds since a photo was last uploaded
+OUTPUT_RETENTION_MAX_BYTES = 20 * 1024 * 1024 * 1024  # 20GB of portraits in COMFY_OUTPUT_DIR
+OUTPUT_RETENTION_MAX_AGE = 0  # seconds since a portrait was generated or last viewed or downloaded
+RETENTION_INTERVAL = 10  # seconds between retention passes
+RETENTION_BATCH = 50  # most files one pass deletes per folder
+
+# Photo Normalization Settings
+PHOTO_CACHE_DIR = DATA_FOLDER + '/photos'
+PHOTO_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 256MB
+PHOTO_MAX_EDGE = 1024  # longest side, in pixels, of the photo sent to the vision model and ComfyUI
+PHOTO_JPEG_QUALITY = 90
+PHOTO_FACE_CROP = True  # crop ComfyUI's copy to the face (needs opencv-python; skipped without it)
+PHOTO_FACE_MARGIN = 2.5  # crop side as a multiple of the detected face size
+
+# Vision Cache Settings
+VISION_CACHE_PATH = DATA_FOLDER + '/vision_cache.sqlite3'
+VISION_CACHE_MAX_ENTRIES = 5000
+VISION_CACHE_TTL = 7 * 24 * 3600  # seconds
+VISION_CACHE_PHASH_DISTANCE = 4  # max differing bits for a near-duplicate hit; 0 = exact matches only
+
+# Result Cache Settings
+RESULT_CACHE_PATH = DATA_FOLDER + '/results.sqlite3'
+RESULT_CACHE_MAX_ENTRIES = 10000
+RESULT_CACHE_TTL = 30 * 24 * 3600  # seconds
+MAX_SEED = 2 ** 32 - 1
+
+# Workflow Settings
+WORKFLOW_DIR = 'workflows'  # API-format workflow files with patch points
+DEFAULT_WORKFLOW = 'adventure'
+WORKFLOW_RELOAD_INTERVAL = 2  # seconds between checks for edited workflow files
+
+# Gallery Settings
+GALLERY_PAGE_SIZE = 48
+GALLERY_MAX_PAGE_SIZE = 500
+HASH_CACHE_ENTRIES = 50000  # memoized file content hashes
+
+# Image Variant Settings (thumbnails, WebP transcodes, pixel-art upscales)
+VARIANT_CACHE_DIR = DATA_FOLDER + '/variants'
+VARIANT_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 512MB
+VARIANT_WIDTHS = (128, 256, 512, 1024, 2048)  # allowed ?w= values
+VARIANT_MAX_UPSCALE = 4  # largest nearest-neighbour upscale factor
+VARIANT_PREWARM = [(256, 'webp')]  # (width, format) rendered as soon as a new output lands
+VARIANT_WORKERS = 2
+
+# Image Serving
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600  # outputs never change once written
+USE_X_SENDFILE = False  # let Apache/lighttpd (mod_xsendfile) send image bodies
@@ -0,0 +1,145 @@
+# Persistent SQLite index of generated images, kept in sync by the output watcher
+
+import base64
+import os
+import sqlite3
+import threading
+import time
+
+
+def encode_cursor(ctime, filename):
+    return base64.urlsafe_b64encode(f"{ctime!r}|{filename}".encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return (ctime, filename) for a cursor from encode_cursor, or None if it is malformed"""
+    try:
+        ctime, filename = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|', 1)
+        return float(ctime), filename
+    except Exception:
+        return None
+
+
+class GalleryIndex:
+    """Gallery listing that costs O(page) per request instead of O(directory).
+
+    Every insert or delete bumps a monotonically increasing version stored on
+    the row ('changed'), which doubles as the delta cursor for ?since= and as
+    the ETag of the listing. Deleted images are kept as tombstones so delta
+    refreshes can report removals. Pinned images are kept in their own
+    table, mirrored in memory so retention can ask about every candidate.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS images (
+                filename TEXT PRIMARY KEY,
+                ctime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                changed INTEGER NOT NULL
+            )''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS images_by_time ON images (deleted, ctime, filename)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS images_by_change ON images (changed)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS pins (filename TEXT PRIMARY KEY, pinned_at REAL NOT NULL)')
+            self._pins = {row[0] for row in self._db.execute('SELECT filename FROM pins')}
+            self.version = self._db.execute('SELECT COALESCE(MAX(changed), 0) FROM images').fetchone()[0]
+
+    def on_watcher_event(self, event, filename, info):
+        """OutputWatcher subscriber"""
+        if event == 'created':
+            self.add(filename, *info)
+        elif event == 'deleted':
+            self.remove(filename)
+        elif event == 'synced':
+            self.retain(info)
+
+    def add(self, filename, ctime, size):
+        with self._lock:
+            row = self._db.execute('SELECT ctime, size, deleted FROM images WHERE filename = ?',
+                                   (filename,)).fetchone()
+            if row == (ctime, size, 0):
+                return
+            self.version += 1
+            self._db.execute('''INSERT INTO images (filename, ctime, size, deleted, changed)
+                                VALUES (?, ?, ?, 0, ?)
+                                ON CONFLICT(filename) DO UPDATE SET
+                                    ctime = excluded.ctime, size = excluded.size,
+                                    deleted = 0, changed = excluded.changed''',
+                             (filename, ctime, size, self.version))
+
+    def remove(self, filename):
+        with self._lock:
+            self._mark_deleted([filename])
+
+    def retain(self, filenames):
+        """Tombstone every live row whose file is no longer present"""
+        with self._lock:
+            live = [row[0] for row in self._db.execute('SELECT filename FROM images WHERE deleted = 0')]
+            self._mark_deleted([name for name in live if name not in filenames])
+
+    def _mark_deleted(self, filenames):
+        for filename in filenames:
+            self.version += 1
+            self._db.execute('UPDATE images SET deleted = 1, changed = ? WHERE filename = ? AND deleted = 0',
+                             (self.version, filename))
+
+    def pin(self, filename):
+        """Keep filename out of retention's reach until unpinned"""
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO pins (filename, pinned_at) VALUES (?, ?)', (filename, time.time()))
+            self._pins.add(filename)
+
+    def unpin(self, filename):
+        with self._lock:
+            self._db.execute('DELETE FROM pins WHERE filename = ?', (filename,))
+            self._pins.discard(filename)
+
+    def is_pinned(self, filename):
+        return filename in self._pins
+
+    def pinned(self):
+        with self._lock:
+            return sorted(self._pins)
+
+    def page(self, limit, cursor=None):
+        """Newest-first page of filenames; returns (filenames, next_cursor)"""
+        position = decode_cursor(cursor) if cursor else None
+        with self._lock:
+            if position:
+                rows = self._db.execute('''SELECT filename, ctime FROM images
+                                           WHERE deleted = 0 AND (ctime < ? OR (ctime = ? AND filename < ?))
+                                           ORDER BY ctime DESC, filename DESC LIMIT ?''',
+                                        (position[0], position[0], position[1], limit + 1)).fetchall()
+            else:
+                rows = self._db.execute('''SELECT filename, ctime FROM images WHERE deleted = 0
+                                           ORDER BY ctime DESC, filename DESC LIMIT ?''',
+                                        (limit + 1,)).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+        return [row[0] for row in rows], next_cursor
+
+    def changes(self, since, limit):
+        """Images added and removed after version `since`; returns (added, removed, version, more)"""
+        with self._lock:
+            rows = self._db.execute('''SELECT filename, deleted, changed FROM images
+                                       WHERE changed > ? ORDER BY changed LIMIT ?''',
+                                    (since, limit + 1)).fetchall()
+            version = self.version
+        more = len(rows) > limit
+        if more:
+            rows = rows[:limit]
+            version = rows[-1][2]
+        # Newest additions first, to match the page ordering
+        added = [row[0] for row in reversed(rows) if not row[1]]
+        removed = [row[0] for row in rows if row[1]]
+        return added, removed, version, more
@@ -0,0 +1,36 @@
+# Content hashing helpers shared by the caches
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import config
+
+_hash_cache = OrderedDict()  # (path, size, mtime_ns) -> sha256 hex
+_hash_lock = threading.Lock()
+
+
+def sha256_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_sha256(path):
+    """SHA-256 of a file's contents, memoized on (path, size, mtime) so repeat calls only stat"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        digest = _hash_cache.get(key)
+        if digest:
+            _hash_cache.move_to_end(key)
+            return digest
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _hash_lock:
+        _hash_cache[key] = digest
+        while len(_hash_cache) > config.HASH_CACHE_ENTRIES:
+            _hash_cache.popitem(last=False)
+    return digest
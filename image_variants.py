@@ -0,0 +1,137 @@
+# On-demand thumbnails, transcodes and pixel-art upscales of generated images
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import config
+from hashing import file_sha256
+
+log = logging.getLogger(__name__)
+
+VARIANT_FORMATS = {
+    'png': ('PNG', 'image/png', {'optimize': True}),
+    'webp': ('WEBP', 'image/webp', {'quality': 85, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True}),
+}
+if 'AVIF' in Image.SAVE:
+    VARIANT_FORMATS['avif'] = ('AVIF', 'image/avif', {'quality': 60})
+
+
+class UndecodableImage(Exception):
+    """Raised when a variant's source cannot be read as an image"""
+
+
+class VariantCache:
+    """Size-bounded on-disk LRU of derived images.
+
+    Entries are keyed by the source's content hash plus the variant
+    parameters, so a variant never goes stale and identical outputs share it.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._entries = OrderedDict()  # filename -> size, least recently used first
+        self._total = 0
+        self._lock = threading.Lock()
+        self._building = {}  # filename -> threading.Lock, so each variant is rendered once
+        self._executor = ThreadPoolExecutor(max_workers=config.VARIANT_WORKERS, thread_name_prefix='variant')
+        self._load()
+
+    def _load(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._total += size
+
+    def get(self, source_path, width=None, fmt='png'):
+        """Path and mimetype of the variant, rendering it on a miss; raises UndecodableImage"""
+        pil_format, mimetype, _ = VARIANT_FORMATS[fmt]
+        key = hashlib.sha256(f"{file_sha256(source_path)}:w={width}:{fmt}".encode()).hexdigest()[:40]
+        path = self._cached(f"{key}.{fmt}", lambda path: self._render(source_path, path, width, fmt))
+        return path, mimetype
+
+    def _cached(self, name, render):
+        """Path of entry name, calling render(path) once to create it on a miss"""
+        path = os.path.join(self.directory, name)
+
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                return path
+            build_lock = self._building.setdefault(name, threading.Lock())
+
+        with build_lock:
+            try:
+                with self._lock:
+                    hit = name in self._entries
+                if not hit:
+                    try:
+                        render(path)
+                    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+                        # Undecodable or truncated source; drop whatever the render left half-written
+                        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+                        raise UndecodableImage(str(e)) from e
+                    size = os.path.getsize(path)
+                    with self._lock:
+                        self._entries[name] = size
+                        self._total += size
+                        self._evict()
+            finally:
+                with self._lock:
+                    self._building.pop(name, None)
+        return path
+
+    def _render(self, source_path, path, width, fmt):
+        pil_format, _, save_options = VARIANT_FORMATS[fmt]
+        with Image.open(source_path) as image:
+            image.load()
+            if width and width < image.width:
+                height = max(1, round(image.height * width / image.width))
+                # Exact integer reductions keep pixel-art edges crisp
+                resample = Image.Resampling.NEAREST if image.width % width == 0 else Image.Resampling.LANCZOS
+                image = image.resize((width, height), resample)
+            elif width and width > image.width:
+                # Upscale by a whole-number factor with nearest neighbour so pixels stay square
+                factor = min(width // image.width, config.VARIANT_MAX_UPSCALE)
+                if factor > 1:
+                    image = image.resize((image.width * factor, image.height * factor), Image.Resampling.NEAREST)
+            if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            image.save(tmp_path, pil_format, **save_options)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def prewarm(self, source_path):
+        """Render the configured default variants for a new output in the background"""
+        for width, fmt in config.VARIANT_PREWARM:
+            self._executor.submit(self._prewarm_one, source_path, width, fmt)
+
+    def _prewarm_one(self, source_path, width, fmt):
+        try:
+            self.get(source_path, width, fmt)
+        except Exception as e:
+            log.error("Variant pre-generation error for %s: %s", source_path, e)
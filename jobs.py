@@ -0,0 +1,328 @@
+# Background job subsystem for long-running character generations
+
+import asyncio
+import logging
+import threading
+import time
+import uuid
+
+import config
+import logs
+from aio import EventLoopThread, LoopEvent
+from metrics import Histogram, register_collector
+
+log = logging.getLogger(__name__)
+
+JOB_SECONDS = Histogram('adventure_job_seconds', 'Job run time from start to finish', ['kind', 'status'])
+JOB_QUEUE_SECONDS = Histogram('adventure_job_queue_seconds', 'Time jobs wait for a worker', ['kind'])
+
+
+TERMINAL_EVENTS = ('done', 'failed', 'cancelled')  # the last event a job publishes
+
+
+class JobError(Exception):
+    """Raised by a pipeline to fail its job with a user-facing message"""
+
+
+class Job:
+    def __init__(self, kind='generate', priority='interactive'):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.priority = priority  # interactive | batch | background, for the ComfyUI prompt scheduler
+        self.status = 'queued'  # queued -> running -> completed | failed | cancelled
+        self.stage = 'queued'
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.timings = {}  # stage name -> seconds
+        self.outputs = []  # output images the job hands out, kept from retention while the job is remembered
+        self.watchers = 0  # open event streams
+        self.last_seen = None  # last status poll, or when the last event stream closed; None until followed
+        self._task = None  # the pipeline's asyncio task, once it has started
+        self._cancel_reason = None  # set by JobManager.cancel()
+        self._events = []  # (seq, event, data) for streaming subscribers
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._listeners = []  # LoopEvents of event streams waiting on the event loop
+        self._done_callbacks = []
+
+    @property
+    def done(self):
+        return self.status in ('completed', 'failed', 'cancelled')
+
+    def touch(self):
+        """Note that a client is still following the job"""
+        self.last_seen = time.monotonic()
+
+    def add_watcher(self):
+        with self._lock:
+            self.watchers += 1
+            self.last_seen = time.monotonic()
+
+    def remove_watcher(self):
+        with self._lock:
+            self.watchers -= 1
+            self.last_seen = time.monotonic()
+
+    def abandoned(self, timeout):
+        """True once a client that followed the unfinished job has not done so for timeout seconds.
+
+        Jobs nobody has polled or streamed yet (submit-and-check-later API
+        clients, bulk work) are never abandoned.
+        """
+        with self._lock:
+            return (not self.done and not self.watchers and self.last_seen is not None
+                    and time.monotonic() - self.last_seen > timeout)
+
+    def _publish_locked(self, event, data):
+        self._events.append((len(self._events) + 1, event, data))
+        self._changed.notify_all()
+        for listener in self._listeners:
+            listener.set()
+
+    def publish(self, event, data):
+        """Append an event for /jobs/<id>/events subscribers"""
+        with self._lock:
+            self._publish_locked(event, data)
+
+    def events_after(self, seq, timeout):
+        """Events with sequence number > seq, waiting up to timeout for new ones"""
+        with self._lock:
+            if len(self._events) <= seq and not self.done:
+                self._changed.wait(timeout)
+            return self._events[seq:]
+
+    def past_end(self, seq):
+        """True once the job is done and seq is at or beyond its final event, so no event will follow"""
+        with self._lock:
+            return self.done and len(self._events) <= seq
+
+    async def events_after_async(self, seq, timeout):
+        """events_after() for coroutines"""
+        with self._lock:
+            if len(self._events) > seq or self.done:
+                return self._events[seq:]
+            listener = LoopEvent()
+            self._listeners.append(listener)
+        try:
+            await listener.wait(timeout)
+        finally:
+            with self._lock:
+                self._listeners.remove(listener)
+        with self._lock:
+            return self._events[seq:]
+
+    def set_stage(self, stage, progress=None):
+        """Record the pipeline stage the job has reached"""
+        with self._lock:
+            self.stage = stage
+            if progress is not None:
+                # Stages can run concurrently, so never move the bar backwards
+                self.progress = max(self.progress, progress)
+            self._publish_locked('stage', {'stage': stage, 'progress': round(self.progress, 3)})
+
+    def set_progress(self, progress, **detail):
+        """Move the progress bar within the current stage"""
+        with self._lock:
+            self.progress = max(self.progress, progress)
+            self._publish_locked('progress', dict(detail, stage=self.stage, progress=round(self.progress, 3)))
+
+    def add_done_callback(self, fn):
+        """Call fn(job) once the job has finished (completed, failed or cancelled); right away if it already has"""
+        with self._lock:
+            if not self.done:
+                self._done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def _run_done_callbacks(self):
+        with self._lock:
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                log.exception("Job done callback failed: %s", e)
+
+    def record_timing(self, stage, seconds):
+        with self._lock:
+            self.timings[stage] = round(seconds, 3)
+
+    def start(self):
+        with self._lock:
+            self.status = 'running'
+            self.started_at = time.time()
+
+    def finish(self, result):
+        with self._lock:
+            self.status = 'completed'
+            self.stage = 'completed'
+            self.progress = 1.0
+            self.result = result
+            self.finished_at = time.time()
+            self._publish_locked('done', result)
+        self._run_done_callbacks()
+
+    def fail(self, error):
+        with self._lock:
+            self.status = 'failed'
+            self.error = error
+            self.finished_at = time.time()
+            self._publish_locked('failed', {'error': error})
+        self._run_done_callbacks()
+
+    def cancelled(self, reason):
+        with self._lock:
+            self.status = 'cancelled'
+            self.error = reason
+            self.finished_at = time.time()
+            self._publish_locked('cancelled', {'reason': reason})
+        self._run_done_callbacks()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'kind': self.kind,
+                'priority': self.priority,
+                'status': self.status,
+                'stage': self.stage,
+                'progress': round(self.progress, 3),
+                'result': self.result,
+                'error': self.error,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'timings': dict(self.timings),
+            }
+
+
+class JobManager:
+    """Runs pipeline coroutines on the job loop and keeps their status for polling.
+
+    At most max_workers pipelines are in progress at once; the rest wait
+    their turn as queued. A pipeline waiting on Ollama or ComfyUI is a
+    suspended coroutine rather than a parked thread, so the limit is about
+    how much work to keep in the backends' queues, not about threads.
+
+    cancel() stops a job wherever its pipeline is waiting. A job whose
+    client polled or streamed it and then went quiet for abandon_timeout
+    seconds is cancelled too, so a closed tab does not keep the backends
+    busy; a job that was never followed runs to the end.
+    """
+
+    def __init__(self, max_workers=None, result_ttl=None, abandon_timeout=None):
+        self.max_workers = max_workers or config.JOB_WORKERS
+        self.result_ttl = result_ttl or config.JOB_RESULT_TTL
+        self.abandon_timeout = abandon_timeout if abandon_timeout is not None else config.JOB_ABANDON_TIMEOUT
+        self._loop = EventLoopThread('job-loop')
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._jobs = {}
+        self._outputs = {}  # output filename -> remembered jobs handing it out
+        self._lock = threading.Lock()
+        register_collector(self._collect)
+        if self.abandon_timeout:
+            self._loop.submit(self._cancel_abandoned())
+
+    def submit(self, fn, *args, kind='generate', priority='interactive', **kwargs):
+        """Queue the coroutine fn(job, *args, **kwargs) on the job loop and return the new Job"""
+        job = Job(kind=kind, priority=priority)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        log.info("Job queued", extra={'job': job.id, 'kind': kind, 'priority': priority})
+        # The task inherits the submitting request's id for its log lines
+        self._loop.submit(self._run(job, fn, args, kwargs))
+        return job
+
+    def cancel(self, job, reason='Cancelled'):
+        """Cancel an unfinished job's pipeline; it finishes as cancelled once its stages have unwound.
+
+        Returns False if the job had already finished.
+        """
+        if job.done:
+            return False
+        log.info("Cancelling job: %s", reason, extra={'job': job.id})
+        job._cancel_reason = reason
+        self._loop.loop.call_soon_threadsafe(self._cancel_task, job)
+        return True
+
+    @staticmethod
+    def _cancel_task(job):
+        # A task that has not taken its first step yet sees _cancel_reason when it does
+        if job._task:
+            job._task.cancel()
+
+    async def _cancel_abandoned(self):
+        while True:
+            await asyncio.sleep(1)
+            with self._lock:
+                abandoned = [job for job in self._jobs.values() if job.abandoned(self.abandon_timeout)]
+            for job in abandoned:
+                self.cancel(job, 'Abandoned by the client')
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def add_outputs(self, job, filenames):
+        """Record output images in job's result; they count as in use until the job is forgotten"""
+        with self._lock:
+            for filename in filenames:
+                job.outputs.append(filename)
+                self._outputs[filename] = self._outputs.get(filename, 0) + 1
+
+    def uses_output(self, filename):
+        """True while an unfinished job, or a finished one still kept for polling, hands out filename"""
+        with self._lock:
+            return filename in self._outputs
+
+    async def _run(self, job, fn, args, kwargs):
+        token = logs.job_id.set(job.id)
+        job._task = asyncio.current_task()
+        try:
+            if job._cancel_reason:
+                raise asyncio.CancelledError
+            async with self._slots:
+                job.start()
+                JOB_QUEUE_SECONDS.observe(job.started_at - job.created_at, kind=job.kind)
+                try:
+                    job.finish(await fn(job, *args, **kwargs))
+                    log.info("Job completed", extra={'kind': job.kind,
+                                                     'seconds': round(job.finished_at - job.started_at, 3)})
+                except JobError as e:
+                    log.warning("Job failed: %s", e, extra={'kind': job.kind})
+                    job.fail(str(e))
+                except Exception as e:
+                    log.exception("Job error: %s", e)
+                    job.fail(str(e))
+        except asyncio.CancelledError:
+            # Raised wherever the pipeline was waiting, or while it waited for a slot
+            job.cancelled(job._cancel_reason or 'Cancelled')
+            log.info("Job cancelled", extra={'kind': job.kind})
+        finally:
+            JOB_SECONDS.observe(job.finished_at - (job.started_at or job.created_at), kind=job.kind, status=job.status)
+            logs.job_id.reset(token)
+
+    def _collect(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                if not job.done:
+                    counts[(job.kind, job.status)] = counts.get((job.kind, job.status), 0) + 1
+        return [('adventure_jobs', 'gauge', 'Jobs queued or running',
+                 [({'kind': kind, 'status': status}, count) for (kind, status), count in counts.items()])]
+
+    def _prune(self):
+        """Forget finished jobs whose results are older than result_ttl"""
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.done and job.finished_at < cutoff]
+        for job_id in expired:
+            for filename in self._jobs.pop(job_id).outputs:
+                count = self._outputs.pop(filename) - 1
+                if count:
+                    self._outputs[filename] = count
@@ -0,0 +1,74 @@
+# Leveled, structured logging that tags every record with the current request and job id
+
+import contextvars
+import json
+import logging
+
+import config
+
+request_id = contextvars.ContextVar('request_id', default=None)
+job_id = contextvars.ContextVar('job_id', default=None)
+
+# Attributes every LogRecord has; anything else came in through extra={...}
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class ContextFilter(logging.Filter):
+    """Copies the request/job ids of the code doing the logging onto the record"""
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        record.job_id = job_id.get()
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    """time LEVEL logger [request=.. job=..] message key=value ..."""
+
+    def format(self, record):
+        ids = ' '.join(f"{name}={value}" for name, value in
+                       (('request', record.request_id), ('job', record.job_id)) if value)
+        extra = ' '.join(f"{key}={value}" for key, value in _extra(record).items())
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}"
+        line += f" [{ids}]" if ids else ''
+        line += f" {record.getMessage()}"
+        line += f" {extra}" if extra else ''
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': record.request_id,
+            'job_id': record.job_id,
+        }
+        entry.update(_extra(record))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _extra(record):
+    return {key: value for key, value in vars(record).items()
+            if key not in _STANDARD_ATTRS and key not in ('request_id', 'job_id')}
+
+
+def setup_logging(level=None, fmt=None):
+    """Route all logging to stderr with config.LOG_LEVEL and config.LOG_FORMAT ('text' or 'json')"""
+    handler = logging.StreamHandler()
+    handler.addFilter(ContextFilter())
+    handler.setFormatter(JsonFormatter() if (fmt or config.LOG_FORMAT) == 'json' else TextFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level or config.LOG_LEVEL)
+    # Library internals (connection pool chatter, plugin imports) stay out of DEBUG output
+    for noisy in ('PIL', 'urllib3'):
+        logging.getLogger(noisy).setLevel(logging.INFO)
@@ -0,0 +1,190 @@
+# Batches Ollama calls per model so a single inference box is not reloading models on every request
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import config
+
+
+class CallAbandoned(Exception):
+    """The caller stopped waiting, so the reply was cut off"""
+
+
+class ModelCall:
+    def __init__(self, model, kwargs):
+        self.model = model
+        self.kwargs = kwargs
+        self.future = Future()
+        self.on_chunk = None
+        self.enqueued_at = time.monotonic()
+        self.abandoned = threading.Event()  # set when an awaiting coroutine was cancelled
+
+
+class ModelScheduler:
+    """Serializes chat calls around a shared ollama Client, grouped by model.
+
+    While a model is resident, queued calls for it are released (up to
+    `parallel` at a time) before any other model is loaded; a model is only
+    swapped out once its in-flight calls have drained, and after `max_batch`
+    consecutive calls if another model is waiting, so neither side starves.
+    keep_alive is chosen from the queue: keep the model while more work for it
+    is queued, unload it immediately when a different model is waiting next,
+    and fall back to idle_keep_alive when the queue is empty.
+
+    Replies are always streamed from Ollama, so a call whose caller has gone
+    away is cut off at the next chunk instead of generating to the end.
+    """
+
+    def __init__(self, client, parallel=None, max_batch=None, idle_keep_alive=None):
+        self.client = client
+        self.parallel = parallel or config.OLLAMA_PARALLEL
+        self.max_batch = max_batch or config.OLLAMA_MAX_BATCH
+        self.idle_keep_alive = idle_keep_alive if idle_keep_alive is not None else config.OLLAMA_IDLE_KEEP_ALIVE
+        self._pending = {}  # model -> deque of ModelCall
+        self._cond = threading.Condition()
+        self._active_model = None
+        self._in_flight = 0
+        self._batch_served = 0
+        self.calls = 0
+        self.abandoned = 0
+        self.swaps = 0
+        self.load_seconds = 0.0
+        self.wait_seconds = 0.0
+        for i in range(self.parallel):
+            threading.Thread(target=self._worker, name=f'ollama-{i}', daemon=True).start()
+
+    def chat(self, model, on_chunk=None, **kwargs):
+        """Drop-in for Client.chat(model=..., ...) that waits for the model's turn.
+
+        With on_chunk the reply is streamed: on_chunk(text) is called for each
+        piece as Ollama produces it, and the assembled response is returned.
+        The model stays marked in flight until the stream is finished.
+        """
+        return self._enqueue(model, on_chunk, kwargs).future.result()
+
+    async def chat_async(self, model, on_chunk=None, **kwargs):
+        """chat() for coroutines: the caller awaits its turn and the reply without holding a thread.
+
+        Only the `parallel` worker threads ever block on Ollama, however many
+        calls are waiting. Cancelling a call that has not started drops it;
+        one that is running is cut off at its next chunk.
+        """
+        call = self._enqueue(model, on_chunk, kwargs)
+        try:
+            return await asyncio.wrap_future(call.future)
+        except asyncio.CancelledError:
+            call.abandoned.set()
+            raise
+
+    def _enqueue(self, model, on_chunk, kwargs):
+        call = ModelCall(model, kwargs)
+        call.on_chunk = on_chunk
+        with self._cond:
+            self._pending.setdefault(model, deque()).append(call)
+            self._cond.notify_all()
+        return call
+
+    def _others_waiting(self, model):
+        return any(queue for other, queue in self._pending.items() if other != model)
+
+    def _next_call(self):
+        """Pick the next call under the residency rules; caller holds self._cond"""
+        while True:
+            # Calls cancelled while queued must not keep a model resident or force a swap
+            for model, queue in self._pending.items():
+                if any(call.future.cancelled() for call in queue):
+                    self._pending[model] = deque(call for call in queue if not call.future.cancelled())
+            active_queue = self._pending.get(self._active_model)
+            if active_queue and (self._batch_served < self.max_batch
+                                 or not self._others_waiting(self._active_model)):
+                self._batch_served += 1
+                return active_queue.popleft()
+            waiting = [queue for queue in self._pending.values() if queue]
+            if waiting and self._in_flight == 0:
+                # Swap to the model whose oldest call has waited longest
+                next_model = min(waiting, key=lambda queue: queue[0].enqueued_at)[0].model
+                if self._active_model is not None and next_model != self._active_model:
+                    self.swaps += 1
+                self._active_model = next_model
+                self._batch_served = 0
+                continue
+            self._cond.wait()
+
+    def _keep_alive(self, model):
+        if self._pending.get(model):
+            return config.OLLAMA_BATCH_KEEP_ALIVE
+        if self._others_waiting(model):
+            return 0
+        return self.idle_keep_alive
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                call = self._next_call()
+                self._in_flight += 1
+                keep_alive = self._keep_alive(call.model)
+                self.wait_seconds += time.monotonic() - call.enqueued_at
+            if not call.future.set_running_or_notify_cancel():
+                self._release()
+                continue
+            try:
+                response = self._stream(call, keep_alive)
+                self._record(response)
+                call.future.set_result(response)
+            except CallAbandoned as e:
+                with self._cond:
+                    self.abandoned += 1
+                call.future.set_exception(e)
+            except Exception as e:
+                call.future.set_exception(e)
+            finally:
+                self._release()
+
+    def _stream(self, call, keep_alive):
+        parts = []
+        response = None
+        chunks = self.client.chat(model=call.model, keep_alive=keep_alive, stream=True, **call.kwargs)
+        try:
+            for response in chunks:
+                if call.abandoned.is_set():
+                    raise CallAbandoned(f"{call.model} call abandoned after {len(parts)} chunks")
+                text = response['message']['content']
+                if text:
+                    parts.append(text)
+                    if call.on_chunk:
+                        call.on_chunk(text)
+        finally:
+            # Closing the stream drops the connection, which stops Ollama generating
+            chunks.close()
+        # The final chunk carries the timings; give it the whole reply
+        response['message']['content'] = ''.join(parts)
+        return response
+
+    def _record(self, response):
+        load_duration = response.get('load_duration') if hasattr(response, 'get') else None
+        with self._cond:
+            self.calls += 1
+            if load_duration:
+                self.load_seconds += load_duration / 1e9
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            pending = {model: len(queue) for model, queue in self._pending.items() if queue}
+            active_model = self._active_model
+        return {
+            'active_model': active_model,
+            'pending': pending,
+            'calls': self.calls,
+            'abandoned': self.abandoned,
+            'swaps': self.swaps,
+            'load_seconds': round(self.load_seconds, 3),
+            'queue_wait_seconds': round(self.wait_seconds, 3),
+        }
@@ -0,0 +1,195 @@
+# Process-wide watcher for the ComfyUI output directory
+
+import logging
+import os
+import threading
+import time
+
+import config
+from aio import LoopEvent
+
+log = logging.getLogger(__name__)
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+class OutputWatcher:
+    """Keeps a live in-memory view of finished images in one directory.
+
+    Uses inotify when inotify_simple is installed (Linux), otherwise an
+    incremental os.scandir loop that only stats entries it has not seen yet.
+    """
+
+    def __init__(self, directory, extensions=IMAGE_EXTENSIONS):
+        self.directory = directory
+        self.extensions = extensions
+        self._files = {}  # filename -> (ctime, size), only fully written files
+        self._pending = {}  # filename -> size seen on the previous scan (polling mode)
+        self._waiters = {}  # filename -> [LoopEvent] of waiting coroutines
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='output-watcher', daemon=True)
+        self._thread.start()
+
+    def subscribe(self, callback):
+        """Register callback(event, filename, info) for 'created' and 'deleted' events.
+
+        After each full resync a 'synced' event is sent with filename None and
+        info set to the names currently present, so listeners can drop stale entries.
+        """
+        self._subscribers.append(callback)
+
+    def _wanted(self, name):
+        return name.lower().endswith(self.extensions) and not name.startswith('.')
+
+    def _run(self):
+        while True:
+            if not os.path.isdir(self.directory):
+                log.debug("Output dir not found locally: %s", self.directory)
+                self._ready.set()
+                time.sleep(config.OUTPUT_SCAN_INTERVAL * 10)
+                continue
+            try:
+                if INotify is not None:
+                    self._watch_inotify()
+                else:
+                    self._watch_polling()
+            except Exception as e:
+                log.error("Output watcher error: %s", e)
+                time.sleep(config.OUTPUT_SCAN_INTERVAL)
+
+    def _watch_inotify(self):
+        inotify = INotify()
+        mask = (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.DELETE
+                | inotify_flags.MOVED_FROM | inotify_flags.DELETE_SELF)
+        inotify.add_watch(self.directory, mask)
+        try:
+            # Watch first, then scan, so nothing written in between is missed
+            self._scan(require_stable=False, announce=True)
+            self._ready.set()
+            while True:
+                for event in inotify.read():
+                    if event.mask & (inotify_flags.Q_OVERFLOW | inotify_flags.IGNORED):
+                        self._scan(require_stable=False, announce=True)
+                        if event.mask & inotify_flags.IGNORED:
+                            return
+                    elif not self._wanted(event.name):
+                        continue
+                    elif event.mask & (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO):
+                        self._add(event.name)
+                    elif event.mask & (inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+                        self._remove(event.name)
+        finally:
+            inotify.close()
+
+    def _watch_polling(self):
+        self._scan(require_stable=False, announce=True)
+        self._ready.set()
+        while os.path.isdir(self.directory):
+            time.sleep(config.OUTPUT_SCAN_INTERVAL)
+            self._scan(require_stable=True)
+
+    def _scan(self, require_stable, announce=False):
+        """Sync the in-memory view with the directory, statting only unseen entries.
+
+        With require_stable a new file is only reported once its size has not
+        changed between two scans, so half-written PNGs are never handed out.
+        """
+        seen = set()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if not self._wanted(name):
+                    continue
+                seen.add(name)
+                if name in self._files:
+                    continue
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    continue
+                if require_stable and self._pending.get(name) != size:
+                    self._pending[name] = size
+                    continue
+                self._pending.pop(name, None)
+                self._add(name)
+        for name in set(self._files) - seen:
+            self._remove(name)
+        for name in set(self._pending) - seen:
+            del self._pending[name]
+        if announce:
+            with self._lock:
+                present = frozenset(self._files)
+            self._notify('synced', None, present)
+
+    def _add(self, name):
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return
+        info = (stat.st_ctime, stat.st_size)
+        with self._lock:
+            self._files[name] = info
+            waiters = self._waiters.pop(name, [])
+        for event in waiters:
+            event.set()
+        self._notify('created', name, info)
+
+    def _remove(self, name):
+        with self._lock:
+            info = self._files.pop(name, None)
+        if info:
+            self._notify('deleted', name, info)
+
+    def _notify(self, event, name, info):
+        for callback in self._subscribers:
+            try:
+                callback(event, name, info)
+            except Exception as e:
+                log.error("Output watcher subscriber error: %s", e)
+
+    async def wait_for_file_async(self, name, timeout):
+        """Wait until name exists and is fully written; returns its path or None"""
+        event = LoopEvent()
+        if not self._add_waiter(name, event):
+            try:
+                if not await event.wait(timeout):
+                    return None
+            finally:
+                self._remove_waiter(name, event)
+        return os.path.join(self.directory, name)
+
+    def _add_waiter(self, name, event):
+        """Register event to be set when name lands; True if it is already there"""
+        with self._lock:
+            if name in self._files:
+                return True
+            self._waiters.setdefault(name, []).append(event)
+            return False
+
+    def _remove_waiter(self, name, event):
+        with self._lock:
+            waiters = self._waiters.get(name, [])
+            if event in waiters:
+                waiters.remove(event)
+            if not waiters:
+                self._waiters.pop(name, None)
+
+    def files(self):
+        """Filenames sorted newest first"""
+        self._ready.wait(config.OUTPUT_SCAN_INTERVAL * 5)
+        with self._lock:
+            items = list(self._files.items())
+        items.sort(key=lambda item: item[1][0], reverse=True)
+        return [name for name, _ in items]
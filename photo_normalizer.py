@@ -0,0 +1,78 @@
+# Upright, downscaled copies of uploaded photos for the vision model and ComfyUI
+
+import hashlib
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+import config
+from hashing import file_sha256
+from image_variants import VariantCache
+
+try:
+    import cv2
+    import numpy
+except ImportError:
+    cv2 = None
+
+_face_lock = threading.Lock()  # OpenCV cascade classifiers are not safe to share between threads
+_face_detector = None
+
+
+def face_box(image, margin):
+    """Square crop box around the largest face, margin times the face size, or None without a face"""
+    global _face_detector
+    with _face_lock:
+        if _face_detector is None:
+            _face_detector = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        faces = _face_detector.detectMultiScale(numpy.asarray(image.convert('L')),
+                                                scaleFactor=1.1, minNeighbors=5, minSize=(48, 48))
+    if not len(faces):
+        return None
+    x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+    side = min(int(max(w, h) * margin), image.width, image.height)
+    left = min(max(0, x + w // 2 - side // 2), image.width - side)
+    top = min(max(0, y + h // 2 - side // 2), image.height - side)
+    return left, top, left + side, top + side
+
+
+class PhotoNormalizer(VariantCache):
+    """Uploads rotated per EXIF, capped at config.PHOTO_MAX_EDGE and re-encoded as JPEG.
+
+    Entries are keyed by the upload's content hash plus the normalization
+    settings, so the vision model and every ComfyUI backend share one copy and
+    a changed setting simply produces new entries. With OpenCV installed,
+    crop_face=True narrows the photo to a square around the largest face for
+    IPAdapter FaceID; without it, or when no face is found, the whole photo is kept.
+    """
+
+    def normalize(self, source_path, crop_face=False):
+        """Path of the normalized JPEG, rendering it on a miss"""
+        crop_face = crop_face and cv2 is not None
+        settings = f"edge={config.PHOTO_MAX_EDGE}:q={config.PHOTO_JPEG_QUALITY}:face={crop_face and config.PHOTO_FACE_MARGIN}"
+        key = hashlib.sha256(f"{file_sha256(source_path)}:{settings}".encode()).hexdigest()[:40]
+        return self._cached(f"{key}.jpg", lambda path: self._render_photo(source_path, path, crop_face))
+
+    def _render_photo(self, source_path, path, crop_face):
+        edge = config.PHOTO_MAX_EDGE
+        with Image.open(source_path) as image:
+            # Let the JPEG decoder skip detail we are about to throw away
+            image.draft('RGB', (edge, edge))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+            if crop_face:
+                box = face_box(image, config.PHOTO_FACE_MARGIN)
+                if box:
+                    image = image.crop(box)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # Flatten transparency onto white rather than JPEG's black
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            image.save(tmp_path, 'JPEG', quality=config.PHOTO_JPEG_QUALITY, optimize=True)
+        os.replace(tmp_path, path)
@@ -0,0 +1,73 @@
+# Small dependency graph runner for the generation pipeline
+
+import asyncio
+import time
+
+from aio import run_blocking
+from metrics import Histogram
+
+STAGE_SECONDS = Histogram('adventure_stage_seconds', 'Time spent in each generation stage', ['stage'])
+
+
+class Stage:
+    def __init__(self, name, fn, deps=(), progress=None):
+        self.name = name
+        # fn(results) -> value; results maps finished stage names to their values.
+        # An async def is awaited on the job loop, anything else runs on the stage threads.
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.progress = progress
+
+
+def stage_metric_name(name):
+    """Per-item stages such as vision_0, vision_1 share one histogram series"""
+    return name.rstrip('0123456789').rstrip('_') or name
+
+
+async def run_stages(job, stages):
+    """Run stages as soon as their dependencies finish, recording per-stage timings on the job.
+
+    Returns the dict of stage results. The first stage to raise fails the whole
+    run: the other running stages are cancelled and the error re-raised.
+    """
+    results = {}
+    remaining = list(stages)
+    running = {}
+
+    async def timed(stage, inputs):
+        started = time.monotonic()
+        try:
+            if asyncio.iscoroutinefunction(stage.fn):
+                return await stage.fn(inputs)
+            return await run_blocking(stage.fn, inputs)
+        finally:
+            seconds = time.monotonic() - started
+            job.record_timing(stage.name, seconds)
+            STAGE_SECONDS.observe(seconds, stage=stage_metric_name(stage.name))
+
+    while remaining or running:
+        for stage in [s for s in remaining if all(dep in results for dep in s.deps)]:
+            remaining.remove(stage)
+            job.set_stage(stage.name, stage.progress)
+            # Tasks inherit the job's context, so stage log lines carry its id
+            running[asyncio.create_task(timed(stage, dict(results)))] = stage
+        if not running:
+            raise ValueError(f"Unsatisfiable stage dependencies: {[s.name for s in remaining]}")
+
+        try:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # The job was cancelled: stop its stages and let them clean up before going
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise
+        for task in done:
+            stage = running.pop(task)
+            try:
+                results[stage.name] = task.result()
+            except BaseException:
+                for pending in running:
+                    pending.cancel()
+                raise
+    return results
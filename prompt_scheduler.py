@@ -0,0 +1,142 @@
+# Priority scheduling of ComfyUI prompts: a shallow window on each backend, the rest waits here in priority order
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+
+import config
+from metrics import Histogram, register_collector
+
+log = logging.getLogger(__name__)
+
+PRIORITIES = ('interactive', 'batch', 'background')  # most urgent first
+
+PROMPT_WAIT_SECONDS = Histogram('adventure_prompt_wait_seconds', 'Time prompts wait in the app for room on a ComfyUI backend',
+                                ['priority'])
+
+
+class PromptSlot:
+    """Room for one prompt in a backend's queue; give it back with PromptScheduler.release()"""
+
+    def __init__(self, backend, priority):
+        self.backend = backend
+        self.priority = priority
+        self.rank = PRIORITIES.index(priority)
+        self.front = False  # queue with ComfyUI's front flag
+        self.prompt_id = None
+        self.granted = False
+        self.released = False
+
+
+class PromptScheduler:
+    """Releases prompts to each ComfyUI backend a few at a time, most urgent first.
+
+    At most COMFY_QUEUE_WINDOW of our prompts sit in a backend's queue at
+    once, so new work never lands behind a deep backlog there; the rest
+    waits in the app, interactive before batch before background, oldest
+    first within a priority. Interactive prompts get a window of their own
+    on top, and are queued with ComfyUI's `front` flag while lower-priority
+    prompts of ours are still pending on the node, so they run next. As
+    ComfyUI runs front prompts newest first, the flag is left off while an
+    interactive prompt of ours is itself still pending there, which keeps
+    interactive prompts in arrival order.
+
+    acquire() is awaited on the job loop; release() may come from any thread.
+    """
+
+    def __init__(self, window=None):
+        self.window = window or config.COMFY_QUEUE_WINDOW
+        self._outstanding = {}  # host -> slots queued or about to be queued there
+        self._waiting = {}  # host -> heap of (rank, seq, slot, future, loop)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        register_collector(self._collect)
+
+    def _has_room_locked(self, host, rank):
+        outstanding = self._outstanding.get(host, [])
+        if rank == 0:
+            return sum(slot.rank == 0 for slot in outstanding) < self.window
+        return len(outstanding) < self.window
+
+    def _grant_locked(self, slot):
+        outstanding = self._outstanding.setdefault(slot.backend.host, [])
+
+        def pending(other):
+            return not (other.prompt_id and slot.backend.tracker.is_running(other.prompt_id))
+
+        # Only jump the queue past our own less urgent prompts that have not started yet. ComfyUI runs
+        # front prompts newest first, so not while one as urgent is still pending: that one would go second
+        slot.front = (any(other.rank > slot.rank and pending(other) for other in outstanding)
+                      and not any(other.rank <= slot.rank and pending(other) for other in outstanding))
+        outstanding.append(slot)
+        slot.granted = True
+
+    async def acquire(self, backend, priority='interactive'):
+        """Wait until a prompt of this priority may be queued on backend; returns its PromptSlot"""
+        slot = PromptSlot(backend, priority)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        started = loop.time()
+        with self._lock:
+            heapq.heappush(self._waiting.setdefault(backend.host, []), (slot.rank, next(self._seq), slot, future, loop))
+            self._wake_locked(backend.host)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = slot.granted
+            # Granted just as the waiter went away: pass the room on
+            if granted:
+                self.release(slot)
+            raise
+        PROMPT_WAIT_SECONDS.observe(loop.time() - started, priority=priority)
+        return slot
+
+    def release(self, slot):
+        """Give back slot's room once its prompt has finished (or was never queued); safe to repeat"""
+        with self._lock:
+            if slot.released:
+                return
+            slot.released = True
+            outstanding = self._outstanding.get(slot.backend.host, [])
+            if slot in outstanding:
+                outstanding.remove(slot)
+            self._wake_locked(slot.backend.host)
+
+    def _wake_locked(self, host):
+        waiting = self._waiting.get(host, [])
+        while waiting:
+            rank, _, slot, future, loop = waiting[0]
+            if future.cancelled():
+                heapq.heappop(waiting)
+                continue
+            if not self._has_room_locked(host, rank):
+                return
+            heapq.heappop(waiting)
+            self._grant_locked(slot)
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def stats(self):
+        with self._lock:
+            return {host: {
+                'outstanding': len(self._outstanding.get(host, [])),
+                'waiting': {priority: sum(entry[0] == rank and not entry[3].done() for entry in waiting)
+                            for rank, priority in enumerate(PRIORITIES)},
+            } for host, waiting in self._waiting.items()}
+
+    def _collect(self):
+        stats = self.stats()
+        return [
+            ('adventure_prompts_waiting', 'gauge', 'Prompts waiting in the app for room on a ComfyUI backend',
+             [({'host': host, 'priority': priority}, count)
+              for host, backend in stats.items() for priority, count in backend['waiting'].items()]),
+            ('adventure_prompts_outstanding', 'gauge', 'Our prompts queued or running on a ComfyUI backend',
+             [({'host': host}, backend['outstanding']) for host, backend in stats.items()]),
+        ]
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
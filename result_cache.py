@@ -0,0 +1,114 @@
+# Cache of finished generations, keyed by a canonical hash of everything that determines the image
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def canonical_hash(value):
+    """SHA-256 of value as JSON with sorted keys and no whitespace, so equal inputs always hash equally"""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Persistent SQLite map from generation inputs to the output image they produced.
+
+    A result is stored under several keys: the canonical hash of the fully
+    patched workflow, and of the request that led to it, so a repeat request
+    can skip the LLM as well as the sampler. Entries only point at files in
+    the output directory; a hit is checked against the disk and watcher
+    deletions drop the entries for that file, so the cache never serves an
+    image the gallery no longer has. Entries expire after ttl seconds and
+    the least recently used are evicted past max_entries.
+    """
+
+    def __init__(self, path, output_dir, max_entries, ttl):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.output_dir = output_dir
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                description TEXT,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_by_file ON results (filename)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_by_use ON results (last_used)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_by_age ON results (created)')
+
+    def on_watcher_event(self, event, filename, info):
+        """OutputWatcher subscriber"""
+        if event == 'deleted':
+            self.forget(filename)
+        elif event == 'synced':
+            self.retain(info)
+
+    def get(self, key):
+        """{'filename', 'description'} for key if its image still exists, else None"""
+        now = time.time()
+        with self._lock:
+            self._db.execute('DELETE FROM results WHERE created < ?', (now - self.ttl,))
+            row = self._db.execute('SELECT filename, description FROM results WHERE key = ?', (key,)).fetchone()
+            if row and not os.path.exists(os.path.join(self.output_dir, row[0])):
+                self._db.execute('DELETE FROM results WHERE filename = ?', (row[0],))
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE results SET last_used = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return {'filename': row[0], 'description': row[1]}
+
+    def put(self, keys, filename, description=None):
+        now = time.time()
+        with self._lock:
+            self._db.executemany('''INSERT OR REPLACE INTO results (key, filename, description, created, last_used)
+                                    VALUES (?, ?, ?, ?, ?)''',
+                                 [(key, filename, description, now, now) for key in keys])
+            count = self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            if count > self.max_entries:
+                excess = count - self.max_entries
+                self._db.execute('''DELETE FROM results WHERE rowid IN
+                                    (SELECT rowid FROM results ORDER BY last_used LIMIT ?)''', (excess,))
+                self.evictions += excess
+
+    def used_since(self, filename, since):
+        """True if an entry for filename was stored or hit after `since` (a time.time())"""
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM results WHERE filename = ? AND last_used > ? LIMIT 1',
+                                    (filename, since)).fetchone() is not None
+
+    def forget(self, filename):
+        with self._lock:
+            self._db.execute('DELETE FROM results WHERE filename = ?', (filename,))
+
+    def retain(self, names):
+        """Drop entries whose image is not among names (the watcher's full listing)"""
+        with self._lock:
+            stale = [filename for (filename,) in self._db.execute('SELECT DISTINCT filename FROM results')
+                     if filename not in names]
+            self._db.executemany('DELETE FROM results WHERE filename = ?', [(filename,) for filename in stale])
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
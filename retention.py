@@ -0,0 +1,255 @@
+# Background retention: keeps the upload and output folders within size and age caps, least recently used first
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from metrics import register_collector
+
+log = logging.getLogger(__name__)
+
+
+class RetentionFolder:
+    """LRU view of the files in one folder and the caps they are held to.
+
+    A file is due once it has gone unused for max_age seconds, or while the
+    folder is over max_bytes; either cap may be 0 for none. Entries are kept
+    in order of last use (touch()), so sweep() only ever looks at the head.
+    protected(path) is asked before a file is deleted, and a protected file is
+    passed over for now rather than moved, so it goes as soon as it is released.
+    series(filename) may map a file to (series, number) for folders whose
+    writer names a new file after the highest number present (ComfyUI
+    does); the highest-numbered file of each series is then always kept, so
+    its name is never handed out again for a different image.
+
+    Files are either listed by scanning the folder once (load()) or fed from
+    an OutputWatcher (on_watcher_event()), which also reports the deletions.
+    Use is only tracked in memory, so after a restart a file counts as last
+    used when it was last accessed (scanned) or created (watched).
+    """
+
+    def __init__(self, name, directory, max_bytes=0, max_age=0, protected=None, series=None):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.protected = protected or (lambda path: False)
+        self.series = series or (lambda filename: None)
+        self._entries = OrderedDict()  # filename -> (size, last used), least recently used first
+        self._newest = {}  # series -> highest number seen in it
+        self._total = 0
+        self._loaded = False
+        self.scan = False  # listed by load() on the retention thread rather than fed by a watcher
+        self.deleted = 0
+        self.reclaimed_bytes = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """List the folder once, oldest access first; files touched meanwhile keep their place"""
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        stat = entry.stat()
+                        entries.append((max(stat.st_atime, stat.st_mtime), entry.name, stat.st_size))
+        except FileNotFoundError:
+            pass
+        entries.sort()
+        with self._lock:
+            touched, self._entries = self._entries, OrderedDict()
+            for used, name, size in entries:
+                if name not in touched:
+                    self._entries[name] = (size, used)
+            self._entries.update(touched)
+            self._total = sum(size for size, _ in self._entries.values())
+            self._count_series_locked()
+            self._loaded = True
+
+    def on_watcher_event(self, event, filename, info):
+        """OutputWatcher subscriber"""
+        if event == 'created':
+            self._add(filename, info[1], info[0])
+        elif event == 'deleted':
+            self.forget(filename)
+        elif event == 'synced':
+            self.retain(info)
+
+    def _add(self, name, size, used):
+        with self._lock:
+            if name in self._entries:
+                self._total -= self._entries[name][0]
+            self._entries[name] = (size, used)
+            self._total += size
+            self._note_series_locked(name)
+
+    def _note_series_locked(self, name):
+        numbered = self.series(name)
+        if numbered and numbered[1] > self._newest.get(numbered[0], -1):
+            self._newest[numbered[0]] = numbered[1]
+
+    def _count_series_locked(self):
+        self._newest = {}
+        for name in self._entries:
+            self._note_series_locked(name)
+
+    def _newest_in_series_locked(self, name):
+        numbered = self.series(name)
+        return numbered is not None and numbered[1] >= self._newest.get(numbered[0], -1)
+
+    def touch(self, name):
+        """Mark name as just used, adding it if it is new"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry:
+                self._entries[name] = (entry[0], now)
+                self._entries.move_to_end(name)
+                return
+        try:
+            size = os.path.getsize(os.path.join(self.directory, name))
+        except OSError:
+            return
+        self._add(name, size, now)
+
+    def forget(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry:
+                self._total -= entry[0]
+                if self._newest_in_series_locked(name):
+                    # Removed by someone else; the next highest is now the one to keep
+                    self._count_series_locked()
+
+    def retain(self, names):
+        """Drop entries not among names (a watcher's full listing) and restore last-use order"""
+        with self._lock:
+            entries = sorted((item for item in self._entries.items() if item[0] in names), key=lambda item: item[1][1])
+            self._entries = OrderedDict(entries)
+            self._total = sum(size for size, _ in self._entries.values())
+            self._count_series_locked()
+            self._loaded = True
+
+    def _due_locked(self, limit):
+        """Up to limit (filename, size) pairs to delete, least recently used first"""
+        now = time.time()
+        excess = self._total - self.max_bytes if self.max_bytes else 0
+        due = []
+        for name, (size, used) in self._entries.items():
+            if len(due) >= limit:
+                break
+            expired = self.max_age and now - used > self.max_age
+            if excess <= 0 and not expired:
+                break  # everything after this was used more recently
+            if self._newest_in_series_locked(name) or self.protected(os.path.join(self.directory, name)):
+                continue
+            due.append((name, size))
+            excess -= size
+        return due
+
+    def sweep(self, limit):
+        """Delete at most limit due files; returns (files, bytes) reclaimed"""
+        with self._lock:
+            if not self._loaded:
+                return 0, 0
+            due = self._due_locked(limit)
+        files = reclaimed = 0
+        for name, size in due:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # Deleted by someone else since; nothing was reclaimed here
+                self.forget(name)
+                continue
+            except OSError as e:
+                log.warning("Could not delete %s from %s: %s", name, self.name, e)
+                # Retried once it comes round again, instead of on every pass
+                self.touch(name)
+                continue
+            self.forget(name)
+            files += 1
+            reclaimed += size
+        with self._lock:
+            self.deleted += files
+            self.reclaimed_bytes += reclaimed
+        return files, reclaimed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'bytes': self._total,
+                'max_bytes': self.max_bytes,
+                'max_age': self.max_age,
+                'deleted': self.deleted,
+                'reclaimed_bytes': self.reclaimed_bytes,
+            }
+
+
+class RetentionManager:
+    """Works off each folder's overdue files a batch at a time on one background thread.
+
+    Every RETENTION_INTERVAL seconds at most RETENTION_BATCH files are deleted
+    per folder, so a large backlog (a new cap, or the first run on an old
+    folder) drains over several passes instead of stalling the disk while
+    requests are being served.
+    """
+
+    def __init__(self, interval=None, batch=None):
+        self.interval = interval or config.RETENTION_INTERVAL
+        self.batch = batch or config.RETENTION_BATCH
+        self.folders = []
+        self._thread = None
+        register_collector(self._collect)
+
+    def add_folder(self, name, directory, max_bytes=0, max_age=0, protected=None, watcher=None, series=None):
+        """Retain a folder; with an OutputWatcher of it, follow that instead of scanning the folder"""
+        folder = RetentionFolder(name, directory, max_bytes, max_age, protected, series)
+        if watcher:
+            watcher.subscribe(folder.on_watcher_event)
+        else:
+            folder.scan = True
+        self.folders.append(folder)
+        return folder
+
+    def start(self):
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        for folder in self.folders:
+            if folder.scan:
+                folder.load()
+        while True:
+            time.sleep(self.interval)
+            for folder in self.folders:
+                if not (folder.max_bytes or folder.max_age):
+                    continue
+                try:
+                    files, reclaimed = folder.sweep(self.batch)
+                except Exception as e:
+                    log.error("Retention error in %s: %s", folder.name, e)
+                    continue
+                if files:
+                    log.info("Retention removed %d files (%d bytes) from %s", files, reclaimed, folder.name,
+                             extra={'folder': folder.name, 'files': files, 'bytes': reclaimed})
+
+    def stats(self):
+        return {folder.name: folder.stats() for folder in self.folders}
+
+    def _collect(self):
+        stats = self.stats()
+        return [
+            ('adventure_retention_bytes', 'gauge', 'Bytes in each retained folder',
+             [({'folder': name}, folder['bytes']) for name, folder in stats.items()]),
+            ('adventure_retention_files', 'gauge', 'Files in each retained folder',
+             [({'folder': name}, folder['files']) for name, folder in stats.items()]),
+            ('adventure_retention_deleted_total', 'counter', 'Files deleted by retention',
+             [({'folder': name}, folder['deleted']) for name, folder in stats.items()]),
+            ('adventure_retention_reclaimed_bytes_total', 'counter', 'Bytes freed by retention',
+             [({'folder': name}, folder['reclaimed_bytes']) for name, folder in stats.items()]),
+        ]
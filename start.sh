@@ -38,10 +38,14 @@ fi
 echo "📁 Creating directories..."
 mkdir -p uploads generated
 
-# Start the Flask application
-echo "🚀 Starting Flask application..."
+# Start the application (python app.py runs Flask's debug server instead, for development)
+echo "🚀 Starting application..."
 echo "Access the app at: http://localhost:5000"
 echo "Press Ctrl+C to stop"
 echo "=========================================="
 
-python app.py
+# One worker process: jobs, ComfyUI trackers and the Ollama scheduler live in memory,
+# so a second process would not see the first one's jobs. Concurrency comes from the
+# event loops instead; Flask requests run on SERVER_THREADS threads (config.py).
+exec uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 1 \
+    --timeout-keep-alive 30 --timeout-graceful-shutdown 10 --no-access-log
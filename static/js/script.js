@@ -15,13 +15,15 @@ const removePhotoBtn = document.getElementById('remove-photo');
 const characterForm = document.getElementById('character-form');
 const generateBtn = document.getElementById('generate-btn');
 const loading = document.getElementById('loading');
+const loadingStage = document.getElementById('loading-stage');
+const loadingPreview = document.getElementById('loading-preview');
 const result = document.getElementById('result');
 const imageGallery = document.getElementById('image-gallery');
 const generationTypeInput = document.getElementById('generation_type');
-const webcamDataInput = document.getElementById('webcam_data');
 
 // State
 let webcamStream = null;
+let webcamBlob = null;
 let hasPhoto = false;
 
 // Initialize
@@ -65,6 +67,7 @@ photoUpload.addEventListener('change', function(e) {
             previewImg.src = e.target.result;
             photoPreview.style.display = 'block';
             webcamContainer.style.display = 'none';
+            webcamBlob = null;
             hasPhoto = true;
             updateGenerateButton();
         };
@@ -93,20 +96,21 @@ captureBtn.addEventListener('click', function() {
     canvas.height = webcam.videoHeight;
     context.drawImage(webcam, 0, 0);
     
-    const dataURL = canvas.toDataURL('image/png');
-    previewImg.src = dataURL;
-    photoPreview.style.display = 'block';
-    webcamContainer.style.display = 'none';
-    webcamDataInput.value = dataURL;
-    
     // Stop webcam stream
     if (webcamStream) {
         webcamStream.getTracks().forEach(track => track.stop());
         webcamStream = null;
     }
     
-    hasPhoto = true;
-    updateGenerateButton();
+    // A compressed binary capture is uploaded as a file part, not a base64 form field
+    canvas.toBlob(function(blob) {
+        webcamBlob = blob;
+        previewImg.src = URL.createObjectURL(blob);
+        photoPreview.style.display = 'block';
+        webcamContainer.style.display = 'none';
+        hasPhoto = true;
+        updateGenerateButton();
+    }, 'image/jpeg', 0.92);
 });
 
 closeWebcamBtn.addEventListener('click', function() {
@@ -120,7 +124,7 @@ closeWebcamBtn.addEventListener('click', function() {
 removePhotoBtn.addEventListener('click', function() {
     photoPreview.style.display = 'none';
     photoUpload.value = '';
-    webcamDataInput.value = '';
+    webcamBlob = null;
     hasPhoto = false;
     updateGenerateButton();
 });
@@ -195,6 +199,9 @@ characterForm.addEventListener('submit', async function(e) {
     
     try {
         const formData = new FormData(characterForm);
+        if (webcamBlob) {
+            formData.append('webcam', webcamBlob, 'webcam.jpg');
+        }
         
         const response = await fetch('/generate', {
             method: 'POST',
@@ -203,21 +210,126 @@ characterForm.addEventListener('submit', async function(e) {
         
         const data = await response.json();
         
-        if (data.success) {
-            displayResult(data);
-            loadGallery(); // Refresh gallery
-        } else {
+        if (!data.success) {
             throw new Error(data.error || 'Generation failed');
         }
+        
+        const job = await followJob(data);
+        displayResult(job.result);
+        loadGallery(); // Refresh gallery
     } catch (error) {
         alert('Error generating character: ' + error.message);
         console.error('Generation error:', error);
     } finally {
         loading.style.display = 'none';
+        loadingStage.textContent = '';
+        loadingPreview.textContent = '';
         generateBtn.disabled = false;
     }
 });
 
+// Job polling
+const STAGE_LABELS = {
+    queued: 'Waiting for a free worker...',
+    vision: 'Studying your photo...',
+    upload: 'Sending your photo to the forge...',
+    description: 'Writing your legend...',
+    queue: 'Queuing the portrait...',
+    generating: 'Painting your portrait...'
+};
+
+// Images ahead of the job in the generation queue, shown after the stage
+let queueNote = '';
+
+// Status URL of the job being followed, cancelled if the page goes away
+let currentJobUrl = null;
+
+window.addEventListener('pagehide', () => {
+    if (currentJobUrl) {
+        fetch(currentJobUrl, { method: 'DELETE', keepalive: true });
+    }
+});
+
+function showJobStage(stage, progress) {
+    loadingStage.textContent = `${STAGE_LABELS[stage] || stage} (${Math.round(progress * 100)}%)${queueNote}`;
+}
+
+function showQueuePosition(queue) {
+    queueNote = queue && queue.position > 0 ? ` · ${queue.position} ahead, about ${queue.estimated_wait}s` : '';
+    loadingStage.textContent = loadingStage.textContent.split(' · ')[0] + queueNote;
+}
+
+// Live updates over Server-Sent Events, falling back to polling if the stream drops
+function followJob(data) {
+    currentJobUrl = data.status_url;
+    const following = window.EventSource ? streamJob(data) : waitForJob(data.status_url);
+    return following.finally(() => { currentJobUrl = null; });
+}
+
+function streamJob(data) {
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(data.events_url);
+        let finished = false;
+        showQueuePosition(data.queue);
+        
+        source.addEventListener('stage', e => {
+            const event = JSON.parse(e.data);
+            showJobStage(event.stage, event.progress);
+        });
+        source.addEventListener('queue', e => {
+            showQueuePosition(JSON.parse(e.data));
+        });
+        source.addEventListener('token', e => {
+            loadingPreview.textContent += JSON.parse(e.data).text;
+        });
+        source.addEventListener('progress', e => {
+            const event = JSON.parse(e.data);
+            loadingStage.textContent = `${STAGE_LABELS[event.stage] || event.stage} step ${event.step}/${event.steps} (${Math.round(event.progress * 100)}%)${queueNote}`;
+        });
+        source.addEventListener('done', e => {
+            finished = true;
+            source.close();
+            resolve({ result: JSON.parse(e.data) });
+        });
+        source.addEventListener('failed', e => {
+            finished = true;
+            source.close();
+            reject(new Error(JSON.parse(e.data).error || 'Generation failed'));
+        });
+        source.addEventListener('cancelled', e => {
+            finished = true;
+            source.close();
+            reject(new Error(JSON.parse(e.data).reason || 'Generation cancelled'));
+        });
+        source.onerror = () => {
+            if (finished) return;
+            source.close();
+            waitForJob(data.status_url).then(resolve, reject);
+        };
+    });
+}
+
+async function waitForJob(statusUrl) {
+    while (true) {
+        const response = await fetch(statusUrl);
+        const job = await response.json();
+        
+        if (!response.ok) {
+            throw new Error(job.error || 'Lost track of generation job');
+        }
+        if (job.status === 'completed') {
+            return job;
+        }
+        if (job.status === 'failed' || job.status === 'cancelled') {
+            throw new Error(job.error || `Generation ${job.status}`);
+        }
+        
+        showQueuePosition(job.queue);
+        showJobStage(job.stage, job.progress);
+        await new Promise(resolve => setTimeout(resolve, 1500));
+    }
+}
+
 function displayResult(data) {
     const characterInfo = document.getElementById('character-info');
     const generatedImage = document.getElementById('generated-image');
@@ -238,6 +350,7 @@ function displayResult(data) {
             </div>
         </div>
         <p><strong>Description:</strong> ${data.character.description}</p>
+        <p><strong>Seed:</strong> ${data.seed}</p>
     `;
     
     // Display generated image
@@ -257,49 +370,127 @@ function displayResult(data) {
 }
 
 // Gallery functionality
+let galleryVersion = null;
+let galleryCursor = null;
+let galleryLoadingMore = false;
+
 async function loadGallery() {
+    // After the first page only fetch what changed since the last response
+    if (galleryVersion !== null) {
+        return refreshGallery();
+    }
+    
     try {
         const response = await fetch('/gallery');
         const data = await response.json();
         
-        if (data.images && data.images.length > 0) {
-            displayGallery(data.images);
-        } else {
-            imageGallery.innerHTML = '<p class="no-images">No characters generated yet. Create your first one!</p>';
-        }
+        galleryVersion = data.version;
+        galleryCursor = data.next_cursor;
+        imageGallery.innerHTML = '';
+        appendGalleryImages(data.images);
+        showEmptyGalleryMessage();
     } catch (error) {
         console.error('Error loading gallery:', error);
         imageGallery.innerHTML = '<p class="no-images">Error loading gallery.</p>';
     }
 }
 
-function displayGallery(images) {
-    imageGallery.innerHTML = '';
+async function refreshGallery() {
+    try {
+        let more = true;
+        while (more) {
+            const response = await fetch(`/gallery?since=${galleryVersion}`);
+            const data = await response.json();
+            
+            data.removed.forEach(image => {
+                const item = findGalleryItem(image);
+                if (item) item.remove();
+            });
+            // Additions arrive newest first, so insert them from the oldest up
+            [...data.images].reverse().forEach(image => {
+                if (!findGalleryItem(image)) {
+                    imageGallery.prepend(createGalleryItem(image));
+                }
+            });
+            
+            galleryVersion = data.version;
+            more = data.more;
+        }
+        showEmptyGalleryMessage();
+    } catch (error) {
+        console.error('Error refreshing gallery:', error);
+    }
+}
+
+async function loadMoreGallery() {
+    if (!galleryCursor || galleryLoadingMore) return;
+    galleryLoadingMore = true;
     
-    images.forEach(image => {
-        const galleryItem = document.createElement('div');
-        galleryItem.className = 'gallery-item';
-        galleryItem.innerHTML = `
-            <img src="/generated/${image}" alt="Generated Character" loading="lazy">
-            <button class="download-btn" onclick="downloadImage('${image}')" title="Download">
-                📥
-            </button>
-            <div class="overlay">
-                <p>Click to view larger</p>
-            </div>
-        `;
-        
-        // Add click to enlarge functionality
-        galleryItem.addEventListener('click', function(e) {
-            if (!e.target.classList.contains('download-btn')) {
-                enlargeImage(image);
-            }
-        });
+    try {
+        const response = await fetch(`/gallery?cursor=${encodeURIComponent(galleryCursor)}`);
+        const data = await response.json();
         
-        imageGallery.appendChild(galleryItem);
+        galleryCursor = data.next_cursor;
+        appendGalleryImages(data.images);
+    } catch (error) {
+        console.error('Error loading more of the gallery:', error);
+    } finally {
+        galleryLoadingMore = false;
+    }
+}
+
+// Fetch the next page when the gallery is scrolled near its end
+imageGallery.addEventListener('scroll', function() {
+    if (imageGallery.scrollTop + imageGallery.clientHeight >= imageGallery.scrollHeight - 200) {
+        loadMoreGallery();
+    }
+});
+
+function findGalleryItem(image) {
+    return imageGallery.querySelector(`.gallery-item[data-image="${CSS.escape(image)}"]`);
+}
+
+function showEmptyGalleryMessage() {
+    const message = imageGallery.querySelector('.no-images');
+    if (imageGallery.querySelector('.gallery-item')) {
+        if (message) message.remove();
+    } else if (!message) {
+        imageGallery.innerHTML = '<p class="no-images">No characters generated yet. Create your first one!</p>';
+    }
+}
+
+function appendGalleryImages(images) {
+    images.forEach(image => {
+        if (!findGalleryItem(image)) {
+            imageGallery.appendChild(createGalleryItem(image));
+        }
     });
 }
 
+function createGalleryItem(image) {
+    const galleryItem = document.createElement('div');
+    galleryItem.className = 'gallery-item';
+    galleryItem.dataset.image = image;
+    galleryItem.innerHTML = `
+        <img src="/generated/${image}?w=256&fmt=webp" alt="Generated Character" loading="lazy">
+        <button class="download-btn" onclick="downloadImage('${image}')" title="Download">
+            📥
+        </button>
+        <div class="overlay">
+            <p>Click to view larger</p>
+        </div>
+    `;
+    
+    // Add click to enlarge functionality
+    galleryItem.addEventListener('click', function(e) {
+        if (!e.target.classList.contains('download-btn')) {
+            enlargeImage(image);
+        }
+    });
+    
+    return galleryItem;
+}
+
 function downloadImage(filename) {
     const link = document.createElement('a');
     link.href = `/download/${filename}`;
@@ -314,7 +505,7 @@ function enlargeImage(filename) {
     modal.innerHTML = `
         <div class="modal-content">
             <span class="close-modal">&times;</span>
-            <img src="/generated/${filename}" alt="Enlarged Character">
+            <img src="/generated/${filename}?w=1024" alt="Enlarged Character">
             <div class="modal-actions">
                 <button onclick="downloadImage('${filename}')" class="modal-download-btn">
                     📥 Download
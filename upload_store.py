@@ -0,0 +1,117 @@
+# Content-addressed photo uploads, streamed to disk while the request is parsed
+
+import hashlib
+import os
+import tempfile
+import threading
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+class UploadStream:
+    """Destination for one multipart file part.
+
+    Werkzeug writes the part here chunk by chunk as it reads the request body;
+    the chunks go straight to a temporary file in the upload folder and into a
+    running SHA-256, and the request is aborted with 413 as soon as the part
+    passes max_bytes. commit() then files it under its hash. A part that is
+    never committed is deleted when the request closes.
+    """
+
+    def __init__(self, directory, max_bytes, content_length=None):
+        if content_length and content_length > max_bytes:
+            raise RequestEntityTooLarge(f"Photo is larger than {max_bytes} bytes")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix='.', suffix='.part', delete=False)
+        self._committed = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.close()
+            raise RequestEntityTooLarge(f"Photo is larger than {self.max_bytes} bytes")
+        self._sha256.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        # read/readline/seek/tell/flush for FileStorage
+        return getattr(self._file, name)
+
+    def commit(self, extension='png', refs=None):
+        """Move the upload to <sha256>.<extension>; an identical earlier upload is reused as is.
+
+        With refs (UploadRefs), the path is held before the earlier copy is
+        looked for, so a cancelled job releasing that copy cannot delete it
+        from under this upload; the caller owns the hold.
+        """
+        if self._committed:
+            return self._committed
+        extension = extension.lower().lstrip('.')
+        if not extension.isalnum():
+            extension = 'png'
+        path = os.path.join(self.directory, f"{self._sha256.hexdigest()}.{extension}")
+        if refs:
+            refs.hold([path])
+        self._file.close()
+        if os.path.exists(path):
+            os.remove(self._file.name)
+        else:
+            os.replace(self._file.name, path)
+        self._committed = path
+        return path
+
+    def close(self):
+        if self._committed:
+            return
+        self._file.close()
+        try:
+            os.remove(self._file.name)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRefs:
+    """Counts the unfinished jobs using each committed upload.
+
+    Uploads are shared by content, so a cancelled job may only delete its
+    photo once no other job still needs the same file; retention also
+    leaves held photos alone.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def hold(self, paths):
+        with self._lock:
+            for path in paths:
+                self._counts[path] = self._counts.get(path, 0) + 1
+
+    def held(self, path):
+        with self._lock:
+            return path in self._counts
+
+    def release(self, paths, delete=False):
+        """Drop one hold on each path; with delete, remove the files no other job holds and return their paths"""
+        unused = []
+        with self._lock:
+            for path in paths:
+                count = self._counts.get(path, 0) - 1
+                if count > 0:
+                    self._counts[path] = count
+                else:
+                    self._counts.pop(path, None)
+                    unused.append(path)
+            if not delete:
+                return []
+            deleted = []
+            for path in unused:
+                try:
+                    os.remove(path)
+                    deleted.append(path)
+                except FileNotFoundError:
+                    pass
+            return deleted
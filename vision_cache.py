@@ -0,0 +1,134 @@
+# Content-addressed cache of vision model descriptions
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from PIL import Image
+
+from hashing import file_sha256
+
+log = logging.getLogger(__name__)
+
+VisionKey = namedtuple('VisionKey', ['sha256', 'phash'])
+
+
+def perceptual_hash(image_path):
+    """64-bit difference hash: survives re-encoding and small webcam jitter"""
+    with Image.open(image_path) as image:
+        pixels = list(image.convert('L').resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def hamming_distance(a, b):
+    return bin((a ^ b) & ((1 << 64) - 1)).count('1')
+
+
+class VisionCache:
+    """Persistent SQLite store of descriptions keyed by image SHA-256 and vision model.
+
+    Exact hits match on content hash; with phash_distance > 0 a near-identical
+    frame (perceptual hash within that Hamming distance) also hits. Entries
+    expire after ttl seconds and the least recently used are evicted past
+    max_entries.
+    """
+
+    def __init__(self, path, max_entries, ttl, phash_distance):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.phash_distance = phash_distance
+        self.hits = 0
+        self.phash_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS descriptions (
+                sha256 TEXT NOT NULL,
+                model TEXT NOT NULL,
+                phash INTEGER,
+                description TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (sha256, model)
+            )''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS descriptions_by_use ON descriptions (last_used)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS descriptions_by_age ON descriptions (created)')
+
+    def key_for(self, image_path):
+        phash = None
+        if self.phash_distance:
+            try:
+                phash = perceptual_hash(image_path)
+            except Exception as e:
+                log.warning("Perceptual hash error: %s", e)
+        return VisionKey(file_sha256(image_path), phash)
+
+    def get(self, key, model):
+        """Cached description for key, or None"""
+        now = time.time()
+        with self._lock:
+            self._db.execute('DELETE FROM descriptions WHERE created < ?', (now - self.ttl,))
+            row = self._db.execute('SELECT sha256, description FROM descriptions WHERE sha256 = ? AND model = ?',
+                                   (key.sha256, model)).fetchone()
+            exact = row is not None
+            if not row and key.phash is not None:
+                row = self._nearest(key.phash, model)
+            if not row:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE descriptions SET last_used = ? WHERE sha256 = ? AND model = ?',
+                             (now, row[0], model))
+            if exact:
+                self.hits += 1
+            else:
+                self.phash_hits += 1
+            return row[1]
+
+    def _nearest(self, phash, model):
+        best = None
+        for sha256, candidate, description in self._db.execute(
+                'SELECT sha256, phash, description FROM descriptions WHERE model = ? AND phash IS NOT NULL',
+                (model,)):
+            distance = hamming_distance(phash, candidate)
+            if distance <= self.phash_distance and (best is None or distance < best[0]):
+                best = (distance, sha256, description)
+        return best[1:] if best else None
+
+    def put(self, key, model, description):
+        now = time.time()
+        with self._lock:
+            self._db.execute('''INSERT OR REPLACE INTO descriptions
+                                (sha256, model, phash, description, created, last_used)
+                                VALUES (?, ?, ?, ?, ?, ?)''',
+                             (key.sha256, model, key.phash, description, now, now))
+            count = self._db.execute('SELECT COUNT(*) FROM descriptions').fetchone()[0]
+            if count > self.max_entries:
+                excess = count - self.max_entries
+                self._db.execute('''DELETE FROM descriptions WHERE rowid IN
+                                    (SELECT rowid FROM descriptions ORDER BY last_used LIMIT ?)''', (excess,))
+                self.evictions += excess
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM descriptions').fetchone()[0]
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'phash_hits': self.phash_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,190 @@
+# Registry of ComfyUI API-format workflows with named patch points
+
+import json
+import logging
+import os
+import threading
+import time
+
+import config
+
+log = logging.getLogger(__name__)
+
+REQUIRED_PATCH_POINTS = ('positive', 'seed', 'image')
+
+
+class WorkflowError(Exception):
+    """Raised for an invalid workflow file or an unknown workflow / patch point"""
+
+
+def is_link(value):
+    """Links between nodes are [source_node_id, output_index]"""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+class Workflow:
+    """One validated workflow file.
+
+    The file holds the API-format prompt under "prompt" and a "patch_points"
+    map of name -> [node_id, input_name]. build() returns a per-request prompt
+    that shares every untouched node with the template, copying only the nodes
+    it patches, so the template itself must never be mutated.
+    """
+
+    def __init__(self, name, path, data, mtime):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.description = data.get('description', '')
+        self.prompt = data['prompt']
+        self.patch_points = {key: tuple(value) for key, value in data['patch_points'].items()}
+        self.progress_node = data.get('progress_node')
+        self._validate()
+
+    def _validate(self):
+        if not isinstance(self.prompt, dict) or not self.prompt:
+            raise WorkflowError(f"{self.name}: 'prompt' must be a non-empty API-format node map")
+        for node_id, node in self.prompt.items():
+            if not isinstance(node, dict) or 'class_type' not in node or not isinstance(node.get('inputs'), dict):
+                raise WorkflowError(f"{self.name}: node {node_id} needs class_type and inputs")
+            for input_name, value in node['inputs'].items():
+                if is_link(value):
+                    if str(value[0]) not in self.prompt:
+                        raise WorkflowError(f"{self.name}: node {node_id}.{input_name} links to missing node {value[0]}")
+        for key in REQUIRED_PATCH_POINTS:
+            if key not in self.patch_points:
+                raise WorkflowError(f"{self.name}: missing required patch point '{key}'")
+        for key, (node_id, input_name) in self.patch_points.items():
+            if input_name not in self.prompt.get(node_id, {}).get('inputs', {}):
+                raise WorkflowError(f"{self.name}: patch point '{key}' targets missing input {node_id}.{input_name}")
+        if self.progress_node and self.progress_node not in self.prompt:
+            raise WorkflowError(f"{self.name}: progress_node {self.progress_node} is not in the prompt")
+
+    def build(self, **values):
+        """Prompt with the named patch points set; None values are left at the template default"""
+        prompt = dict(self.prompt)
+        copied = set()
+        for key, value in values.items():
+            if value is None:
+                continue
+            if key not in self.patch_points:
+                raise WorkflowError(f"{self.name}: unknown patch point '{key}'")
+            node_id, input_name = self.patch_points[key]
+            if node_id not in copied:
+                node = dict(prompt[node_id])
+                node['inputs'] = dict(node['inputs'])
+                prompt[node_id] = node
+                copied.add(node_id)
+            prompt[node_id]['inputs'][input_name] = value
+        return prompt
+
+    def build_branches(self, branches, **shared):
+        """One prompt that renders several variants side by side in a single ComfyUI run.
+
+        branches is a list of patch-point dicts, one per variant; shared values
+        apply to all of them. Every node downstream of a per-branch patch point
+        is cloned for each branch (branch 0 keeps the template ids, branch n
+        gets "<id>_<n>"), while the rest of the graph, such as the checkpoint,
+        LoRAs and the empty latent, is loaded and evaluated once. Returns
+        (prompt, node_maps) where node_maps[n] maps template node ids to the
+        ids used by branch n.
+        """
+        keys = {key for values in branches for key, value in values.items() if value is not None}
+        for key in keys:
+            if key not in self.patch_points:
+                raise WorkflowError(f"{self.name}: unknown patch point '{key}'")
+        branched = {self.patch_points[key][0] for key in keys}
+        grown = True
+        while grown:
+            grown = False
+            for node_id, node in self.prompt.items():
+                if node_id not in branched and any(
+                        is_link(value) and str(value[0]) in branched for value in node['inputs'].values()):
+                    branched.add(node_id)
+                    grown = True
+
+        base = self.build(**shared)
+        prompt = {node_id: node for node_id, node in base.items() if node_id not in branched}
+        node_maps = []
+        for n, values in enumerate(branches):
+            ids = {node_id: node_id if n == 0 else f"{node_id}_{n}" for node_id in branched}
+            for node_id in branched:
+                node = base[node_id]
+                inputs = {
+                    input_name: [ids.get(str(value[0]), value[0]), value[1]] if is_link(value) else value
+                    for input_name, value in node['inputs'].items()
+                }
+                prompt[ids[node_id]] = dict(node, inputs=inputs)
+            for key, value in values.items():
+                if value is not None:
+                    node_id, input_name = self.patch_points[key]
+                    prompt[ids[node_id]]['inputs'][input_name] = value
+            node_maps.append({node_id: ids.get(node_id, node_id) for node_id in self.prompt})
+        return prompt, node_maps
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'description': self.description,
+            'patch_points': sorted(self.patch_points),
+        }
+
+
+class WorkflowRegistry:
+    """Loads every *.json in a directory at startup and picks up edits without a restart.
+
+    get() re-checks file mtimes at most every reload_interval seconds. A file
+    that fails to parse or validate is reported and the previously loaded
+    version of that workflow stays in service.
+    """
+
+    def __init__(self, directory, default, reload_interval=None):
+        self.directory = directory
+        self.default = default
+        self.reload_interval = reload_interval if reload_interval is not None else config.WORKFLOW_RELOAD_INTERVAL
+        self._workflows = {}
+        self._failed = {}  # name -> mtime of a file that did not load, so it is reported once
+        self._lock = threading.Lock()
+        self._checked_at = 0
+        self.reload()
+        if default not in self._workflows:
+            raise WorkflowError(f"Default workflow '{default}' not found in {directory}")
+
+    def reload(self):
+        with self._lock:
+            self._checked_at = time.monotonic()
+            present = set()
+            for filename in sorted(os.listdir(self.directory)):
+                if not filename.endswith('.json'):
+                    continue
+                name = filename[:-len('.json')]
+                path = os.path.join(self.directory, filename)
+                present.add(name)
+                mtime = None
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                    current = self._workflows.get(name)
+                    if (current and current.mtime == mtime) or self._failed.get(name) == mtime:
+                        continue
+                    with open(path) as f:
+                        self._workflows[name] = Workflow(name, path, json.load(f), mtime)
+                    self._failed.pop(name, None)
+                    log.info("Loaded workflow '%s' from %s", name, path)
+                except (OSError, ValueError, KeyError, TypeError, WorkflowError) as e:
+                    self._failed[name] = mtime
+                    log.error("Workflow load error for %s: %s", path, e)
+            for name in set(self._workflows) - present:
+                if name != self.default:
+                    del self._workflows[name]
+
+    def get(self, name=None):
+        if time.monotonic() - self._checked_at >= self.reload_interval:
+            self.reload()
+        workflow = self._workflows.get(name or self.default)
+        if workflow is None:
+            raise WorkflowError(f"Unknown workflow '{name}'")
+        return workflow
+
+    def list(self):
+        self.get()
+        return [workflow.to_dict() for _, workflow in sorted(self._workflows.items())]